@@ -1,5 +1,6 @@
+import atexit
 import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
+from logging.handlers import QueueListener
 import os
 
 from flask import Flask
@@ -8,6 +9,19 @@ from flask_migrate import Migrate
 from flask_login import LoginManager
 
 from config import Config
+from app.database import DatabaseProfile
+from app.replicas import ReplicaRouter, RoutingSession
+from app.search import include_object
+from app.last_seen import LastSeenTracker
+from app.instrumentation import RequestInstrumentation
+from app.metrics import Metrics
+from app.log_handlers import BoundedQueueHandler, DigestMailHandler
+from app.log_handlers import BatchingFileHandler, JsonFormatter
+from app.identity import IdentityCache, UsernameAvailability
+from app.hashing import PasswordHasher
+from app.fragments import FragmentCache
+from app.conditional import ConditionalGet
+from app.graph import SocialGraph
 # from app.forms import LoginForm
 
 
@@ -17,19 +31,45 @@ app = Flask(__name__)
 app.config.from_object(Config)
 
 
+# Pool options and SQLite pragmas, set before the engines are created
+database_profile = DatabaseProfile(app)
+# Sends the reads of a request to a replica until it writes
+replica_router = ReplicaRouter()
 # Creating a db instance using SQLAlchemy
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession,
+                                      'router': replica_router})
+database_profile.attach(db)
+replica_router.init_app(app, db)
 # Setting up migration engine
-migrate = Migrate(app, db)
+migrate = Migrate(app, db, include_object=include_object)
+# Buffering last_seen updates instead of committing on every request
+last_seen_tracker = LastSeenTracker(app, db)
+# Per-request SQL and timing instrumentation (opt-in)
+instrumentation = RequestInstrumentation(app)
+# Request latency histograms and cache counters for /metrics
+metrics = Metrics(app, db)
+# Rendered post cells and profile headers
+fragment_cache = FragmentCache(app, metrics.cache('fragment'))
+# 304 answers for unchanged profile and feed pages
+conditional_get = ConditionalGet(app, metrics)
+# Password hashing in a bounded process pool, shedding load when saturated
+password_hasher = PasswordHasher(app)
+# Follow lookups from an in-memory copy of the followers table (opt-in)
+social_graph = SocialGraph(app, db)
 
 
 # Setting up the Login Manager
 login_manager = LoginManager()
 login_manager.init_app(app)
+# Caching the identity of logged in users between requests
+identity_cache = IdentityCache(app, db, metrics.cache('identity'))
+# Remembering free usernames for the live availability check
+username_availability = UsernameAvailability(
+    app, db, metrics.cache('username'))
 # Load user
 @login_manager.user_loader
 def load_user(user_id):
-    return models.User.query.get(int(user_id))
+    return identity_cache.load(int(user_id))
 
 # Example user input
 # u = User(username='susan', email='susan@example.com')
@@ -47,28 +87,54 @@ if not app.debug:
         secure = None
         if app.config['MAIL_USE_TLS']:
             secure = ()
-        mail_handler = SMTPHandler(
+        # Errors are queued and mailed from a background thread as one
+        # digest per MAIL_DIGEST_WINDOW, so a burst of failing requests
+        # neither waits on SMTP nor floods the admins' inboxes
+        mail_handler = DigestMailHandler(
             mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
             fromaddr='no-reply@' + app.config['MAIL_SERVER'],
             toaddrs=app.config['ADMINS'], subject='Microblog Failure',
-            credentials=auth, secure=secure
+            credentials=auth, secure=secure,
+            window=app.config['MAIL_DIGEST_WINDOW']
             )
-        mail_handler.setLevel(logging.ERROR)
+        mail_queue = BoundedQueueHandler(app.config['MAIL_QUEUE_SIZE'])
+        mail_queue.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+        mail_queue.setLevel(logging.ERROR)
+        mail_handler.queue_handler = mail_queue
+        mail_listener = QueueListener(mail_queue.queue, mail_handler)
+        mail_listener.start()
+        # atexit runs in reverse: drain the queue first, then send the digest
+        atexit.register(mail_handler.close)
+        atexit.register(mail_listener.stop)
         print("📧 Email error logging setup is active")
-        app.logger.addHandler(mail_handler)
+        app.logger.addHandler(mail_queue)
 
-    # Configure a file based error logging system using a RotatingFileHandler
-    if not os.path.exists('logs'):
-        os.mkdir('logs')
-    file_handler = RotatingFileHandler('logs/microblog.log', maxBytes=10240,
-                                       backupCount=10)
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
+    # Configure a file based logging system. Request threads only put records
+    # on a queue; a background thread writes them in batches and rotates
+    log_dir = os.path.dirname(app.config['LOG_FILE'])
+    if log_dir and not os.path.exists(log_dir):
+        os.mkdir(log_dir)
+    file_handler = BatchingFileHandler(
+        app.config['LOG_FILE'], max_bytes=app.config['LOG_MAX_BYTES'],
+        backup_count=app.config['LOG_BACKUP_COUNT'],
+        flush_bytes=app.config['LOG_FLUSH_BYTES'],
+        flush_interval=app.config['LOG_FLUSH_INTERVAL'])
+    if app.config['LOG_JSON']:
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
+    file_queue = BoundedQueueHandler(app.config['LOG_QUEUE_SIZE'])
+    file_queue.setLevel(logging.INFO)
+    file_listener = QueueListener(file_queue.queue, file_handler)
+    file_listener.start()
+    atexit.register(file_handler.close)
+    atexit.register(file_listener.stop)
+    app.logger.addHandler(file_queue)
 
     app.logger.setLevel(logging.INFO)
     app.logger.info('Microblog')
 
 # Import routes at the end, after app and db are ready and errors
-from app import routes, models, errors
\ No newline at end of file
+from app import routes, models, errors, cli
\ No newline at end of file
@@ -0,0 +1,365 @@
+import csv
+import gzip
+import io
+import json
+import sys
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from itertools import islice
+
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+
+from app import db, password_hasher
+from app import search
+from app.models import User, Post, followers, email_digest
+
+# What each kind of record is loaded into, in the order they must be loaded
+TABLES = {'users': 'user', 'posts': 'post', 'follows': 'followers'}
+
+
+class ImportFailed(Exception):
+    """
+    Raised when a record cannot be loaded; earlier batches stay committed.
+    """
+
+
+def guess_format(path):
+    """
+    Return 'csv' for .csv and .csv.gz file names and 'ndjson' otherwise.
+    """
+    return 'csv' if path.removesuffix('.gz').endswith('.csv') else 'ndjson'
+
+
+@contextmanager
+def open_text(path, mode='r', compress=None):
+    """
+    Open a file for reading or writing text, '-' being stdin or stdout.
+
+    Args:
+        path (str): The file name, or '-'.
+        mode (str): 'r' or 'w'.
+        compress (bool, optional): Whether the data is gzipped; by default
+                                   files named .gz are.
+    """
+    if compress is None:
+        compress = path.endswith('.gz')
+    if path != '-':
+        opener = gzip.open if compress else open
+        with opener(path, mode + 't', encoding='utf-8', newline='') as stream:
+            yield stream
+        return
+    stream = sys.stdin if mode == 'r' else sys.stdout
+    if not compress:
+        yield stream
+        return
+    # Closing the wrapper finishes the gzip stream but leaves stdout open
+    with io.TextIOWrapper(gzip.GzipFile(fileobj=stream.buffer,
+                                        mode=mode + 'b'),
+                          encoding='utf-8', newline='') as stream:
+        yield stream
+
+
+def read_records(stream, format='ndjson'):
+    """
+    Yield the records of an NDJSON or CSV file one by one, as dicts.
+
+    Args:
+        stream (file): The open text file.
+        format (str): 'ndjson' or 'csv'.
+    """
+    if format == 'csv':
+        for record in csv.DictReader(stream):
+            # An empty cell means "not given", like a missing NDJSON key
+            yield {key: value for key, value in record.items() if value != ''}
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_users(session, records, batch_size=1000, pool=None, progress=None):
+    """
+    Insert users from records with username, email and optionally
+    password, password_hash, about_me and last_seen.
+
+    Plain passwords are hashed with the configured method, a batch at a
+    time, in parallel over pool if one is given.
+
+    Returns:
+        int: Number of users inserted.
+    """
+    now = datetime.now(timezone.utc)
+
+    def rows(batch, first):
+        passwords = [record['password'] for record in batch
+                     if record.get('password') is not None]
+        hashes = iter(password_hasher.hash_many(passwords, pool))
+        for n, record in enumerate(batch, first):
+            email = _field(record, 'email', 'users', n)
+            if record.get('password') is not None:
+                password_hash = next(hashes)
+            else:
+                password_hash = record.get('password_hash')
+            yield {
+                'username': _field(record, 'username', 'users', n),
+                'email': email,
+                'email_digest': email_digest(email),
+                'password_hash': password_hash,
+                'about_me': record.get('about_me'),
+                'last_seen': _timestamp(record.get('last_seen')) or now,
+            }
+
+    return _load(session, 'users', User.__table__, records, rows, batch_size,
+                 progress=progress)
+
+
+def load_posts(session, records, batch_size=1000, progress=None):
+    """
+    Insert posts from records with author (a username), body and
+    optionally timestamp, and add them to the authors' post counts.
+
+    Returns:
+        int: Number of posts inserted.
+    """
+    now = datetime.now(timezone.utc)
+
+    def rows(batch, first):
+        authors = _user_ids(session, batch, ('author',), 'posts', first)
+        for n, record in enumerate(batch, first):
+            yield {
+                'user_id': authors[record['author']],
+                'body': _field(record, 'body', 'posts', n),
+                'timestamp': _timestamp(record.get('timestamp')) or now,
+            }
+
+    def after(batch):
+        _add_counts(session, 'post_count',
+                    Counter(row['user_id'] for row in batch))
+
+    return _load(session, 'posts', Post.__table__, records, rows, batch_size,
+                 after, progress)
+
+
+def load_follows(session, records, batch_size=1000, progress=None):
+    """
+    Insert follow edges from records with follower and followed usernames,
+    and update both users' counters and profile versions.
+
+    Returns:
+        int: Number of edges inserted.
+    """
+    def rows(batch, first):
+        ids = _user_ids(session, batch, ('follower', 'followed'), 'follows',
+                        first)
+        for record in batch:
+            yield {'follower_id': ids[record['follower']],
+                   'followed_id': ids[record['followed']]}
+
+    def after(batch):
+        # Both counts are shown in the cached profile headers
+        _add_counts(session, 'following_count',
+                    Counter(row['follower_id'] for row in batch), True)
+        _add_counts(session, 'followers_count',
+                    Counter(row['followed_id'] for row in batch), True)
+
+    return _load(session, 'follows', followers, records, rows, batch_size,
+                 after, progress)
+
+
+@contextmanager
+def deferred_indexes(session, kinds):
+    """
+    Drop the secondary indexes and search triggers of the tables loaded.
+
+    Unique indexes stay, as they are what rejects duplicate users and
+    edges. When the block ends, even with an error, the indexes and
+    triggers are recreated and the search indexes rebuilt. Only safe
+    while the database is not serving requests, which would otherwise
+    scan whole tables in the meantime.
+    """
+    tables = [TABLES[kind] for kind in kinds]
+    dropped = [index for name in tables
+               for index in db.metadata.tables[name].indexes
+               if not index.unique]
+    sqlite = session.get_bind().dialect.name == 'sqlite'
+    for index in dropped:
+        index.drop(session.connection(), checkfirst=True)
+    if sqlite:
+        search.drop_triggers(
+            session, [name for name in tables if name in search.TRIGGERS])
+    session.commit()
+    try:
+        yield
+    finally:
+        session.rollback()
+        for index in dropped:
+            index.create(session.connection(), checkfirst=True)
+        if sqlite:
+            search.restore_triggers(session)
+        session.commit()
+        if sqlite and any(name in search.TRIGGERS for name in tables):
+            search.rebuild(session)
+
+
+def export_query(kind, since=None, redact=(), password_hashes=False):
+    """
+    Return the query exporting users, posts or follows in the import format.
+
+    Rows come in primary key order, and posts and follows name users by
+    username, so an export loads back with the import command.
+
+    Args:
+        kind (str): 'users', 'posts' or 'follows'.
+        since (int or datetime, optional): Only rows with a greater id or,
+                                           for a datetime, a later timestamp
+                                           (last_seen for users).
+        redact (iterable): Names of columns to leave out.
+        password_hashes (bool): Whether user password hashes are exported.
+
+    Returns:
+        Select: The query; its column names are the record fields.
+    """
+    if kind == 'users':
+        columns = [User.id, User.username, User.email, User.password_hash,
+                   User.about_me, User.last_seen]
+        if not password_hashes:
+            columns.remove(User.password_hash)
+        query = sa.select(*columns).order_by(User.id)
+        keys = {int: User.id, datetime: User.last_seen}
+    elif kind == 'posts':
+        query = (
+            sa.select(Post.id, User.username.label('author'), Post.body,
+                      Post.timestamp)
+            .join(User, User.id == Post.user_id)
+            .order_by(Post.id)
+        )
+        keys = {int: Post.id, datetime: Post.timestamp}
+    else:
+        follower, followed = so.aliased(User), so.aliased(User)
+        query = (
+            sa.select(follower.username.label('follower'),
+                      followed.username.label('followed'))
+            .select_from(followers)
+            .join(follower, follower.id == followers.c.follower_id)
+            .join(followed, followed.id == followers.c.followed_id)
+            .order_by(followers.c.follower_id, followers.c.followed_id)
+        )
+        keys = {}
+    unknown = set(redact) - {column.key for column in query.selected_columns}
+    if unknown:
+        raise ValueError(f'{kind} have no column {", ".join(sorted(unknown))}')
+    if since is not None:
+        if not keys:
+            raise ValueError(f'{kind} have no id or timestamp to export since')
+        query = query.where(keys[type(since)] > since)
+    return query.with_only_columns(
+        *[column for column in query.selected_columns
+          if column.key not in redact])
+
+
+def stream_records(session, query, batch_size=1000):
+    """
+    Yield the rows of an export query as dicts, fetching batch_size rows
+    at a time from a server-side cursor, so memory use stays constant.
+    """
+    result = session.execute(
+        query, execution_options={'yield_per': batch_size})
+    for row in result.mappings():
+        yield {key: value.isoformat() if isinstance(value, datetime) else value
+               for key, value in row.items()}
+
+
+def write_records(stream, records, fields, format='ndjson'):
+    """
+    Write records to an open text file as NDJSON or CSV.
+
+    Returns:
+        int: Number of records written.
+    """
+    count = 0
+    if format == 'csv':
+        writer = csv.DictWriter(stream, fields)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+            count += 1
+    else:
+        for record in records:
+            stream.write(json.dumps(record) + '\n')
+            count += 1
+    return count
+
+
+def _load(session, kind, table, records, rows, batch_size, after=None,
+          progress=None):
+    """
+    Insert the rows built from records with one executemany per batch,
+    committing every batch on its own.
+    """
+    records = iter(records)
+    count = 0
+    while batch := list(islice(records, batch_size)):
+        first, last = count + 1, count + len(batch)
+        batch = list(rows(batch, first))
+        try:
+            session.execute(sa.insert(table), batch)
+            if after is not None:
+                after(batch)
+            session.commit()
+        except sa.exc.IntegrityError as error:
+            session.rollback()
+            raise ImportFailed(
+                f'{kind} records {first}-{last}: {error.orig}') from error
+        count = last
+        if progress is not None:
+            progress(kind, count)
+    return count
+
+
+def _field(record, name, kind, n):
+    try:
+        return record[name]
+    except KeyError:
+        raise ImportFailed(f'{kind} record {n}: "{name}" is missing') from None
+
+
+def _timestamp(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+def _user_ids(session, batch, fields, kind, first):
+    """
+    Map the usernames referenced by a batch to user ids in one query.
+    """
+    names = set()
+    for n, record in enumerate(batch, first):
+        for field in fields:
+            names.add(_field(record, field, kind, n))
+    ids = dict(session.execute(
+        sa.select(User.username, User.id).where(User.username.in_(names))).all())
+    for n, record in enumerate(batch, first):
+        for field in fields:
+            if record[field] not in ids:
+                raise ImportFailed(
+                    f'{kind} record {n}: unknown user "{record[field]}" in "{field}"')
+    return ids
+
+
+def _add_counts(session, column, counts, bump_profile_version=False):
+    """
+    Add per-user amounts to a counter column with one executemany UPDATE,
+    optionally retiring the users' cached fragments as well.
+    """
+    user = User.__table__
+    values = {column: user.c[column] + sa.bindparam('amount')}
+    if bump_profile_version:
+        values['profile_version'] = user.c.profile_version + 1
+    session.execute(
+        sa.update(user).where(user.c.id == sa.bindparam('user_id'))
+        .values(values),
+        [{'user_id': user_id, 'amount': amount}
+         for user_id, amount in counts.items()])
@@ -0,0 +1,285 @@
+import os
+import time
+from contextlib import nullcontext
+from datetime import datetime
+
+import click
+import sqlalchemy as sa
+
+from app import app, db, password_hasher, social_graph
+from app.models import User, Timeline, Suggestion
+from app import search as search_index
+from app import bulk
+
+
+@app.cli.group()
+def timeline():
+    """Home timeline maintenance commands."""
+    pass
+
+
+@timeline.command()
+def rebuild():
+    """
+    Recompute every user's home timeline from posts and followers.
+
+    Run this once after enabling TIMELINE_ENABLED on an existing database.
+    """
+    Timeline.rebuild()
+    db.session.commit()
+    count = db.session.scalar(sa.select(sa.func.count()).select_from(Timeline))
+    click.echo(f'Timeline rebuilt with {count} entries.')
+
+
+@app.cli.group()
+def counters():
+    """Denormalized User counter commands."""
+    pass
+
+
+@counters.command()
+@click.option('--repair', is_flag=True,
+              help='Overwrite drifted counters with the real counts.')
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='Number of user ids checked per query.')
+def verify(repair, chunk_size):
+    """
+    Compare the stored follower/following/post counters with the real counts.
+
+    Users are checked in id ranges of --chunk-size so the command never holds
+    a long transaction on a large table.
+    """
+    last_id = db.session.scalar(sa.select(sa.func.max(User.id))) or 0
+    drifted = 0
+    for first_id in range(1, last_id + 1, chunk_size):
+        rows = db.session.execute(
+            User.counter_drift(first_id, first_id + chunk_size - 1)).all()
+        for user_id, fans, idols, posts in rows:
+            drifted += 1
+            click.echo(f'User {user_id}: followers={fans} following={idols} '
+                       f'posts={posts}')
+            if repair:
+                db.session.execute(
+                    sa.update(User).where(User.id == user_id).values(
+                        followers_count=fans, following_count=idols,
+                        post_count=posts))
+        db.session.commit()
+    if repair:
+        click.echo(f'Repaired {drifted} users.')
+    else:
+        click.echo(f'{drifted} users have drifted counters.')
+
+
+@app.cli.group()
+def search():
+    """Full-text search index commands."""
+    pass
+
+
+@search.command('rebuild')
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='Number of ids indexed per transaction.')
+def rebuild_search(chunk_size):
+    """
+    Rebuild the post and user search indexes from the existing rows.
+
+    The indexes are kept current by triggers; run this after restoring a
+    database, or if an index was damaged. Rows are indexed in id ranges of
+    --chunk-size, each in its own transaction.
+    """
+    search_index.rebuild(
+        db.session, chunk_size,
+        progress=lambda table, last_id: click.echo(
+            f'{table}: indexed up to id {last_id}'))
+    click.echo('Search indexes rebuilt.')
+
+
+@app.cli.group()
+def suggestions():
+    """"Who to follow" suggestion commands."""
+    pass
+
+
+@suggestions.command('rebuild')
+@click.option('--size', default=app.config['SUGGESTIONS_SIZE'],
+              show_default=True, help='Suggestions kept per user.')
+@click.option('--chunk-size', default=1000, show_default=True,
+              help='Number of users whose lists are replaced per transaction.')
+def rebuild_suggestions(size, chunk_size):
+    """
+    Recompute every user's friends-of-friends suggestions.
+
+    Run this periodically, e.g. nightly from cron; follows made in between
+    only remove suggestions, as followed users are left out when reading.
+    """
+    start = time.perf_counter()
+    written = Suggestion.rebuild(size, chunk_size)
+    click.echo(f'Wrote {written} suggestions in '
+               f'{time.perf_counter() - start:.1f}s.')
+
+
+@app.cli.group()
+def data():
+    """Bulk import and export commands."""
+    pass
+
+
+@data.command('import')
+@click.option('--users', type=click.Path(dir_okay=False, allow_dash=True),
+              help='Users: username, email, password or password_hash, '
+                   'about_me, last_seen.')
+@click.option('--posts', type=click.Path(dir_okay=False, allow_dash=True),
+              help='Posts: author (a username), body, timestamp.')
+@click.option('--follows', type=click.Path(dir_okay=False, allow_dash=True),
+              help='Follow edges: follower, followed (usernames).')
+@click.option('--format', type=click.Choice(['ndjson', 'csv']),
+              help='File format; guessed from each file name by default.')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Number of rows inserted per transaction.')
+@click.option('--hash-workers', default=os.cpu_count() or 1,
+              show_default=True,
+              help='Processes hashing passwords; 0 hashes in this process.')
+@click.option('--defer-indexes', is_flag=True,
+              help='Drop secondary indexes during the load and rebuild them '
+                   'after. Only while no one is using the database.')
+def import_data(users, posts, follows, format, batch_size, hash_workers,
+                defer_indexes):
+    """
+    Load users, posts and follow edges from NDJSON or CSV files.
+
+    Records are streamed and inserted --batch-size rows at a time with one
+    executemany statement, each batch in its own transaction. Posts and
+    follows refer to users by username, so they may be loaded in a later
+    run than their users; the counters of the users involved are kept up
+    to date. Files named .gz are decompressed on the fly; give '-' to read
+    a file from standard input.
+    """
+    files = {'users': users, 'posts': posts, 'follows': follows}
+    files = {kind: path for kind, path in files.items() if path is not None}
+    if not files:
+        raise click.UsageError('Give at least one of --users, --posts and '
+                               '--follows.')
+    loaders = {
+        'users': bulk.load_users,
+        'posts': bulk.load_posts,
+        'follows': bulk.load_follows,
+    }
+    deferred = bulk.deferred_indexes(db.session, files) \
+        if defer_indexes else nullcontext()
+    pool = password_hasher.bulk_pool(hash_workers) \
+        if 'users' in files and hash_workers > 0 else nullcontext()
+    try:
+        with deferred, pool:
+            for kind, path in files.items():
+                options = {'pool': pool} if kind == 'users' and \
+                    hash_workers > 0 else {}
+                start = time.perf_counter()
+                with bulk.open_text(path) as stream:
+                    records = bulk.read_records(
+                        stream, format or bulk.guess_format(path))
+                    count = loaders[kind](
+                        db.session, records, batch_size,
+                        progress=lambda kind, count: click.echo(
+                            f'{kind}: {count} rows', err=True),
+                        **options)
+                elapsed = time.perf_counter() - start
+                click.echo(f'Imported {count} {kind} in {elapsed:.1f}s '
+                           f'({count / max(elapsed, 1e-9):.0f} rows/s).')
+    except (bulk.ImportFailed, ValueError) as error:
+        raise click.ClickException(str(error))
+    if app.config['TIMELINE_ENABLED'] and ('posts' in files or
+                                           'follows' in files):
+        Timeline.rebuild()
+        db.session.commit()
+        click.echo('Timeline rebuilt.')
+
+
+def _since(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise click.BadParameter('expected an id or an ISO 8601 timestamp')
+
+
+@data.command('export')
+@click.argument('kind', type=click.Choice(list(bulk.TABLES)))
+@click.option('--output', '-o', default='-', show_default=True,
+              type=click.Path(dir_okay=False, writable=True, allow_dash=True),
+              help='File to write; gzipped if its name ends in .gz.')
+@click.option('--format', type=click.Choice(['ndjson', 'csv']),
+              help='File format; guessed from the file name by default.')
+@click.option('--since', callback=_since,
+              help='Only rows with a greater id or, given an ISO 8601 '
+                   'timestamp, a later timestamp (last_seen for users).')
+@click.option('--gzip', 'compress', is_flag=True,
+              help='Compress the output, e.g. when writing to stdout.')
+@click.option('--redact', multiple=True, metavar='COLUMN',
+              help='Leave out a column, e.g. email. May be repeated.')
+@click.option('--password-hashes', is_flag=True,
+              help='Include user password hashes, which are left out by '
+                   'default.')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Number of rows fetched from the database at a time.')
+def export_data(kind, output, format, since, compress, redact,
+                password_hashes, batch_size):
+    """
+    Write all users, posts or follow edges as NDJSON or CSV.
+
+    Rows are streamed from a server-side cursor --batch-size at a time, so
+    memory use stays the same whatever the size of the table. The output
+    loads back with flask data import. For incremental exports, pass the
+    last id reported by the previous run as --since.
+    """
+    try:
+        query = bulk.export_query(kind, since, redact, password_hashes)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+    fields = [column.key for column in query.selected_columns]
+    last = {}
+
+    def records():
+        for record in bulk.stream_records(db.session, query, batch_size):
+            last['id'] = record.get('id')
+            yield record
+
+    start = time.perf_counter()
+    with bulk.open_text(output, 'w', compress or None) as stream:
+        count = bulk.write_records(stream, records(), fields,
+                                   format or bulk.guess_format(output))
+    elapsed = time.perf_counter() - start
+    message = f'Exported {count} {kind} in {elapsed:.1f}s ' \
+              f'({count / max(elapsed, 1e-9):.0f} rows/s)'
+    if last.get('id') is not None:
+        message += f', last id {last["id"]}'
+    click.echo(message + '.', err=True)
+
+
+@app.cli.group()
+def graph():
+    """In-memory social graph commands."""
+    pass
+
+
+@graph.command()
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              help='Snapshot file; SOCIAL_GRAPH_PATH by default.')
+def snapshot(output):
+    """
+    Write the followers table to a memory-mappable snapshot file.
+
+    Workers using SOCIAL_GRAPH_PATH switch to the new snapshot on their next
+    lookup. Run this after a bulk import, and now and then to fold the delta
+    log into the snapshot.
+    """
+    if not (output or social_graph.path):
+        raise click.UsageError('Pass --output or set SOCIAL_GRAPH_PATH.')
+    start = time.perf_counter()
+    _, edges = social_graph.snapshot(output)
+    click.echo(f'Wrote {edges} follows to {output or social_graph.path} in '
+               f'{time.perf_counter() - start:.1f}s.')
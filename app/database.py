@@ -0,0 +1,91 @@
+from functools import partial
+
+import sqlalchemy as sa
+
+# Pragma sets selectable with SQLITE_PROFILE. 'tuned' lets readers run
+# alongside the writer (WAL), waits for locks instead of failing at once,
+# syncs only at checkpoints and keeps more of the database in memory.
+PROFILES = {
+    'default': {},
+    'tuned': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'cache_size': -64000,
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    },
+}
+
+
+def _is_memory(url):
+    return url.database in (None, '', ':memory:')
+
+
+class DatabaseProfile:
+    """
+    Engine options and connection pragmas for the application database.
+
+    Before the engines are created, init_app() fills in
+    SQLALCHEMY_ENGINE_OPTIONS from the DATABASE_POOL_* settings and, with
+    SQLITE_READ_ONLY_ENGINE, adds a 'readonly' bind that opens the same
+    SQLite file in read-only mode. Once they exist, attach(db) applies the
+    pragmas of SQLITE_PROFILE, overridden by SQLITE_PRAGMAS, to every new
+    SQLite connection.
+
+    Attributes:
+        pragmas (dict): The pragmas run on each new connection, in order.
+
+    Methods:
+        init_app(app): Sets the engine options; call before SQLAlchemy(app).
+        attach(db): Installs the pragma hook on the created engines.
+    """
+
+    def __init__(self, app=None):
+        self.pragmas = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.pragmas = dict(PROFILES[app.config['SQLITE_PROFILE']])
+        self.pragmas.update(app.config['SQLITE_PRAGMAS'])
+        url = sa.engine.make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        # Copied, so that the dicts of the Config class are never modified
+        options = app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+            app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+        options.setdefault('pool_pre_ping', app.config['DATABASE_POOL_PRE_PING'])
+        # In-memory SQLite runs on a single shared connection, without a pool
+        if url.get_backend_name() != 'sqlite' or not _is_memory(url):
+            if app.config['DATABASE_POOL_SIZE']:
+                options.setdefault('pool_size', app.config['DATABASE_POOL_SIZE'])
+            options.setdefault('max_overflow', app.config['DATABASE_MAX_OVERFLOW'])
+        if app.config['SQLITE_READ_ONLY_ENGINE'] and \
+                url.get_backend_name() == 'sqlite' and not _is_memory(url):
+            binds = app.config['SQLALCHEMY_BINDS'] = dict(
+                app.config.get('SQLALCHEMY_BINDS') or {})
+            binds.setdefault('readonly', url.set(
+                database=f'file:{url.database}',
+                query={**url.query, 'mode': 'ro', 'uri': 'true'},
+            ).render_as_string(hide_password=False))
+
+    def attach(self, db):
+        with self.app.app_context():
+            engines = dict(db.engines)
+        for key, engine in engines.items():
+            if engine.dialect.name == 'sqlite':
+                sa.event.listen(engine, 'connect',
+                                partial(self._configure, key == 'readonly'))
+
+    def _configure(self, read_only, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in self.pragmas.items():
+                # journal_mode is a property of the file, the writer sets it
+                if read_only and name == 'journal_mode':
+                    continue
+                cursor.execute(f'PRAGMA {name} = {value}')
+            if read_only:
+                cursor.execute('PRAGMA query_only = ON')
+        finally:
+            cursor.close()
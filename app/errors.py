@@ -1,5 +1,6 @@
 from flask import render_template
 from app import app, db
+from app.hashing import HashingBusy
 
 @app.errorhandler(404)
 def not_found_error(error):
@@ -10,3 +11,9 @@ def internal_error(error):
     db.session.rollback()
     return render_template('500.html'), 500
 
+
+@app.errorhandler(HashingBusy)
+def hashing_busy_error(error):
+    # Shed the login instead of queueing it behind the hashes already running
+    db.session.rollback()
+    return render_template('503.html'), 503, {'Retry-After': '1'}
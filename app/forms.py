@@ -27,7 +27,62 @@ class LoginForm(FlaskForm):
     remember_me = BooleanField('Remember Me')
     submit = SubmitField('Sign In')
 
-class RegistrationForm(FlaskForm):
+class UniqueUserMixin:
+    """
+    Uniqueness checks for forms with a username and optionally an email field.
+
+    Both values are checked in a single query returning only existence
+    flags. A user who registers or renames concurrently can still win the
+    race between that check and the commit; the unique indexes then reject
+    the row and unique_violation() reports the IntegrityError on the field.
+
+    Methods:
+        check_unique(username, email): Adds errors for values already in use.
+        unique_violation(error): Maps an IntegrityError to a field error.
+    """
+    taken_messages = {
+        'username': 'Please use a different username.',
+        'email': 'Please use a different email address.',
+    }
+
+    def check_unique(self, username=None, email=None):
+        """
+        Add a field error for each given value that is already in use.
+
+        Returns:
+            bool: True if neither value is taken.
+        """
+        if username is None and email is None:
+            return True
+        taken = User.identifiers_taken(username, email)
+        for name, is_taken in zip(('username', 'email'), taken):
+            if is_taken:
+                self[name].errors.append(self.taken_messages[name])
+        return not any(taken)
+
+    def unique_violation(self, error):
+        """
+        Report an IntegrityError from ix_user_username or ix_user_email.
+
+        Args:
+            error (IntegrityError): The error raised by the commit.
+
+        Returns:
+            bool: True if the error was a uniqueness violation on this form.
+        """
+        message = str(error.orig)
+        for name in ('username', 'email'):
+            if name not in self:
+                continue
+            # SQLite names the column, other databases the index
+            if f'user.{name}' in message or f'ix_user_{name}' in message:
+                self[name].errors = list(self[name].errors)
+                self[name].errors.append(self.taken_messages[name])
+                return True
+        return False
+
+
+class RegistrationForm(UniqueUserMixin, FlaskForm):
     """
     A user registration form built using Flask-WTF
 
@@ -41,8 +96,7 @@ class RegistrationForm(FlaskForm):
         submit (SubmitField): Button to submit the form.
 
     Methods:
-        validate_username(): Ensures the username used doesn't already exist.
-        validate_email(): Ensures the email used doesn't already exist.
+        validate(): Also ensures the username and email don't already exist.
     """
     username = StringField('Username', validators=[DataRequired()])
     email = StringField('Email', validators=[DataRequired(), Email()])
@@ -51,19 +105,14 @@ class RegistrationForm(FlaskForm):
         'Repeat Password', validators=[DataRequired(), EqualTo('password')])
     submit = SubmitField('Register')
 
-    def validate_username(self, username):
-        user = db.session.scalar(sa.select(User).where(
-            User.username == username.data))
-        if user is not None:
-            raise ValidationError('Please use a different username.')
-        
-    def validate_email(self, email):
-        user = db.session.scalar(sa.select(User).where(
-            User.email == email.data))
-        if user is not None:
-            raise ValidationError('Please use a different email address.')
-
-class EditProfileForm(FlaskForm):
+    def validate(self, extra_validators=None):
+        valid = super().validate(extra_validators)
+        # Only look up the values that passed their own validators
+        username = None if self.username.errors else self.username.data
+        email = None if self.email.errors else self.email.data
+        return self.check_unique(username, email) and valid
+
+class EditProfileForm(UniqueUserMixin, FlaskForm):
     """
     A form to edit the user profile page.
 
@@ -72,7 +121,7 @@ class EditProfileForm(FlaskForm):
         about_me (TextAreaField): The about me section for the user.
 
     Methods:
-        ...
+        validate(): Also ensures a changed username is not already taken.
     """
     username = StringField('Username', validators=[DataRequired()])
     about_me = TextAreaField('About me', validators=[Length(min=0, max=140)])
@@ -90,21 +139,18 @@ class EditProfileForm(FlaskForm):
         super().__init__(*args, **kwargs)
         self.original_username = original_username
     
-    def validate_username(self, username):
+    def validate(self, extra_validators=None):
         """
-        Validate that the username is not already taken by another user.
-
-        Args:
-            username: The form field data containing the username to validate.
+        Validate the form, then check that a changed username is not taken.
 
-        Raises:
-            ValidationError: If the username is already used by a different user.
+        Returns:
+            bool: True if the form is valid and the username is available.
         """
-        if username.data != self.original_username:
-            user = db.session.scalar(sa.select(User).where(
-                User.username == username.data))
-            if user is not None:
-                raise ValidationError('Please use a different username.')
+        valid = super().validate(extra_validators)
+        if self.username.errors or \
+                self.username.data == self.original_username:
+            return valid
+        return self.check_unique(username=self.username.data) and valid
             
 
 class EmptyForm(FlaskForm):
@@ -0,0 +1,161 @@
+import os
+import sqlite3
+import threading
+
+from flask import render_template
+from markupsafe import Markup
+
+from app.lru import LRUCache
+
+
+class LRUBackend(LRUCache):
+    """
+    A bounded, thread-safe in-process LRU store of rendered fragments.
+
+    Fragments never expire; they are keyed by version and simply age out.
+
+    Attributes:
+        maxsize (int): Maximum number of fragments kept.
+    """
+
+    def __init__(self, maxsize=10000):
+        super().__init__(maxsize)
+
+
+class SQLiteBackend:
+    """
+    A fragment store in a local SQLite file, shared by all worker processes.
+
+    Every thread uses its own connection. The file is bounded to roughly
+    maxsize fragments by periodically deleting the oldest written ones.
+
+    Attributes:
+        path (str): The SQLite file.
+        maxsize (int): Approximate maximum number of fragments kept.
+    """
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, maxsize=100000):
+        self.path = path
+        self.maxsize = maxsize
+        self._local = threading.local()
+        self._writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS fragment '
+                         '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA synchronous = OFF')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT value FROM fragment WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set(self, key, value):
+        try:
+            with self._connect() as conn:
+                # REPLACE gives the row a new rowid, so rowid order is age
+                conn.execute('INSERT OR REPLACE INTO fragment (key, value) '
+                             'VALUES (?, ?)', (key, value))
+                self._writes += 1
+                if self._writes % self.PRUNE_EVERY == 0:
+                    conn.execute('DELETE FROM fragment WHERE rowid <= '
+                                 '(SELECT MAX(rowid) FROM fragment) - ?',
+                                 (self.maxsize,))
+        except sqlite3.OperationalError:
+            # A busy cache is not worth failing the request for
+            pass
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM fragment')
+
+
+class FragmentCache:
+    """
+    Caches the rendered HTML of post cells and profile headers.
+
+    Fragments are keyed by what they show: a post cell by (post id, author
+    author_version) and a profile header by (user id, profile_version).
+    follow(), unfollow() and edit_profile() bump profile_version, and only
+    edit_profile() bumps author_version, so a follow leaves the post cells
+    cached. An outdated fragment is simply never asked for again and ages
+    out; no worker has to be told to drop anything. Lookups go to an in-process
+    LRU first and then, with FRAGMENT_CACHE_PATH set, to a SQLite file
+    shared by all workers.
+
+    Attributes:
+        enabled (bool): Whether fragments are cached at all.
+        backends (list): The stores, checked in order.
+
+    Methods:
+        init_app(app, stats): Reads the configuration, adds template globals.
+        post(post): Returns the rendered _post.html cell of a post.
+        profile_header(user): Returns the rendered profile header of a user.
+    """
+
+    def __init__(self, app=None, stats=None):
+        self.enabled = False
+        self.backends = []
+        self.stats = None
+        if app is not None:
+            self.init_app(app, stats)
+
+    def init_app(self, app, stats=None):
+        self.stats = stats
+        self.enabled = app.config['FRAGMENT_CACHE_SIZE'] > 0
+        self.backends = [LRUBackend(app.config['FRAGMENT_CACHE_SIZE'])]
+        if app.config['FRAGMENT_CACHE_PATH']:
+            self.backends.append(SQLiteBackend(
+                app.config['FRAGMENT_CACHE_PATH'],
+                app.config['FRAGMENT_CACHE_SHARED_SIZE']))
+        app.jinja_env.globals['cached_post'] = self.post
+        app.jinja_env.globals['cached_profile_header'] = self.profile_header
+
+    def post(self, post):
+        return self._fragment(
+            f'post:{post.id}:{post.author.author_version}',
+            '_post.html', post=post)
+
+    def profile_header(self, user):
+        return self._fragment(
+            f'profile:{user.id}:{user.profile_version}',
+            '_profile_header.html', user=user)
+
+    def clear(self):
+        for backend in self.backends:
+            backend.clear()
+
+    def _fragment(self, key, template, **context):
+        if not self.enabled:
+            return Markup(render_template(template, **context))
+        for i, backend in enumerate(self.backends):
+            html = backend.get(key)
+            if html is not None:
+                # Fill the faster stores in front of the one that had it
+                for faster in self.backends[:i]:
+                    faster.set(key, html)
+                self._count('hit')
+                return Markup(html)
+        self._count('miss')
+        html = render_template(template, **context)
+        for backend in self.backends:
+            backend.set(key, html)
+        return Markup(html)
+
+    def _count(self, result):
+        if self.stats is not None:
+            getattr(self.stats, result)()
@@ -0,0 +1,149 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingBusy(Exception):
+    """
+    Raised when every password hashing slot of this worker is taken, or the
+    pool could not answer in time.
+    """
+
+
+class PasswordHasher:
+    """
+    Runs password hashing and verification off the request threads.
+
+    Password hashes are deliberately slow to compute, so a login storm used
+    to pin every worker thread. Operations now run in a bounded process pool
+    of PASSWORD_HASH_WORKERS processes (0 hashes inline), and at most
+    PASSWORD_HASH_CONCURRENCY of them may be in flight per worker; beyond
+    that HashingBusy is raised at once, which is answered with a 503, rather
+    than queueing requests behind each other. An operation that takes longer
+    than PASSWORD_HASH_TIMEOUT seconds, or whose pool lost a process, is
+    answered the same way; a broken pool is replaced for the next request.
+
+    Attributes:
+        method (str): The werkzeug hash method, including its cost parameters.
+        workers (int): Size of the process pool.
+        concurrency (int): Maximum operations in flight in this worker.
+        timeout (float): Seconds to wait for a pooled operation.
+
+    Methods:
+        init_app(app): Reads the configuration.
+        hash(password): Returns a new hash of the password.
+        verify(pwhash, password): Checks a password against a stored hash.
+        needs_rehash(pwhash): Whether a hash was made with another method or cost.
+        bulk_pool(workers): Returns a process pool for hash_many().
+        hash_many(passwords, pool): Hashes a batch of passwords in parallel.
+    """
+
+    def __init__(self, app=None):
+        self.workers = 0
+        self.concurrency = 1
+        self.timeout = None
+        self._method = None
+        self._prefix = None
+        self._slots = threading.BoundedSemaphore(1)
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = app.config['PASSWORD_HASH_METHOD']
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.concurrency = app.config['PASSWORD_HASH_CONCURRENCY']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+
+    @property
+    def method(self):
+        return self._method
+
+    @method.setter
+    def method(self, method):
+        self._method = method
+        # werkzeug fills in default parameters, e.g. 'scrypt' is stored as
+        # 'scrypt:32768:8:1', so take the prefix from a real hash
+        self._prefix = generate_password_hash('', method).split('$', 1)[0]
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return pwhash.split('$', 1)[0] != self._prefix
+
+    @staticmethod
+    def bulk_pool(workers):
+        """
+        Return a new process pool for hashing batches outside of requests.
+
+        The caller shuts it down, e.g. by using it as a context manager.
+        """
+        return ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def hash_many(self, passwords, pool=None):
+        """
+        Hash a batch of passwords, spread over the processes of pool.
+
+        Meant for bulk loads, so the request concurrency limit does not
+        apply. Without a pool the passwords are hashed one by one.
+
+        Args:
+            passwords (list): The passwords to hash.
+            pool (Executor, optional): A pool from bulk_pool().
+
+        Returns:
+            list: The hashes, in the order of passwords.
+        """
+        if pool is None:
+            return [generate_password_hash(password, self.method)
+                    for password in passwords]
+        return list(pool.map(generate_password_hash, passwords,
+                             [self.method] * len(passwords), chunksize=4))
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            if self.workers == 0:
+                return function(*args)
+            pool = self._pool()
+            try:
+                return pool.submit(function, *args).result(self.timeout)
+            except TimeoutError:
+                # The process finishes the hash in the background; the slot
+                # is freed now so a stuck pool cannot hold the worker
+                raise HashingBusy() from None
+            except BrokenProcessPool:
+                self._discard(pool)
+                raise HashingBusy() from None
+        finally:
+            self._slots.release()
+
+    def _pool(self):
+        with self._executor_lock:
+            # A pool inherited from a preloading parent is not ours to use
+            if self._executor is None or self._executor_pid != os.getpid():
+                # spawn: the children only need werkzeug, not a copy of the app
+                self._executor = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context('spawn'))
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _discard(self, pool):
+        with self._executor_lock:
+            # Another thread may already have replaced it
+            if self._executor is pool:
+                self._executor = None
+        pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,215 @@
+import sqlalchemy as sa
+
+from app.lru import LRUCache
+
+
+def _by_id(name):
+    """
+    Return a Principal method running the User method name on the principal.
+    """
+    def method(self, *args, **kwargs):
+        from app.models import User
+        return getattr(User, name)(self, *args, **kwargs)
+
+    method.__name__ = name
+    return method
+
+
+class Principal:
+    """
+    The lightweight identity of the logged in user, as seen by Flask-Login.
+
+    Holds only what most pages need (id, username, email digest and flags).
+    Follow state and suggestion lookups, and the home feed, only need the id
+    and run without the row too.
+    Any other attribute or method, e.g. current_user.follow(), loads the full
+    User row on first use and delegates to it, so views that never touch it
+    issue no identity query at all. Assignments are written through to the
+    row.
+
+    Attributes:
+        id (int): The user id.
+        username (str): The username.
+        email_digest (str): md5 hex digest of the lower-cased email address.
+        active (bool): Whether the account may log in.
+    """
+    __slots__ = ('id', 'username', 'email_digest', 'active', '_user')
+
+    def __init__(self, id, username, email_digest, active=True):
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'username', username)
+        object.__setattr__(self, 'email_digest', email_digest)
+        object.__setattr__(self, 'active', active)
+        object.__setattr__(self, '_user', None)
+
+    # The Flask-Login user interface
+    is_authenticated = True
+    is_anonymous = False
+
+    @property
+    def is_active(self):
+        return self.active
+
+    def get_id(self):
+        return str(self.id)
+
+    def avatar(self, size):
+        from app.models import gravatar_url
+        return gravatar_url(self.email_digest, size)
+
+    # Only the id is needed by these, so they run without the User row
+    follow_states = _by_id('follow_states')
+    is_following = _by_id('is_following')
+    suggestions = _by_id('suggestions')
+    feed_head = _by_id('feed_head')
+    following_posts_page = _by_id('following_posts_page')
+    _feed = _by_id('_feed')
+    _timeline_feed = _by_id('_timeline_feed')
+
+    def materialize(self):
+        """
+        Return the full User row for this principal, loading it once.
+        """
+        if self._user is None:
+            from app.models import User
+            from app import db
+            object.__setattr__(self, '_user', db.session.get(User, self.id))
+        return self._user
+
+    def __getattr__(self, name):
+        return getattr(self.materialize(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.materialize(), name, value)
+        if name in Principal.__slots__:
+            object.__setattr__(self, name, value)
+
+    def __eq__(self, other):
+        # Compare like flask_login.UserMixin, so User == Principal works too
+        if hasattr(other, 'get_id') and not getattr(other, 'is_anonymous', True):
+            return self.get_id() == other.get_id()
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return '<Principal {}>'.format(self.username)
+
+
+class IdentityCache:
+    """
+    A TTL-bounded LRU cache of user identities for Flask-Login's user_loader.
+
+    Loading the logged in user used to fetch the full User row on every
+    request. The cache keeps the (id, username, email digest, flags) tuple of
+    recently active users for IDENTITY_CACHE_TTL seconds, so a cache hit costs
+    no query. Each worker has its own cache; entries are invalidated locally
+    when a profile is edited and expire elsewhere after the TTL. At most
+    IDENTITY_CACHE_SIZE identities are kept.
+
+    Methods:
+        init_app(app, db, stats): Reads the configuration.
+        load(user_id): Returns the Principal for a user id, or None.
+        invalidate(user_id): Drops a user's cached identity.
+    """
+
+    def __init__(self, app=None, db=None, stats=None):
+        self._entries = LRUCache(10000, 60.0)
+        if app is not None:
+            self.init_app(app, db, stats)
+
+    def init_app(self, app, db, stats=None):
+        self.db = db
+        self.stats = stats
+        self._entries = LRUCache(app.config['IDENTITY_CACHE_SIZE'],
+                                 app.config['IDENTITY_CACHE_TTL'])
+
+    def load(self, user_id):
+        identity = self._entries.get(user_id)
+        if identity is not None:
+            self._count('hit')
+            return Principal(*identity)
+        self._count('miss')
+        identity = self._fetch(user_id)
+        if identity is None:
+            return None
+        self._entries.set(user_id, identity)
+        return Principal(*identity)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id)
+
+    def clear(self):
+        self._entries.clear()
+
+    def _fetch(self, user_id):
+        user = self.db.metadata.tables['user']
+        row = self.db.session.execute(
+            sa.select(user.c.id, user.c.username, user.c.email_digest)
+            .where(user.c.id == user_id)).first()
+        if row is None:
+            return None
+        return (row.id, row.username, row.email_digest, True)
+
+    def _count(self, result):
+        if self.stats is not None:
+            getattr(self.stats, result)()
+
+
+class UsernameAvailability:
+    """
+    A TTL-bounded cache of usernames known to be free, for live validation.
+
+    Only negative lookups are cached: a name that was free a moment ago is
+    answered without a query, while a taken name is always looked up again.
+    Registering or renaming a user claims the name in this worker; other
+    workers may report it as free for up to USERNAME_CACHE_TTL seconds,
+    which is harmless because submitting the form checks again. At most
+    USERNAME_CACHE_SIZE names are kept.
+
+    Methods:
+        init_app(app, db, stats): Reads the configuration.
+        is_available(username): Whether no user has that username.
+        claim(username): Forgets a name that has just been taken.
+    """
+
+    def __init__(self, app=None, db=None, stats=None):
+        self._entries = LRUCache(10000, 30.0)
+        if app is not None:
+            self.init_app(app, db, stats)
+
+    def init_app(self, app, db, stats=None):
+        self.db = db
+        self.stats = stats
+        self._entries = LRUCache(app.config['USERNAME_CACHE_SIZE'],
+                                 app.config['USERNAME_CACHE_TTL'])
+
+    def is_available(self, username):
+        if self._entries.get(username):
+            self._count('hit')
+            return True
+        self._count('miss')
+        user = self.db.metadata.tables['user']
+        taken = self.db.session.scalar(
+            sa.select(sa.exists().where(user.c.username == username)))
+        if taken:
+            return False
+        self._entries.set(username, True)
+        return True
+
+    def claim(self, username):
+        self._entries.pop(username)
+
+    def clear(self):
+        self._entries.clear()
+
+    def _count(self, result):
+        if self.stats is not None:
+            getattr(self.stats, result)()
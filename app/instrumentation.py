@@ -0,0 +1,146 @@
+import time
+
+import sqlalchemy as sa
+from flask import g, has_request_context, request
+from flask import before_render_template, template_rendered
+
+
+class RequestTiming:
+    """
+    The cost of a single request, collected while it is being handled.
+
+    Attributes:
+        start (float): perf_counter() value when the request started.
+        queries (int): Number of SQL statements executed.
+        db_time (float): Seconds spent executing SQL statements.
+        render_time (float): Seconds spent rendering templates.
+    """
+    __slots__ = ('start', 'queries', 'db_time', 'render_time', '_renders')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self._renders = []
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+def current_timing():
+    """
+    Return the RequestTiming of the active request, or None outside of one.
+    """
+    if not has_request_context():
+        return None
+    return g.get('request_timing')
+
+
+class RequestInstrumentation:
+    """
+    Opt-in per-request SQL, template and wall time instrumentation.
+
+    When INSTRUMENTATION_ENABLED is set, every request records how many SQL
+    statements it ran, the time spent in the database and in templates, and
+    its total wall time. The numbers are returned to the client in a
+    Server-Timing header and written to the application log as structured
+    fields. Statements slower than SLOW_QUERY_THRESHOLD milliseconds are
+    logged together with their parameters and the route that issued them.
+
+    Attributes:
+        enabled (bool): Whether requests are being instrumented.
+        slow_query_threshold (float): Slow query threshold in seconds.
+
+    Methods:
+        init_app(app): Registers the request, template and engine hooks.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.slow_query_threshold = 0.1
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config['INSTRUMENTATION_ENABLED']
+        self.slow_query_threshold = app.config['SLOW_QUERY_THRESHOLD'] / 1000
+        # Hooks are always installed so that instrumentation can be switched
+        # on at runtime; they return immediately while disabled
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._finish_render, app)
+        sa.event.listen(sa.engine.Engine, 'before_cursor_execute',
+                        self._start_query)
+        sa.event.listen(sa.engine.Engine, 'after_cursor_execute',
+                        self._finish_query)
+
+    def _start_request(self):
+        if self.enabled:
+            g.request_timing = RequestTiming()
+
+    def _finish_request(self, response):
+        timing = current_timing()
+        if timing is None:
+            return response
+        total = timing.elapsed()
+        response.headers['Server-Timing'] = ', '.join([
+            f'db;dur={timing.db_time * 1000:.1f};desc="{timing.queries} queries"',
+            f'render;dur={timing.render_time * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ])
+        fields = {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'queries': timing.queries,
+            'db_ms': round(timing.db_time * 1000, 1),
+            'render_ms': round(timing.render_time * 1000, 1),
+            'total_ms': round(total * 1000, 1),
+        }
+        self.app.logger.info(
+            ' '.join(f'{key}={value}' for key, value in fields.items()),
+            extra=fields)
+        return response
+
+    def _start_render(self, sender, template, context, **extra):
+        timing = current_timing()
+        if timing is not None:
+            timing._renders.append(time.perf_counter())
+
+    def _finish_render(self, sender, template, context, **extra):
+        timing = current_timing()
+        if timing is not None and timing._renders:
+            started = timing._renders.pop()
+            # Only the outermost template counts, nested renders are inside it
+            if not timing._renders:
+                timing.render_time += time.perf_counter() - started
+
+    def _start_query(self, conn, cursor, statement, parameters, context,
+                     executemany):
+        # Kept on the statement's own context, which is dropped with it even
+        # when the statement fails and _finish_query never runs
+        if self.enabled and context is not None:
+            context._query_start = time.perf_counter()
+
+    def _finish_query(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        started = getattr(context, '_query_start', None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        timing = current_timing()
+        if timing is not None:
+            timing.queries += 1
+            timing.db_time += elapsed
+        if elapsed >= self.slow_query_threshold:
+            route = request.endpoint if has_request_context() else None
+            self.app.logger.warning(
+                'Slow query (%.1f ms) in route %s: %s %r',
+                elapsed * 1000, route, statement, parameters,
+                extra={'duration_ms': round(elapsed * 1000, 1),
+                       'route': route, 'statement': statement,
+                       'parameters': repr(parameters)})
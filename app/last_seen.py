@@ -0,0 +1,170 @@
+import atexit
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import sqlalchemy as sa
+
+
+class LastSeenTracker:
+    """
+    Buffers User.last_seen updates in memory and writes them in batches.
+
+    Recording activity on every request used to mean a commit per request,
+    which on SQLite serializes all traffic behind the write lock. The tracker
+    instead keeps the latest timestamp per user, ignores updates that would
+    move last_seen by less than LAST_SEEN_GRANULARITY seconds, and flushes
+    the dirty entries with a single UPDATE ... WHERE id IN (...) either at
+    request teardown or from a background thread.
+
+    Attributes:
+        granularity (timedelta): Updates closer together than this are absorbed.
+        flush_interval (float): Minimum number of seconds between two flushes.
+        counters (dict): 'touches', 'absorbed', 'flushes' and 'rows_written'.
+
+    Methods:
+        init_app(app, db): Reads the configuration and registers the hooks.
+        touch(user_id, stored): Records activity for a user.
+        flush(): Writes all pending timestamps to the database.
+        stats(): Returns a snapshot of the counters.
+    """
+
+    def __init__(self, app=None, db=None):
+        self.granularity = timedelta(seconds=60)
+        self.flush_interval = 5.0
+        self.counters = {'touches': 0, 'absorbed': 0, 'flushes': 0,
+                         'rows_written': 0}
+        self._pending = {}
+        self._written = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._thread = None
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        self.granularity = timedelta(
+            seconds=app.config['LAST_SEEN_GRANULARITY'])
+        self.flush_interval = app.config['LAST_SEEN_FLUSH_INTERVAL']
+        if app.config['LAST_SEEN_FLUSH_THREAD']:
+            self.start()
+        else:
+            app.teardown_request(self._flush_if_due)
+        atexit.register(self.stop)
+
+    def touch(self, user_id, stored=None, now=None):
+        """
+        Record that a user was active.
+
+        Args:
+            user_id (int): The id of the active user.
+            stored (datetime, optional): The last_seen value loaded from the db.
+            now (datetime, optional): The activity time; defaults to utcnow.
+
+        Returns:
+            bool: True if a write was queued, False if it was absorbed.
+        """
+        now = now or datetime.now(timezone.utc)
+        with self._lock:
+            self.counters['touches'] += 1
+            newest = max(
+                (_aware(v) for v in (stored, self._written.get(user_id),
+                                     self._pending.get(user_id)) if v),
+                default=None)
+            if newest is not None and now - newest < self.granularity:
+                self.counters['absorbed'] += 1
+                return False
+            self._pending[user_id] = now
+            return True
+
+    def flush(self):
+        """
+        Write every pending timestamp in one UPDATE statement.
+
+        Returns:
+            int: The number of users written.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return 0
+        user = self.db.metadata.tables['user']
+        stmt = (
+            sa.update(user)
+            .where(user.c.id.in_(pending))
+            .values(last_seen=sa.case(pending, value=user.c.id))
+        )
+        try:
+            with self.db.engine.begin() as connection:
+                connection.execute(stmt)
+        except sa.exc.SQLAlchemyError:
+            # Put the entries back so the next flush retries them
+            with self._lock:
+                for user_id, seen in pending.items():
+                    self._pending.setdefault(user_id, seen)
+            raise
+        with self._lock:
+            cutoff = datetime.now(timezone.utc) - self.granularity
+            self._written = {k: v for k, v in self._written.items()
+                             if v > cutoff}
+            self._written.update(pending)
+            self.counters['flushes'] += 1
+            self.counters['rows_written'] += len(pending)
+        return len(pending)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['pending'] = len(self._pending)
+        return stats
+
+    def start(self):
+        """
+        Flush from a daemon thread every flush_interval seconds.
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='last-seen-flusher')
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread, if any, and write what is left.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.flush_interval + 1)
+            self._thread = None
+        try:
+            with self.app.app_context():
+                self.flush()
+        except sa.exc.SQLAlchemyError:
+            self.app.logger.exception('Failed to flush last_seen')
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except sa.exc.SQLAlchemyError:
+                    self.app.logger.exception('Failed to flush last_seen')
+
+    def _flush_if_due(self, exc=None):
+        if time.monotonic() - self._last_flush < self.flush_interval:
+            return
+        try:
+            self.flush()
+        except sa.exc.SQLAlchemyError:
+            self.app.logger.exception('Failed to flush last_seen')
+
+
+def _aware(value):
+    # SQLite hands back naive datetimes; everything stored is UTC
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
@@ -0,0 +1,316 @@
+import hashlib
+import json
+import logging
+import os
+import queue
+import smtplib
+import threading
+import traceback
+from datetime import datetime, timezone
+from email.message import EmailMessage
+from logging.handlers import QueueHandler
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    A QueueHandler that never blocks the logging thread.
+
+    Records are put on a bounded queue without waiting; when the queue is
+    full the record is dropped and counted instead, so a burst of errors
+    cannot slow down the requests that log them.
+
+    Attributes:
+        dropped (int): Number of records dropped because the queue was full.
+    """
+
+    def __init__(self, maxsize=1000):
+        super().__init__(queue.Queue(maxsize=maxsize))
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Remember what the error was before the traceback is merged into msg
+        record.digest_key = _digest_key(record)
+        return super().prepare(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _digest_key(record):
+    if record.exc_info and record.exc_info[1] is not None:
+        # The same exception type raised from the same frames is the same
+        # error, whatever its message says
+        exc_type, _, tb = record.exc_info
+        frames = traceback.extract_tb(tb)
+        signature = exc_type.__qualname__ + ''.join(
+            f'|{frame.filename}:{frame.lineno}' for frame in frames)
+    else:
+        signature = f'{record.pathname}:{record.lineno}:{record.msg}'
+    return hashlib.sha1(signature.encode('utf-8')).hexdigest()
+
+
+class DigestMailHandler(logging.Handler):
+    """
+    Aggregates error records and mails them as one digest per time window.
+
+    Identical errors (same traceback, or same log call when there is no
+    traceback) are grouped and sent once with a count, so a burst of 500s
+    produces one email rather than hundreds. Each flush opens a single SMTP
+    connection. Meant to run behind a QueueListener, off the request thread.
+
+    Attributes:
+        window (float): Seconds over which errors are collected into a digest.
+        sent (int): Number of digest emails sent.
+        failed (int): Number of digests that could not be delivered.
+        queue_handler (BoundedQueueHandler, optional): Whose drops to report.
+
+    Methods:
+        emit(record): Adds a record to the current digest.
+        flush(): Sends the current digest, if it has any records.
+        close(): Stops the timer and sends what is left.
+    """
+
+    def __init__(self, mailhost, fromaddr, toaddrs, subject, credentials=None,
+                 secure=None, timeout=5.0, window=60.0, max_groups=50):
+        super().__init__()
+        self.mailhost, self.mailport = mailhost
+        self.fromaddr = fromaddr
+        self.toaddrs = toaddrs
+        self.subject = subject
+        self.credentials = credentials
+        self.secure = secure
+        self.timeout = timeout
+        self.window = window
+        self.max_groups = max_groups
+        self.sent = 0
+        self.failed = 0
+        self.queue_handler = None
+        self._groups = {}
+        self._reported_drops = 0
+        self._stop = threading.Event()
+        self._timer = threading.Thread(target=self._run, daemon=True,
+                                       name='error-mail-digest')
+        self._timer.start()
+
+    def emit(self, record):
+        now = datetime.now(timezone.utc)
+        key = getattr(record, 'digest_key', None) or _digest_key(record)
+        with self.lock:
+            group = self._groups.get(key)
+            if group is None:
+                if len(self._groups) >= self.max_groups:
+                    key = 'overflow'
+                    group = self._groups.setdefault(key, {
+                        'count': 0, 'first': now, 'last': now,
+                        'text': 'Further distinct errors were not itemized.'})
+                else:
+                    group = self._groups[key] = {
+                        'count': 0, 'first': now, 'last': now,
+                        'text': self.format(record)}
+            group['count'] += 1
+            group['last'] = now
+
+    def flush(self):
+        with self.lock:
+            groups, self._groups = self._groups, {}
+        dropped = 0
+        if self.queue_handler is not None:
+            dropped = self.queue_handler.dropped - self._reported_drops
+            self._reported_drops += dropped
+        if not groups and not dropped:
+            return
+        try:
+            self._send(self._build(groups, dropped))
+            self.sent += 1
+        except (OSError, smtplib.SMTPException):
+            # Logging the failure could feed straight back into this handler
+            self.failed += 1
+            traceback.print_exc()
+
+    def close(self):
+        self._stop.set()
+        self._timer.join(self.timeout)
+        self.flush()
+        super().close()
+
+    def _build(self, groups, dropped):
+        total = sum(group['count'] for group in groups.values())
+        msg = EmailMessage()
+        msg['From'] = self.fromaddr
+        msg['To'] = ','.join(self.toaddrs)
+        msg['Subject'] = (f'{self.subject} ({total} errors, '
+                          f'{len(groups)} distinct)')
+        parts = []
+        for group in sorted(groups.values(), key=lambda g: -g['count']):
+            parts.append(f"=== {group['count']}x between "
+                         f"{group['first']:%Y-%m-%d %H:%M:%S} and "
+                         f"{group['last']:%H:%M:%S} UTC ===\n{group['text']}")
+        if dropped:
+            parts.append(f'{dropped} error records were dropped because the '
+                         'mail queue was full.')
+        msg.set_content('\n\n'.join(parts))
+        return msg
+
+    def _send(self, msg):
+        with smtplib.SMTP(self.mailhost, self.mailport,
+                          timeout=self.timeout) as smtp:
+            if self.credentials:
+                if self.secure is not None:
+                    smtp.ehlo()
+                    smtp.starttls(*self.secure)
+                    smtp.ehlo()
+                smtp.login(*self.credentials)
+            smtp.send_message(msg)
+
+    def _run(self):
+        while not self._stop.wait(self.window):
+            self.flush()
+
+
+try:
+    import fcntl
+except ImportError:  # Windows: rotation is only safe with a single process
+    fcntl = None
+
+# Attributes every LogRecord has; anything else was passed in through extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord(
+    '', logging.INFO, '', 0, '', None, None))) | {'message', 'asctime',
+                                                  'digest_key'}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line for machine ingestion.
+
+    Fields passed through extra=, such as the per-request timings logged by
+    RequestInstrumentation, are included as top-level keys.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc)
+            .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'path': record.pathname,
+            'line': record.lineno,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+class BatchingFileHandler(logging.Handler):
+    """
+    Writes log lines to a size-rotated file in batches.
+
+    Formatted lines are buffered and written with a single os.write() on an
+    O_APPEND descriptor once flush_bytes have accumulated or flush_interval
+    seconds have passed, so whole batches land atomically and lines from
+    several worker processes never interleave. Rotation is serialized
+    between processes with an flock on '<filename>.lock'; the other
+    processes notice the renamed file and reopen. Meant to run behind a
+    QueueListener, off the request thread.
+
+    Attributes:
+        filename (str): The active log file.
+        max_bytes (int): Size at which the file is rotated.
+        backup_count (int): Number of rotated files kept.
+        flush_bytes (int): Buffered size that triggers a write.
+        flush_interval (float): Maximum seconds a line stays buffered.
+    """
+
+    def __init__(self, filename, max_bytes=10 * 1024 * 1024, backup_count=10,
+                 flush_bytes=64 * 1024, flush_interval=1.0):
+        super().__init__()
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._buffered = 0
+        self._fd = None
+        self._open()
+        self._stop = threading.Event()
+        self._timer = threading.Thread(target=self._run, daemon=True,
+                                       name='log-file-writer')
+        self._timer.start()
+
+    def emit(self, record):
+        try:
+            line = (self.format(record) + '\n').encode('utf-8')
+        except Exception:
+            self.handleError(record)
+            return
+        self._buffer.append(line)
+        self._buffered += len(line)
+        if self._buffered >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self._buffer or self._fd is None:
+                return
+            data = b''.join(self._buffer)
+            self._buffer, self._buffered = [], 0
+            if self._rotated_elsewhere():
+                self._open()
+            if os.fstat(self._fd).st_size + len(data) > self.max_bytes:
+                self._rotate()
+            os.write(self._fd, data)
+
+    def close(self):
+        self._stop.set()
+        self._timer.join(self.flush_interval + 1)
+        self.flush()
+        with self.lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        super().close()
+
+    def _open(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.filename,
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _rotated_elsewhere(self):
+        try:
+            return os.stat(self.filename).st_ino != os.fstat(self._fd).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _rotate(self):
+        lock = open(self.filename + '.lock', 'a')
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another process may have rotated while we waited for the lock
+            if not self._rotated_elsewhere() and \
+                    os.fstat(self._fd).st_size > 0:
+                for i in range(self.backup_count - 1, 0, -1):
+                    source = f'{self.filename}.{i}'
+                    if os.path.exists(source):
+                        os.replace(source, f'{self.filename}.{i + 1}')
+                if self.backup_count > 0:
+                    os.replace(self.filename, self.filename + '.1')
+                else:
+                    os.remove(self.filename)
+            self._open()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
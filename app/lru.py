@@ -0,0 +1,58 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe in-process LRU mapping with optional expiry.
+
+    The least recently used entry is evicted once more than maxsize are
+    kept. With a ttl, an entry is also forgotten that many seconds after it
+    was set, however often it is read. None is not a valid value, as get()
+    returns it for a miss.
+
+    Attributes:
+        maxsize (int): Maximum number of entries kept.
+        ttl (float): Seconds an entry lives, or None to keep it until evicted.
+
+    Methods:
+        get(key): Returns the value of a live entry, or None.
+        set(key, value): Stores an entry, evicting the oldest if full.
+        pop(key): Forgets an entry.
+        clear(): Forgets every entry.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
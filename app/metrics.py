@@ -0,0 +1,257 @@
+import bisect
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from flask import g, request
+
+# Upper bounds in seconds of the request latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           float('inf'))
+
+_MAGIC = b'MBMETRIC'
+_HEADER = struct.Struct('<8sII')  # magic, header length, slot count
+_SLOT = struct.Struct('<d')
+
+
+class MetricsStore:
+    """
+    A table of named float slots, kept in an mmap'd file per process.
+
+    Every process writes only to its own file, so no cross-process locking
+    is needed; a scrape sums the slots of all files in the directory. When
+    no directory is configured the slots live in anonymous memory and only
+    the current process is reported.
+
+    Attributes:
+        directory (str, optional): Where the per-process files are kept.
+
+    Methods:
+        register(names): Adds slots; allowed at any time.
+        add(name, amount): Adds to a slot.
+        collect(): Returns the summed slots of every process.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._names = []
+        self._index = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._map = None
+
+    def register(self, names):
+        with self._lock:
+            for name in names:
+                if name not in self._index:
+                    self._index[name] = len(self._names)
+                    self._names.append(name)
+            if self._map is not None and self._pid == os.getpid():
+                self._open(carry=True)
+
+    def add(self, name, amount=1.0):
+        with self._lock:
+            if self._pid != os.getpid():
+                # First write in this process, e.g. a freshly forked worker
+                self._open()
+            offset = self._offset(self._index[name])
+            value, = _SLOT.unpack_from(self._map, offset)
+            _SLOT.pack_into(self._map, offset, value + amount)
+
+    def collect(self):
+        """
+        Return a dict of slot name to the value summed over all processes.
+        """
+        if self.directory is None:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._open()
+                return self._read(self._map)
+        totals = {}
+        for path in glob.glob(os.path.join(self.directory, '*.metrics')):
+            try:
+                with open(path, 'rb') as f:
+                    values = self._read(f.read())
+            except (OSError, ValueError, struct.error):
+                continue
+            for name, value in values.items():
+                totals[name] = totals.get(name, 0.0) + value
+        return totals
+
+    def _offset(self, index):
+        return self._data_start + index * _SLOT.size
+
+    def _open(self, carry=False):
+        previous = self._read(self._map) if carry else {}
+        header = json.dumps(self._names).encode('utf-8')
+        self._data_start = _HEADER.size + len(header)
+        size = self._data_start + len(self._names) * _SLOT.size
+        content = bytearray(size)
+        _HEADER.pack_into(content, 0, _MAGIC, len(header), len(self._names))
+        content[_HEADER.size:self._data_start] = header
+        for name, value in previous.items():
+            _SLOT.pack_into(content, self._offset(self._index[name]), value)
+        if self.directory is None:
+            self._map = mmap.mmap(-1, size)
+            self._map[:] = content
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f'{os.getpid()}.metrics')
+            # Readers see either the old or the new file, never a partial one
+            with open(path + '.tmp', 'wb') as f:
+                f.write(content)
+            os.replace(path + '.tmp', path)
+            with open(path, 'r+b') as f:
+                self._map = mmap.mmap(f.fileno(), size)
+        self._pid = os.getpid()
+
+    @staticmethod
+    def _read(buffer):
+        magic, header_length, count = _HEADER.unpack_from(buffer, 0)
+        if magic != _MAGIC:
+            raise ValueError('not a metrics file')
+        start = _HEADER.size + header_length
+        names = json.loads(bytes(buffer[_HEADER.size:start]))
+        return {name: _SLOT.unpack_from(buffer, start + i * _SLOT.size)[0]
+                for i, name in enumerate(names[:count])}
+
+
+class CacheStats:
+    """
+    Hit and miss counters for one cache, exported with its hit ratio.
+    """
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        store.register([self._slot('hits'), self._slot('misses')])
+
+    def hit(self):
+        self.store.add(self._slot('hits'))
+
+    def miss(self):
+        self.store.add(self._slot('misses'))
+
+    def _slot(self, kind):
+        return f'cache:{self.name}:{kind}'
+
+
+class Metrics:
+    """
+    In-process request metrics exported in the Prometheus text format.
+
+    Request latencies are recorded into fixed-bucket histograms, one per
+    endpoint listed in METRICS_ENDPOINTS; all other endpoints share the
+    'other' histogram. Caches register hit/miss counters through cache().
+    With METRICS_DIR set, every gunicorn worker writes to its own mmap'd
+    file in that directory and /metrics reports the sum over all workers.
+    The directory should be emptied when the server (re)starts, as files of
+    exited workers keep being counted.
+
+    Methods:
+        init_app(app, db): Reads the configuration and registers the hooks.
+        cache(name): Returns the CacheStats for a named cache.
+        observe(endpoint, seconds): Records one request.
+        render(): Returns the metrics in the Prometheus text format.
+    """
+
+    def __init__(self, app=None, db=None):
+        self.store = MetricsStore()
+        self.endpoints = ()
+        self.caches = {}
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.db = db
+        self.store.directory = app.config['METRICS_DIR']
+        self.endpoints = tuple(app.config['METRICS_ENDPOINTS']) + ('other',)
+        self.store.register(
+            self._slot(endpoint, part)
+            for endpoint in self.endpoints
+            for part in list(range(len(BUCKETS))) + ['sum'])
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+    def cache(self, name):
+        if name not in self.caches:
+            self.caches[name] = CacheStats(self.store, name)
+        return self.caches[name]
+
+    def observe(self, endpoint, seconds):
+        if endpoint not in self.endpoints:
+            endpoint = 'other'
+        self.store.add(self._slot(endpoint, bisect.bisect_left(BUCKETS, seconds)))
+        self.store.add(self._slot(endpoint, 'sum'), seconds)
+
+    def render(self):
+        values = self.store.collect()
+        lines = [
+            '# HELP microblog_request_duration_seconds Request latency by endpoint.',
+            '# TYPE microblog_request_duration_seconds histogram',
+        ]
+        for endpoint in self.endpoints:
+            cumulative = 0
+            for i, bound in enumerate(BUCKETS):
+                cumulative += values.get(self._slot(endpoint, i), 0)
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('microblog_request_duration_seconds_bucket'
+                             f'{{endpoint="{endpoint}",le="{le}"}} {cumulative:g}')
+            lines.append('microblog_request_duration_seconds_sum'
+                         f'{{endpoint="{endpoint}"}} '
+                         f'{values.get(self._slot(endpoint, "sum"), 0):g}')
+            lines.append('microblog_request_duration_seconds_count'
+                         f'{{endpoint="{endpoint}"}} {cumulative:g}')
+        lines.extend(self._render_caches(values))
+        lines.extend(self._render_pool())
+        return '\n'.join(lines) + '\n'
+
+    def _render_caches(self, values):
+        if not self.caches:
+            return []
+        lines = [
+            '# HELP microblog_cache_requests_total Cache lookups by result.',
+            '# TYPE microblog_cache_requests_total counter',
+        ]
+        ratios = [
+            '# HELP microblog_cache_hit_ratio Share of cache lookups that hit.',
+            '# TYPE microblog_cache_hit_ratio gauge',
+        ]
+        for name, stats in sorted(self.caches.items()):
+            hits = values.get(stats._slot('hits'), 0)
+            misses = values.get(stats._slot('misses'), 0)
+            lines.append(f'microblog_cache_requests_total'
+                         f'{{cache="{name}",result="hit"}} {hits:g}')
+            lines.append(f'microblog_cache_requests_total'
+                         f'{{cache="{name}",result="miss"}} {misses:g}')
+            ratio = hits / (hits + misses) if hits + misses else 0
+            ratios.append(f'microblog_cache_hit_ratio{{cache="{name}"}} {ratio:g}')
+        return lines + ratios
+
+    def _render_pool(self):
+        # Pool gauges describe the worker answering the scrape only
+        pool = self.db.engine.pool
+        lines = []
+        for stat in ('size', 'checkedin', 'checkedout', 'overflow'):
+            if hasattr(pool, stat):
+                lines.append(f'# TYPE microblog_db_pool_{stat} gauge')
+                lines.append(f'microblog_db_pool_{stat}{{pid="{os.getpid()}"}} '
+                             f'{getattr(pool, stat)()}')
+        return lines
+
+    def _start_request(self):
+        g.metrics_start = time.perf_counter()
+
+    def _finish_request(self, response):
+        start = g.pop('metrics_start', None)
+        if start is not None and request.endpoint != 'metrics':
+            self.observe(request.endpoint, time.perf_counter() - start)
+        return response
+
+    @staticmethod
+    def _slot(endpoint, part):
+        return f'request:{endpoint}:{part}'
@@ -1,15 +1,34 @@
-from app import db
+from app import db, password_hasher, social_graph
+from app.pagination import Page, paginate
+from app import search
+from app.graph import read_adjacency
 
 from typing import Optional
+from collections import Counter, namedtuple
 from datetime import datetime, timezone
 
-from werkzeug.security import generate_password_hash, check_password_hash
 import sqlalchemy as sa
 import sqlalchemy.orm as so
+from flask import current_app, g, has_request_context
 from flask_login import UserMixin
+from functools import lru_cache
 from hashlib import md5
+import heapq
 
 
+def email_digest(email):
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+# How two users follow each other, as seen from one of them
+FollowState = namedtuple('FollowState', ['following', 'followed_by'])
+
+
+# A page shows the same few avatars many times, at one or two sizes
+@lru_cache(maxsize=4096)
+def gravatar_url(digest, size):
+    return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+
 
 class User(UserMixin, db.Model):
     """
@@ -19,10 +38,18 @@ class User(UserMixin, db.Model):
         id (int): Unique primary key for each user.
         username (str): A unique username (max 64 characters).
         email (str): A unique email address (max 120 characters).
+        email_digest (str): md5 hex digest of the lower-cased email, kept in sync with email.
         password_hash (str, optional): The hashed password (max 256 characters).
         posts (List[Post]): A one-to-many relationship to posts authored by the user.
         about_me (str, optional): A brief user bio (max 140 characters).
         last_seen (datetime, optional): The last time the user was seen (defaults to current UTC time).
+        followers_count (int): Denormalized number of followers, kept in sync by follow()/unfollow().
+        following_count (int): Denormalized number of followed users, kept in sync by follow()/unfollow().
+        post_count (int): Denormalized number of posts, kept in sync when posts are flushed.
+        profile_version (int): Bumped whenever the profile header changes, to key its cached
+                               fragments.
+        author_version (int): Bumped when the username or avatar shown in the user's post cells
+                              changes, to key their cached fragments.
         followers (Table): Association table for self-referential many-to-many relationship to track followers.
         followers: Association table for self-referential many-to-many relationship to track followers.
         following: Association table for self-referential many-to-many relationship to track followed users.
@@ -30,14 +57,28 @@ class User(UserMixin, db.Model):
     Methods:
         __repr__(): Returns a readable string representation of the user (e.g., <User johndoe>).
         set_password(password): Hashes and stores the provided password.
-        check_password(password): Verifies a provided password against the stored hash.
+        check_password(password): Verifies a provided password against the stored hash,
+                                  rehashing it if the configured method or cost changed.
         load_user(id): Returns the user with the id specified.
         avatar(size): Return the users gravatar icon.
         follow(user): Follow a user.
         unfollow(user): Unfollow a user.
         is_following(user): Check if the current user is following another user.
-        followers_count(): Returns the number of followers the user has.
-        following_count(): Returns the number of users the user is following.
+        follow_states(users): Returns how the user and each of users follow each other.
+        suggestions(limit): Returns the precomputed users to follow, best first.
+        bump_profile_version(): Retires the cached profile header of this user.
+        bump_author_version(): Retires the cached post cells of this user.
+        counter_drift(): Query comparing stored counters with the real counts.
+        identifiers_taken(username, email): Whether a username or email is in use.
+        following_posts(): Returns a query for the user's home feed.
+        following_posts_page(cursor, per_page): Returns one page of the home feed.
+        feed_head(): Returns the versions and newest post id validating the home feed.
+        newest_post(): Returns the (id, timestamp) of the user's newest post.
+        posts_page(cursor, per_page): Returns one page of the user's own posts.
+        followers_page(cursor, per_page): Returns one page of the user's followers.
+        following_page(cursor, per_page): Returns one page of the followed users.
+        timeline_posts(): Returns a home feed query backed by the timeline table.
+        search_page(terms, cursor, per_page): Returns one page of users matching a search.
     """
 
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
@@ -54,6 +95,8 @@ class User(UserMixin, db.Model):
         unique=True
     )
 
+    email_digest: so.Mapped[str] = so.mapped_column(sa.String(32))
+
     password_hash: so.Mapped[Optional[str]] = so.mapped_column(
         sa.String(256)
     )
@@ -67,13 +110,26 @@ class User(UserMixin, db.Model):
         default=lambda: datetime.now(timezone.utc)
     )
 
+    followers_count: so.Mapped[int] = so.mapped_column(
+        default=0, server_default='0')
+    following_count: so.Mapped[int] = so.mapped_column(
+        default=0, server_default='0')
+    post_count: so.Mapped[int] = so.mapped_column(
+        default=0, server_default='0')
+    profile_version: so.Mapped[int] = so.mapped_column(
+        default=0, server_default='0')
+    author_version: so.Mapped[int] = so.mapped_column(
+        default=0, server_default='0')
+
     followers = sa.Table(
         'followers',
         db.metadata,
         sa.Column('follower_id', sa.Integer, sa.ForeignKey('user.id'),
                   primary_key=True),
         sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id'),
-                  primary_key=True)
+                  primary_key=True),
+        # Reverse of the primary key, for "who follows X" lookups
+        sa.Index('ix_followers_followed_id', 'followed_id', 'follower_id')
     )
 
     following: so.WriteOnlyMapped['User'] = so.relationship(
@@ -92,54 +148,343 @@ class User(UserMixin, db.Model):
         return '<User {}>'.format(self.username)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
         if self.password_hash is None:
             return False
-        return check_password_hash(self.password_hash, password)
+        if not password_hasher.verify(self.password_hash, password):
+            return False
+        # Upgrade hashes made with an older method or cost; the caller
+        # commits along with the rest of the login
+        if password_hasher.needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
     
+    @so.validates('email')
+    def _update_email_digest(self, key, email):
+        # Also runs for User(email=...), so the digest is never stale
+        self.email_digest = email_digest(email) if email is not None else None
+        return email
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return gravatar_url(self.email_digest, size)
     
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            # Incremented in SQL so concurrent follows cannot lose updates
+            self.following_count = User.following_count + 1
+            user.followers_count = User.followers_count + 1
+            self.bump_profile_version()
+            user.bump_profile_version()
+            _forget_follow_states(self.id, user.id)
+            social_graph.record(db.session, self.id, user.id, True)
+            if current_app.config['TIMELINE_ENABLED']:
+                Timeline.backfill(self, user)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self.following_count = User.following_count - 1
+            user.followers_count = User.followers_count - 1
+            self.bump_profile_version()
+            user.bump_profile_version()
+            _forget_follow_states(self.id, user.id)
+            social_graph.record(db.session, self.id, user.id, False)
+            if current_app.config['TIMELINE_ENABLED']:
+                Timeline.prune(self, user)
+                Timeline.demote(user)
+
+    def bump_profile_version(self):
+        # Cached fragments of the old version are never looked up again
+        self.profile_version = User.profile_version + 1
+
+    def bump_author_version(self):
+        # Not bumped by follows, so the post cells outlive them
+        self.author_version = User.author_version + 1
 
     def is_following(self, user):
-        query = self.following.select().where(User.id == user.id)
-        return db.session.scalar(query) is not None
+        return self.follow_states([user])[user.id].following
+
+    def follow_states(self, users):
+        """
+        Return whether the user follows, and is followed by, each of users.
+
+        Both directions are looked up for all users at once, in one query
+        over the followers primary key and its reverse index. Inside a
+        request the answers are remembered until follow() or unfollow()
+        changes them, so rendering a list of users, or asking about the
+        same user again, costs no further queries. With SOCIAL_GRAPH_ENABLED
+        the graph answers instead, unless the session holds follows or
+        unfollows it has not seen yet.
+
+        Args:
+            users (iterable): Users or user ids.
+
+        Returns:
+            dict: A FollowState(following, followed_by) per user id.
+        """
+        users = list(users)
+        if self.id is None or any(getattr(user, 'id', user) is None
+                                  for user in users):
+            # Users that were just added get their ids when flushed
+            db.session.flush()
+        ids = {getattr(user, 'id', user) for user in users}
+        if social_graph.enabled and not social_graph.pending(db.session):
+            return {user_id: FollowState(*state) for user_id, state in
+                    social_graph.follow_states(self.id, ids).items()}
+        memo = _follow_states_memo(self.id)
+        missing = ids - memo.keys()
+        if missing:
+            found = {user_id: [False, False] for user_id in missing}
+            query = sa.union_all(
+                sa.select(followers.c.followed_id, sa.literal(0)).where(
+                    followers.c.follower_id == self.id,
+                    followers.c.followed_id.in_(missing)),
+                sa.select(followers.c.follower_id, sa.literal(1)).where(
+                    followers.c.followed_id == self.id,
+                    followers.c.follower_id.in_(missing)),
+            )
+            for user_id, direction in db.session.execute(query):
+                found[user_id][direction] = True
+            for user_id, state in found.items():
+                memo[user_id] = FollowState(*state)
+        return {user_id: memo[user_id] for user_id in ids}
     
-    def followers_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.followers.select().subquery())
-        return db.session.scalar(query)
+    def suggestions(self, limit=5):
+        """
+        Return the users suggested to follow, best first.
 
-    def following_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.following.select().subquery())
-        return db.session.scalar(query)
+        Reads the list precomputed by Suggestion.rebuild() in one query over
+        the suggestion primary key. Users followed since it was computed
+        are left out by a probe of the followers primary key.
 
-    def following_posts(self):
-        Author = so.aliased(User)
-        Follower = so.aliased(User)
+        Args:
+            limit (int): The maximum number of users returned.
+
+        Returns:
+            list: (user, mutual, follows_you) rows, where mutual is the number
+                  of followed users who follow the suggested user.
+        """
+        following = sa.exists().where(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id == Suggestion.suggested_id)
+        follows_you = sa.exists().where(
+            followers.c.follower_id == Suggestion.suggested_id,
+            followers.c.followed_id == self.id)
+        query = (
+            sa.select(User, Suggestion.score, follows_you)
+            .join(Suggestion, Suggestion.suggested_id == User.id)
+            .where(Suggestion.user_id == self.id, ~following)
+            .order_by(Suggestion.rank)
+            .limit(limit)
+            .options(so.load_only(User.username, User.email_digest))
+        )
+        return db.session.execute(query).all()
+
+    @staticmethod
+    def identifiers_taken(username=None, email=None):
+        """
+        Check whether a username and an email address are already in use.
+
+        Both are answered by one query of two EXISTS flags, each resolved
+        from its unique index without loading any row.
+
+        Args:
+            username (str, optional): The username to look up.
+            email (str, optional): The email address to look up.
+
+        Returns:
+            tuple: (username_taken, email_taken); False for an omitted value.
+        """
+        flags = []
+        for column, value in ((User.username, username), (User.email, email)):
+            if value is None:
+                flags.append(sa.false())
+            else:
+                flags.append(sa.exists().where(column == value))
+        row = db.session.execute(sa.select(*flags)).one()
+        return bool(row[0]), bool(row[1])
+
+    @staticmethod
+    def counter_drift(first_id, last_id):
+        """
+        Return a query for users whose stored counters are out of sync.
+
+        Args:
+            first_id (int): The lowest user id to check.
+            last_id (int): The highest user id to check.
+
+        Returns:
+            Select: Rows of (id, followers, following, posts) with the real counts.
+        """
+        fans = (
+            sa.select(sa.func.count()).select_from(followers)
+            .where(followers.c.followed_id == User.id).scalar_subquery()
+        )
+        idols = (
+            sa.select(sa.func.count()).select_from(followers)
+            .where(followers.c.follower_id == User.id).scalar_subquery()
+        )
+        posts = (
+            sa.select(sa.func.count()).select_from(Post)
+            .where(Post.user_id == User.id).scalar_subquery()
+        )
         return (
+            sa.select(User.id, fans, idols, posts)
+            .where(User.id.between(first_id, last_id))
+            .where(sa.or_(
+                User.followers_count != fans,
+                User.following_count != idols,
+                User.post_count != posts,
+            ))
+        )
+
+    def following_posts(self):
+        return self._feed()[0]
+
+    def following_posts_page(self, cursor=None, per_page=20):
+        """
+        Return one keyset-paginated page of the user's home feed.
+
+        Args:
+            cursor (str, optional): The cursor from a previous page.
+            per_page (int): The number of posts per page.
+
+        Returns:
+            Page: The posts on the page and the cursors around it.
+        """
+        query, keys = self._feed()
+        return paginate(query, keys, cursor, per_page, key_of=_post_key)
+
+    def feed_head(self):
+        """
+        Return the validators of the home feed page in one query.
+
+        The user's profile_version changes with every follow, unfollow and
+        profile edit, the sum of the followed users' author_version when one
+        of them is renamed, and the newest post of the feed with every new
+        post. All are read together, and only the id is needed, so the feed
+        of the logged in user is validated without loading their row.
+
+        Returns:
+            Row: (profile_version, authors_version, post_id), post_id being
+                 None if the feed is empty.
+        """
+        query, keys = self._feed()
+        newest = query.with_only_columns(Post.id).limit(1).scalar_subquery()
+        author = so.aliased(User)
+        authors = (
+            sa.select(sa.func.coalesce(sa.func.sum(author.author_version), 0))
+            .join(followers, followers.c.followed_id == author.id)
+            .where(followers.c.follower_id == self.id)
+            .scalar_subquery()
+        )
+        reader = so.aliased(User)
+        return db.session.execute(
+            sa.select(reader.profile_version, authors, newest)
+            .where(reader.id == self.id)).first()
+
+    def newest_post(self):
+        """
+        Return the id and timestamp of the newest post written by the user.
+
+        Returns:
+            Row: (id, timestamp), or None if the user has not posted.
+        """
+        return db.session.execute(
+            sa.select(Post.id, Post.timestamp).where(Post.user_id == self.id)
+            .order_by(Post.timestamp.desc(), Post.id.desc()).limit(1)).first()
+
+    def posts_page(self, cursor=None, per_page=20):
+        """
+        Return one keyset-paginated page of the posts written by the user.
+        """
+        return paginate(self.posts.select().options(_feed_author),
+                        (Post.timestamp, Post.id), cursor, per_page)
+
+    def followers_page(self, cursor=None, per_page=20):
+        """
+        Return one keyset-paginated page of the user's followers.
+
+        Follow edges carry no timestamp, so the listing is keyed on user id.
+        """
+        return paginate(self.followers.select(), (User.id,), cursor, per_page)
+
+    def following_page(self, cursor=None, per_page=20):
+        """
+        Return one keyset-paginated page of the users this user follows.
+        """
+        return paginate(self.following.select(), (User.id,), cursor, per_page)
+
+    def _feed(self):
+        """
+        Return the home feed query together with its pagination keys.
+        """
+        if current_app.config['TIMELINE_ENABLED']:
+            return self._timeline_feed()
+        followed = sa.select(followers.c.followed_id).where(
+            followers.c.follower_id == self.id)
+        query = (
             sa.select(Post)
-            .join(Post.author.of_type(Author))
-            .join(Author.followers.of_type(Follower), isouter=True)
             .where(sa.or_(
-                Follower.id == self.id,
-                Author.id == self.id,
+                Post.user_id.in_(followed),
+                Post.user_id == self.id,
             ))
-            .group_by(Post)
-            .order_by(Post.timestamp.desc())
+            .order_by(Post.timestamp.desc(), Post.id.desc())
+            .options(_feed_author)
         )
-    
+        return query, (Post.timestamp, Post.id)
+
+    def timeline_posts(self):
+        """
+        Build the home feed from the precomputed timeline table.
+
+        Posts by regular authors are pushed into the timeline when written, so
+        the common case is a single range scan over ix_timeline_user_timestamp.
+        Posts by followed authors above TIMELINE_FANOUT_LIMIT are never pushed
+        and are pulled from the post table at read time instead.
+
+        Returns:
+            Select: A query for the posts in the user's feed, newest first.
+        """
+        return self._timeline_feed()[0]
+
+    def _timeline_feed(self):
+        celebrities = db.session.scalars(
+            Timeline.celebrities(follower_id=self.id)).all()
+        if not celebrities:
+            query = (
+                sa.select(Post)
+                .join(Timeline, Timeline.post_id == Post.id)
+                .where(Timeline.user_id == self.id)
+                .order_by(Timeline.timestamp.desc(), Timeline.post_id.desc())
+                .options(_feed_author)
+            )
+            return query, (Timeline.timestamp, Timeline.post_id)
+        pushed = sa.select(Timeline.post_id).where(Timeline.user_id == self.id)
+        query = (
+            sa.select(Post)
+            .where(sa.or_(
+                Post.id.in_(pushed),
+                Post.user_id.in_(celebrities),
+            ))
+            .order_by(Post.timestamp.desc(), Post.id.desc())
+            .options(_feed_author)
+        )
+        return query, (Post.timestamp, Post.id)
+
+    @staticmethod
+    def search_page(terms, cursor=None, per_page=20):
+        """
+        Return one page of the users whose username or about me match terms.
+
+        Returns:
+            Page: Users ranked by bm25, best match first.
+        """
+        return _search_page(User, search.user_fts, terms, cursor, per_page)
+
     # @login.user_loader
     # def load_user(id):
     #     return db.session.get(User,int(id))
@@ -158,6 +503,7 @@ class Post(db.Model):
 
     Methods:
         __repr__(): Returns a concise string representation of the post, useful for debugging.
+        search_page(terms, cursor, per_page): Returns one page of posts matching a search.
     """
     id: so.Mapped[int] = so.mapped_column(
         primary_key=True
@@ -170,16 +516,376 @@ class Post(db.Model):
         default=lambda: datetime.now(timezone.utc)
         )
     user_id: so.Mapped[int] = so.mapped_column(
-        sa.ForeignKey(User.id),
-        index=True
+        sa.ForeignKey(User.id)
         )
+    # Every template that shows a post shows its author, so authors are
+    # always loaded in the same query as the posts
     author: so.Mapped[User] = so.relationship(
-        back_populates='posts'
+        back_populates='posts',
+        lazy='joined',
+        innerjoin=True
         )
 
+    __table_args__ = (
+        # Serves both author lookups and the profile listing order
+        sa.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
     def __repr__(self):
         return '<Post {}>'.format(self.body)
-    
+
+    @staticmethod
+    def search_page(terms, cursor=None, per_page=20):
+        """
+        Return one page of the posts whose body matches terms.
+
+        Returns:
+            Page: Posts ranked by bm25, best match first.
+        """
+        return _search_page(Post, search.post_fts, terms, cursor, per_page,
+                            _feed_author)
+
+
+followers = db.metadata.tables['followers']
+
+# The FTS5 search indexes are created and dropped along with the tables
+search.install(db.metadata)
+
+# Feeds only render the author's name and avatar, so load just those columns
+# and the version their cached cells are keyed by
+_feed_author = so.joinedload(Post.author).load_only(
+    User.username, User.email_digest, User.author_version)
+
+
+def _follow_states_memo(user_id):
+    """
+    Return the follow states of user_id remembered during this request.
+    """
+    if not has_request_context():
+        return {}
+    return g.setdefault('follow_states', {}).setdefault(user_id, {})
+
+
+def _forget_follow_states(follower_id, followed_id):
+    memo = g.get('follow_states') if has_request_context() else None
+    if memo:
+        memo.get(follower_id, {}).pop(followed_id, None)
+        memo.get(followed_id, {}).pop(follower_id, None)
+
+
+def _post_key(post):
+    return (post.timestamp, post.id)
+
+
+def _search_page(model, index, terms, cursor, per_page, *options):
+    """
+    Return one keyset-paginated page of full-text search results.
+
+    The pages are keyed on (score, id), where score is the negated bm25
+    rank, so the best matches come first and the ids break ties.
+    """
+    expression = search.match_expression(terms)
+    if expression is None:
+        return Page([])
+    score = -sa.func.bm25(sa.literal_column(index.name))
+    query = (
+        sa.select(model, score.label('score'))
+        .join(index, index.c.rowid == model.id)
+        .where(sa.literal_column(index.name).op('MATCH')(expression))
+        .options(*options)
+    )
+    page = paginate(query, (score, model.id), cursor, per_page,
+                    key_of=lambda row: (row.score, row[0].id), scalars=False)
+    page.items = [row[0] for row in page.items]
+    return page
+
+
+class Timeline(db.Model):
+    """
+    An SQLAlchemy model holding the precomputed home feed of every user.
+
+    A row is written for the author and each of their followers when a post is
+    created (fan-out on write), so reading a feed never has to join the
+    followers table. Authors with more than TIMELINE_FANOUT_LIMIT followers are
+    skipped and their posts are pulled at read time by User.timeline_posts().
+
+    Attributes:
+        user_id (int): The user whose feed the entry belongs to.
+        post_id (int): The post shown in the feed.
+        timestamp (datetime): Copy of the post timestamp, used for ordering.
+
+    Methods:
+        fan_out(post): Push a new post into its author's and followers' feeds.
+        backfill(follower, followed): Copy a followed user's recent posts into a feed.
+        demote(followed): Push a former celebrity's recent posts to their followers.
+        prune(follower, followed): Remove an unfollowed user's posts from a feed.
+        celebrities(): Query for authors whose posts are pulled, not pushed.
+        rebuild(): Recompute every feed from the post and followers tables.
+    """
+    user_id: so.Mapped[int] = so.mapped_column(
+        sa.ForeignKey(User.id),
+        primary_key=True
+        )
+    post_id: so.Mapped[int] = so.mapped_column(
+        sa.ForeignKey(Post.id),
+        primary_key=True
+        )
+    timestamp: so.Mapped[datetime] = so.mapped_column()
+
+    __table_args__ = (
+        sa.Index('ix_timeline_user_timestamp', 'user_id', 'timestamp',
+                 'post_id'),
+    )
+
+    def __repr__(self):
+        return '<Timeline {} {}>'.format(self.user_id, self.post_id)
+
+    @staticmethod
+    def celebrities(follower_id=None):
+        """
+        Return a query for the ids of authors that are too big to fan out.
+
+        Args:
+            follower_id (int, optional): Only return authors followed by this user.
+        """
+        query = sa.select(User.id).where(
+            User.followers_count > current_app.config['TIMELINE_FANOUT_LIMIT'])
+        if follower_id is not None:
+            query = query.join(
+                followers, followers.c.followed_id == User.id
+            ).where(followers.c.follower_id == follower_id)
+        return query
+
+    @staticmethod
+    def is_celebrity(user_id):
+        fans = sa.select(User.followers_count).where(User.id == user_id)
+        return db.session.scalar(fans) > current_app.config['TIMELINE_FANOUT_LIMIT']
+
+    @staticmethod
+    def fan_out(post):
+        db.session.execute(sa.insert(Timeline).values(
+            user_id=post.user_id, post_id=post.id, timestamp=post.timestamp))
+        if Timeline.is_celebrity(post.user_id):
+            return
+        db.session.execute(sa.insert(Timeline).from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            sa.select(
+                followers.c.follower_id,
+                sa.literal(post.id),
+                sa.literal(post.timestamp, sa.DateTime),
+            ).where(followers.c.followed_id == post.user_id)
+        ))
+
+    @staticmethod
+    def _recent(user_id):
+        # The newest posts of an author, as many as a feed backfill copies
+        return (
+            sa.select(Post.id, Post.timestamp)
+            .where(Post.user_id == user_id)
+            .order_by(Post.timestamp.desc(), Post.id.desc())
+            .limit(current_app.config['TIMELINE_BACKFILL'])
+            .subquery()
+        )
+
+    @staticmethod
+    def backfill(follower, followed):
+        if Timeline.is_celebrity(followed.id):
+            return
+        recent = Timeline._recent(followed.id)
+        db.session.execute(sa.insert(Timeline).from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            sa.select(sa.literal(follower.id), recent.c.id, recent.c.timestamp)
+        ))
+
+    @staticmethod
+    def demote(followed):
+        """
+        Push an author's recent posts to their followers when the author
+        stops being a celebrity.
+
+        Their posts were pulled at read time until now and are no longer,
+        so without this they would vanish from the feeds until a rebuild.
+        Only the unfollow that brings the author down to
+        TIMELINE_FANOUT_LIMIT followers does any work. Posts from before
+        the author became a celebrity may still be in a feed and are
+        skipped.
+        """
+        fans = db.session.scalar(
+            sa.select(User.followers_count).where(User.id == followed.id))
+        if fans != current_app.config['TIMELINE_FANOUT_LIMIT']:
+            return
+        recent = Timeline._recent(followed.id)
+        pushed = sa.select(Timeline.post_id).where(
+            Timeline.user_id == followers.c.follower_id,
+            Timeline.post_id == recent.c.id)
+        db.session.execute(sa.insert(Timeline).from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            # Every follower gets every recent post
+            sa.select(followers.c.follower_id, recent.c.id, recent.c.timestamp)
+            .join(recent, sa.true())
+            .where(followers.c.followed_id == followed.id,
+                   ~pushed.exists())
+        ))
+
+    @staticmethod
+    def prune(follower, followed):
+        db.session.execute(sa.delete(Timeline).where(
+            Timeline.user_id == follower.id,
+            Timeline.post_id.in_(
+                sa.select(Post.id).where(Post.user_id == followed.id))
+        ))
+
+    @staticmethod
+    def rebuild():
+        """
+        Recompute every feed from scratch.
+
+        Used to populate the table after TIMELINE_ENABLED is switched on for a
+        database that already has posts and followers.
+        """
+        db.session.execute(sa.delete(Timeline))
+        db.session.execute(sa.insert(Timeline).from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            sa.select(Post.user_id, Post.id, Post.timestamp)
+        ))
+        db.session.execute(sa.insert(Timeline).from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            sa.select(followers.c.follower_id, Post.id, Post.timestamp)
+            .join(followers, followers.c.followed_id == Post.user_id)
+            .where(followers.c.followed_id.not_in(Timeline.celebrities()))
+        ))
+
+
+class Suggestion(db.Model):
+    """
+    An SQLAlchemy model holding the top "who to follow" candidates per user.
+
+    Candidates are friends of friends: the users followed by the users one
+    follows, scored by how many of those follow them. Counting them in SQL
+    means a self-join of the followers table per user, so the lists are
+    computed in a periodic batch over an in-memory copy of the graph and
+    stored here, ranked, to be read back with one indexed query.
+
+    Attributes:
+        user_id (int): The user the suggestion is made to.
+        rank (int): Position in the user's list, 0 being the best.
+        suggested_id (int): The suggested user.
+        score (int): Number of followed users who follow the suggested user.
+
+    Methods:
+        candidates(following, user_id, size): Scores the candidates of a user.
+        rebuild(size, chunk_size, progress): Recomputes every user's list.
+    """
+    user_id: so.Mapped[int] = so.mapped_column(
+        sa.ForeignKey(User.id),
+        primary_key=True
+        )
+    rank: so.Mapped[int] = so.mapped_column(primary_key=True)
+    suggested_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
+    score: so.Mapped[int] = so.mapped_column()
+
+    def __repr__(self):
+        return '<Suggestion {} {}>'.format(self.user_id, self.suggested_id)
+
+    @staticmethod
+    def candidates(following, user_id, size=10):
+        """
+        Return the best friends of friends of a user.
+
+        Args:
+            following (Adjacency): The users each user follows.
+            user_id (int): The user to find candidates for.
+            size (int): The maximum number of candidates returned.
+
+        Returns:
+            list: (score, user_id) pairs, best first; ties go to the lower id.
+        """
+        followed = following.neighbors(user_id)
+        counts = Counter()
+        for other in followed:
+            counts.update(following.neighbors(other))
+        for other in followed:
+            counts.pop(other, None)
+        counts.pop(user_id, None)
+        best = heapq.nsmallest(size, ((-score, candidate)
+                                      for candidate, score in counts.items()))
+        return [(-score, candidate) for score, candidate in best]
+
+    @staticmethod
+    def rebuild(size=10, chunk_size=1000, progress=None):
+        """
+        Recompute the suggestions of every user.
+
+        The followers table is read once, in index order, into compressed
+        sparse rows. Lists are then replaced in id ranges of chunk_size
+        users, each in its own transaction, so readers never see a user
+        without suggestions for longer than one chunk.
+
+        Args:
+            size (int): Suggestions kept per user.
+            chunk_size (int): Users whose lists are replaced per transaction.
+            progress (callable, optional): Called with the last user id of
+                                           each chunk and the rows written.
+
+        Returns:
+            int: The number of suggestions written.
+        """
+        following = read_adjacency(db.session.connection())
+        last_id = db.session.scalar(sa.select(sa.func.max(User.id))) or 0
+        written = 0
+        for first_id in range(1, last_id + 1, chunk_size):
+            chunk_last = min(first_id + chunk_size - 1, last_id)
+            rows = [
+                {'user_id': user_id, 'rank': rank, 'suggested_id': candidate,
+                 'score': score}
+                for user_id in range(first_id, chunk_last + 1)
+                for rank, (score, candidate) in enumerate(
+                    Suggestion.candidates(following, user_id, size))
+            ]
+            db.session.execute(sa.delete(Suggestion).where(
+                Suggestion.user_id.between(first_id, chunk_last)))
+            if rows:
+                db.session.execute(sa.insert(Suggestion), rows)
+            db.session.commit()
+            written += len(rows)
+            if progress is not None:
+                progress(chunk_last, written)
+        return written
+
+
+@sa.event.listens_for(db.session, 'before_flush')
+def count_new_posts(session, flush_context, instances):
+    """
+    Increment User.post_count for the authors of newly added posts.
+    """
+    added = {}
+    with session.no_autoflush:
+        for obj in session.new:
+            if not isinstance(obj, Post):
+                continue
+            author = obj.author
+            if author is None and obj.user_id is not None:
+                author = session.get(User, obj.user_id)
+            if author is not None:
+                added[author] = added.get(author, 0) + 1
+    for author, count in added.items():
+        if sa.inspect(author).persistent:
+            author.post_count = User.post_count + count
+        else:
+            author.post_count = (author.post_count or 0) + count
+
+
+@sa.event.listens_for(db.session, 'after_flush')
+def fan_out_new_posts(session, flush_context):
+    """
+    Push newly flushed posts into the timeline table when it is enabled.
+    """
+    if not current_app.config['TIMELINE_ENABLED']:
+        return
+    for obj in session.new:
+        if isinstance(obj, Post):
+            Timeline.fan_out(obj)
+
 
 
 # Querying the DB for specific values using .select and .where
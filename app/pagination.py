@@ -0,0 +1,163 @@
+import base64
+import json
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from app import db
+
+
+def encode_cursor(values, direction):
+    """
+    Encode the key values of a boundary row into an opaque, URL-safe cursor.
+
+    Args:
+        values (tuple): The key column values of the row, e.g. (timestamp, id).
+        direction (str): 'next' to read rows after the boundary, 'prev' for before.
+
+    Returns:
+        str: The encoded cursor.
+    """
+    payload = [direction[0]] + [
+        v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor, keys):
+    """
+    Decode a cursor produced by encode_cursor().
+
+    Args:
+        cursor (str): The opaque cursor string.
+        keys (tuple): The key columns the cursor was built from.
+
+    Returns:
+        tuple: (direction, values), or (None, None) if the cursor is malformed.
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        if not isinstance(payload, list) or len(payload) != len(keys) + 1:
+            return None, None
+        direction, values = payload[0], payload[1:]
+        if direction not in ('n', 'p'):
+            return None, None
+        values = tuple(_key_value(k, v) for k, v in zip(keys, values))
+    except (ValueError, TypeError):
+        return None, None
+    return ('next' if direction == 'n' else 'prev'), values
+
+
+def _key_value(key, value):
+    """
+    Return a decoded cursor value as the type of its key column.
+
+    Cursors come from the query string, so anything but the scalar that
+    encode_cursor() writes for the column raises ValueError.
+    """
+    if isinstance(key.type, sa.DateTime):
+        if not isinstance(value, str):
+            raise ValueError(f'{key} takes a timestamp')
+        return datetime.fromisoformat(value)
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f'{key} takes a scalar')
+    if isinstance(key.type, sa.Integer) and not isinstance(value, int):
+        raise ValueError(f'{key} takes an integer')
+    return value
+
+
+class Page:
+    """
+    One page of a keyset-paginated query.
+
+    Attributes:
+        items (list): The rows on this page, in display (descending) order.
+        next_cursor (str, optional): Cursor for the following page, if any.
+        prev_cursor (str, optional): Cursor for the preceding page, if any.
+
+    Methods:
+        to_dict(serialize): Returns a JSON-ready representation of the page.
+    """
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def to_dict(self, serialize):
+        return {
+            'items': [serialize(item) for item in self.items],
+            'next': self.next_cursor,
+            'prev': self.prev_cursor,
+        }
+
+
+def paginate(query, keys, cursor=None, per_page=20, key_of=None,
+             scalars=True):
+    """
+    Return one page of a query using keyset (seek) pagination.
+
+    Rows are ordered by the key columns descending. Instead of an OFFSET, the
+    page boundary is expressed as a row-value comparison against the keys of
+    the last row seen, so every page costs the same as the first one as long
+    as the keys are covered by an index.
+
+    Args:
+        query (Select): The query to paginate. Any existing ORDER BY is replaced.
+        keys (tuple): The columns that uniquely order the rows, e.g.
+            (Post.timestamp, Post.id).
+        cursor (str, optional): A cursor from a previous Page; None for page one.
+        per_page (int): The maximum number of rows per page.
+        key_of (callable, optional): Extracts the key values from a row.
+            Defaults to reading the key column names as attributes.
+        scalars (bool): Return the first entity of each row; False returns
+            whole rows, for queries that select more than one column.
+
+    Returns:
+        Page: The requested page.
+    """
+    if key_of is None:
+        def key_of(row):
+            return tuple(getattr(row, k.key) for k in keys)
+
+    direction, values = (None, None)
+    if cursor:
+        direction, values = decode_cursor(cursor, keys)
+
+    query = query.order_by(None)
+    if direction == 'prev':
+        query = query.where(sa.tuple_(*keys) > sa.tuple_(*values))
+        query = query.order_by(*[k.asc() for k in keys])
+    else:
+        if direction == 'next':
+            query = query.where(sa.tuple_(*keys) < sa.tuple_(*values))
+        query = query.order_by(*[k.desc() for k in keys])
+
+    if scalars:
+        rows = db.session.scalars(query.limit(per_page + 1)).all()
+    else:
+        rows = db.session.execute(query.limit(per_page + 1)).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if direction == 'prev':
+        rows.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = direction == 'next', more
+
+    next_cursor = prev_cursor = None
+    if rows and has_next:
+        next_cursor = encode_cursor(key_of(rows[-1]), 'next')
+    if rows and has_prev:
+        prev_cursor = encode_cursor(key_of(rows[0]), 'prev')
+    return Page(rows, next_cursor, prev_cursor)
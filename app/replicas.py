@@ -0,0 +1,103 @@
+import random
+import time
+
+import sqlalchemy as sa
+from flask import has_request_context, request, session
+from flask_sqlalchemy.session import Session
+
+
+class RoutingSession(Session):
+    """
+    A session that sends the reads of a request to a read replica.
+
+    Inside a request, plain SELECTs go to one of the router's replicas,
+    picked once per session. Anything else (a flush, an INSERT, UPDATE or
+    DELETE, SELECT ... FOR UPDATE) goes to the primary and pins the rest of
+    the request to it, so a request always reads its own writes. Outside
+    of requests, e.g. in CLI commands, everything uses the primary.
+
+    Attributes:
+        router (ReplicaRouter): Which replicas exist.
+        use_primary (bool): Whether all statements go to the primary.
+        wrote (bool): Whether anything was sent to the primary as a write.
+    """
+
+    def __init__(self, db, router=None, **kwargs):
+        super().__init__(db, **kwargs)
+        self.router = router
+        self.use_primary = False
+        self.wrote = False
+        self._replica = None
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.router is not None and self.router.replicas \
+                and has_request_context():
+            if _is_plain_read(clause):
+                if not self.use_primary and not _has_bind_key(mapper):
+                    return self._db.engines[self._pick_replica()]
+            else:
+                self.use_primary = self.wrote = True
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+    def _pick_replica(self):
+        if self._replica is None:
+            self._replica = random.choice(self.router.replicas)
+        return self._replica
+
+
+def _is_plain_read(clause):
+    return isinstance(clause, (sa.Select, sa.CompoundSelect)) and \
+        getattr(clause, '_for_update_arg', None) is None
+
+
+def _has_bind_key(mapper):
+    # Models bound to a bind of their own are not replicated here
+    if mapper is None:
+        return False
+    table = sa.inspect(mapper).local_table
+    return table.metadata.info.get('bind_key') is not None
+
+
+class ReplicaRouter:
+    """
+    Chooses between the primary database and its read replicas.
+
+    Replicas are SQLALCHEMY_BINDS entries listed in DATABASE_REPLICAS, and
+    are used by the RoutingSession. Requests other than GET and HEAD use the
+    primary throughout. A request that wrote also marks the user's session,
+    so that their requests in the next REPLICA_STICKY_SECONDS read from the
+    primary too and see their change even while the replicas lag behind.
+
+    Attributes:
+        replicas (list): Bind keys of the read replicas; empty disables routing.
+        sticky_seconds (float): How long a writer keeps reading the primary.
+
+    Methods:
+        init_app(app, db): Reads the configuration and registers the hooks.
+    """
+
+    def __init__(self, app=None, db=None):
+        self.replicas = []
+        self.sticky_seconds = 5.0
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.db = db
+        self.replicas = list(app.config['DATABASE_REPLICAS'])
+        self.sticky_seconds = app.config['REPLICA_STICKY_SECONDS']
+        app.before_request(self._choose_database)
+        app.after_request(self._remember_write)
+
+    def _choose_database(self):
+        if not self.replicas:
+            return
+        if request.method not in ('GET', 'HEAD') or \
+                session.get('_primary_until', 0) > time.time():
+            self.db.session().use_primary = True
+
+    def _remember_write(self, response):
+        if self.replicas and self.db.session.registry.has() and \
+                getattr(self.db.session(), 'wrote', False):
+            session['_primary_until'] = time.time() + self.sticky_seconds
+        return response
@@ -1,50 +1,54 @@
 from urllib.parse import urlsplit
-from datetime import datetime, timezone
 
 from flask import render_template, flash, redirect, url_for
-from flask import request
+from flask import request, jsonify, Response, abort
 from flask_login import current_user, login_required, login_user
 from flask_login import logout_user
 import sqlalchemy as sa
+import sqlalchemy.orm as so
 
-from app import app, db
+from app import app, db, last_seen_tracker, metrics, identity_cache
+from app import username_availability, conditional_get
 from app.forms import RegistrationForm
 from app.forms import LoginForm
 from app.forms import EmptyForm
-from app.models import User
+from app.models import User, Post
 from app.forms import EditProfileForm
 
 # @app.route('/') maps the root URL (http://yourdomain.com/) to the function.
 # @app.route('/index') maps the /index URL (http://yourdomain.com/index) to the same function.
 @app.route('/')
 @app.route('/index')
+@login_required
 def index():
     """
-    Renders the home page with a sample user and list of blog posts.
+    Renders the home page with the current user's feed.
 
-    The function prepares a mock user and a list of example posts,
-    each containing an author and a body. It then renders the
-    'index.html' template, passing the user and posts data to it.
+    The feed is keyset-paginated: the optional 'cursor' query argument is an
+    opaque token taken from the next/prev links of a previous page. A client
+    whose copy is still current gets a 304 before the feed is queried.
 
     Returns:
-        str: Rendered HTML of the index page using the specified template.
-    """
-    user = {'username': 'Isa'}
-    posts = [
-        {
-            'author': {'username': 'Jim', 'email': 'jim@hotmail.com'},
-            'body': 'What is Flask?'
-        },
-        {
-            'author': {'username': 'John', 'email': 'john@hotmail.com'},
-            'body': 'Flask is a micro web framework for Python.'
-        },
-        {
-            'author': {'username': 'Alice'},
-            'body': 'I love using Flask for web development!'
-        }
-    ]
-    return render_template("index.html", title='Home Page', posts=posts)
+        Response: The rendered index page, or 304 Not Modified.
+    """
+    # The newest feed entry changes with every new post, the reader's profile
+    # version with every follow, unfollow and profile edit, and the followed
+    # authors' version when one of them renames, which the post cells show
+    suggestions, shown = _suggestions()
+    validators = (current_user.id, tuple(current_user.feed_head()), shown)
+
+    def render():
+        page = current_user.following_posts_page(
+            request.args.get('cursor'), app.config['POSTS_PER_PAGE'])
+        next_url = url_for('index', cursor=page.next_cursor) \
+            if page.has_next else None
+        prev_url = url_for('index', cursor=page.prev_cursor) \
+            if page.has_prev else None
+        return render_template("index.html", title='Home Page',
+                               posts=page.items, suggestions=suggestions,
+                               next_url=next_url, prev_url=prev_url)
+
+    return conditional_get.respond(validators, render)
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -72,6 +76,8 @@ def login():
         if user is None or not user.check_password(form.password.data):
             flash('Invalid username or password')
             return redirect(url_for('login'))
+        # Persist a hash that check_password upgraded to the current cost
+        db.session.commit()
         # Logging in the user - Register the user as logged in
         login_user(user, remember=form.remember_me.data)
         next_page = request.args.get('next')
@@ -116,7 +122,16 @@ def register():
         user = User(username=form.username.data, email=form.email.data)
         user.set_password(form.password.data)
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except sa.exc.IntegrityError as error:
+            # Someone took the username or email since the form was checked
+            db.session.rollback()
+            if not form.unique_violation(error):
+                raise
+            return render_template('register.html', title='Register',
+                                   form=form)
+        username_availability.claim(user.username)
         flash(f'Congratulations, user {form.username.data} has now been registered!')
         return redirect(url_for('login'))
     return render_template('register.html', title='Register', form=form)
@@ -130,28 +145,176 @@ def user(username):
     Args:
         username (str): The username of the user whose page is being displayed
         form (FlaskForm): An instance of the EmptyForm class for follow/unfollow actions.
-        posts (list): A list of example posts authored by the user.
+        posts (list): One keyset-paginated page of posts authored by the user.
     Return:
-        Renders the user.html template with the user's information, posts, and form.
+        Renders the user.html template with the user's information, posts, and form,
+        or answers 304 Not Modified if the client's copy is still current.
+    """
+    # The viewer's own profile_version, read along with the profile, changes
+    # when they rename themselves, as the navigation bar shows
+    viewer = so.aliased(User)
+    row = db.session.execute(
+        sa.select(User, sa.select(viewer.profile_version)
+                  .where(viewer.id == current_user.id).scalar_subquery())
+        .where(User.username == username)).first()
+    if row is None:
+        abort(404)
+    user, viewer_version = row
+    # profile_version also changes when the viewer follows or unfollows
+    newest = user.newest_post()
+    # Suggestions are only shown on the reader's own profile
+    suggestions, shown = _suggestions() if user.id == current_user.id \
+        else ([], ())
+    validators = (user.id, user.profile_version, user.last_seen,
+                  tuple(newest) if newest else None, current_user.id,
+                  viewer_version, shown)
+
+    def render():
+        form = EmptyForm()
+        page = user.posts_page(request.args.get('cursor'),
+                               app.config['POSTS_PER_PAGE'])
+        next_url = url_for('user', username=user.username,
+                           cursor=page.next_cursor) if page.has_next else None
+        prev_url = url_for('user', username=user.username,
+                           cursor=page.prev_cursor) if page.has_prev else None
+        follow_state = current_user.follow_states([user])[user.id]
+        return render_template('user.html', user=user, posts=page.items,
+                               form=form, follow_state=follow_state,
+                               suggestions=suggestions,
+                               next_url=next_url, prev_url=prev_url)
+
+    return conditional_get.respond(validators, render)
+
+
+@app.route('/search')
+@login_required
+def search():
+    """
+    Full-text search over post bodies, or over usernames and about me texts.
+
+    Query arguments are 'q' (the words to find, all of which must match),
+    'kind' ('posts' or 'users') and the keyset 'cursor' of the result page.
+
+    Returns:
+        str: The rendered search page with the best matches first.
+    """
+    terms = request.args.get('q', '').strip()
+    kind = 'users' if request.args.get('kind') == 'users' else 'posts'
+    follow_states = {}
+    if kind == 'users':
+        page = User.search_page(terms, request.args.get('cursor'),
+                                app.config['USERS_PER_PAGE'])
+        follow_states = current_user.follow_states(page.items)
+    else:
+        page = Post.search_page(terms, request.args.get('cursor'),
+                                app.config['POSTS_PER_PAGE'])
+    next_url = url_for('search', q=terms, kind=kind, cursor=page.next_cursor) \
+        if page.has_next else None
+    prev_url = url_for('search', q=terms, kind=kind, cursor=page.prev_cursor) \
+        if page.has_prev else None
+    return render_template('search.html', title='Search', terms=terms,
+                           kind=kind, results=page.items,
+                           follow_states=follow_states,
+                           next_url=next_url, prev_url=prev_url)
+
+
+@app.route('/user/<username>/followers')
+@login_required
+def followers(username):
+    """
+    Returns a page of the user's followers as JSON.
+
+    Args:
+        username (str): The username of the user whose followers are listed.
+    Return:
+        JSON with the listed users, whether the viewer follows them and is
+        followed by them, and the 'next'/'prev' cursors, which can be passed
+        back in the 'cursor' query argument.
+    """
+    user = db.first_or_404(sa.select(User).where(User.username == username))
+    page = user.followers_page(request.args.get('cursor'),
+                               app.config['USERS_PER_PAGE'])
+    return jsonify(page.to_dict(_user_summaries(page.items)))
+
+
+@app.route('/user/<username>/following')
+@login_required
+def following(username):
+    """
+    Returns a page of the users followed by the user as JSON.
+
+    Args:
+        username (str): The username of the user whose followed users are listed.
+    Return:
+        JSON with the listed users and the 'next'/'prev' cursors.
     """
-    form = EmptyForm()
     user = db.first_or_404(sa.select(User).where(User.username == username))
-    posts = [
-        {'author': user, 'body': 'Test post #1'},
-        {'author': user, 'body': 'Test post #2'}
-    ]
-    return render_template('user.html', user=user, posts=posts, form=form)
+    page = user.following_page(request.args.get('cursor'),
+                               app.config['USERS_PER_PAGE'])
+    return jsonify(page.to_dict(_user_summaries(page.items)))
+
+
+def _user_summaries(users):
+    """
+    Return a serializer of listed users, with how the viewer follows each.
+
+    The follow states of the whole list are fetched at once.
+    """
+    states = current_user.follow_states(users)
+
+    def summary(user):
+        state = states[user.id]
+        return {'username': user.username, 'avatar': user.avatar(36),
+                'following': state.following, 'follows_you': state.followed_by}
+
+    return summary
+
+
+def _suggestions():
+    """
+    Return the reader's suggestions and a validator of how they render.
+
+    Suggestions change when the batch job runs, so the page validators
+    include what is shown rather than a version.
+    """
+    suggestions = current_user.suggestions(app.config['SUGGESTIONS_SHOWN'])
+    return suggestions, tuple(
+        (user.id, user.username, user.email_digest, mutual, follows_you)
+        for user, mutual, follows_you in suggestions)
 
 
 @app.before_request
 def before_request():
     """
-    Gets the last seen time for a user to display on their profile page.
-    Stores this in the last_seen parameter of the User in the db
+    Records the last seen time for a user to display on their profile page.
+
+    The timestamp is handed to the last_seen tracker, which absorbs updates
+    within LAST_SEEN_GRANULARITY and writes the rest to the db in batches.
     """
-    if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+    if current_user.is_authenticated and request.endpoint != 'static':
+        last_seen_tracker.touch(current_user.id)
+
+@app.route('/username_available')
+def username_available():
+    """
+    Tells the registration and profile forms whether a username is free.
+
+    Meant to be called while the user types, so free names are answered
+    from a cache; the form checks again when it is submitted.
+
+    Returns:
+        Response: JSON with the username and an 'available' flag.
+    """
+    username = request.args.get('username', '').strip()
+    if not username or len(username) > 64:
+        available = False
+    elif current_user.is_authenticated and \
+            username == current_user.username:
+        # Keeping one's own name is always allowed
+        available = True
+    else:
+        available = username_availability.is_available(username)
+    return jsonify({'username': username, 'available': available})
 
 @app.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
@@ -168,9 +331,22 @@ def edit_profile():
     """
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
+        if form.username.data != current_user.username:
+            # The post cells show the username; the about me text is not
+            current_user.bump_author_version()
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
-        db.session.commit()
+        current_user.bump_profile_version()
+        try:
+            db.session.commit()
+        except sa.exc.IntegrityError as error:
+            db.session.rollback()
+            if not form.unique_violation(error):
+                raise
+            return render_template('edit_profile.html', title='Edit Profile',
+                                   form=form)
+        identity_cache.invalidate(current_user.id)
+        username_availability.claim(form.username.data)
         flash('Your changes have been saved.')
         return redirect(url_for('edit_profile'))
     elif request.method == 'GET':
@@ -236,10 +412,15 @@ def unfollow(username):
         return redirect(url_for('user', username=username))
     else:
         return redirect(url_for('index'))
-    
-
-
-
 
 
+@app.route('/metrics', endpoint='metrics')
+def metrics_endpoint():
+    """
+    Exposes request latency histograms, cache and db pool statistics.
 
+    Returns:
+        Response: The metrics in the Prometheus text exposition format.
+    """
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
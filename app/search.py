@@ -0,0 +1,136 @@
+import sqlalchemy as sa
+
+# External content FTS5 indexes: the text lives in post and user only, the
+# indexes are kept up to date by triggers on every write to those columns
+SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5("
+    "body, content='post', content_rowid='id', tokenize='porter unicode61')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS user_fts USING fts5("
+    "username, about_me, content='user', content_rowid='id', "
+    "tokenize='porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post BEGIN "
+    "INSERT INTO post_fts (rowid, body) VALUES (new.id, new.body); END",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post BEGIN "
+    "INSERT INTO post_fts (post_fts, rowid, body) "
+    "VALUES ('delete', old.id, old.body); END",
+    "CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF body ON post "
+    "BEGIN "
+    "INSERT INTO post_fts (post_fts, rowid, body) "
+    "VALUES ('delete', old.id, old.body); "
+    "INSERT INTO post_fts (rowid, body) VALUES (new.id, new.body); END",
+    'CREATE TRIGGER IF NOT EXISTS user_fts_insert AFTER INSERT ON "user" BEGIN '
+    "INSERT INTO user_fts (rowid, username, about_me) "
+    "VALUES (new.id, new.username, new.about_me); END",
+    'CREATE TRIGGER IF NOT EXISTS user_fts_delete AFTER DELETE ON "user" BEGIN '
+    "INSERT INTO user_fts (user_fts, rowid, username, about_me) "
+    "VALUES ('delete', old.id, old.username, old.about_me); END",
+    "CREATE TRIGGER IF NOT EXISTS user_fts_update "
+    'AFTER UPDATE OF username, about_me ON "user" BEGIN '
+    "INSERT INTO user_fts (user_fts, rowid, username, about_me) "
+    "VALUES ('delete', old.id, old.username, old.about_me); "
+    "INSERT INTO user_fts (rowid, username, about_me) "
+    "VALUES (new.id, new.username, new.about_me); END",
+]
+
+FTS_TABLES = ('post_fts', 'user_fts')
+
+# The triggers keeping the indexes current, by content table
+TRIGGERS = {
+    'post': ('post_fts_insert', 'post_fts_delete', 'post_fts_update'),
+    'user': ('user_fts_insert', 'user_fts_delete', 'user_fts_update'),
+}
+
+# How each index is filled from its content table
+_SOURCES = {
+    'post_fts': ('post', ('body',)),
+    'user_fts': ('"user"', ('username', 'about_me')),
+}
+
+post_fts = sa.table('post_fts', sa.column('rowid', sa.Integer),
+                    sa.column('body', sa.Text))
+user_fts = sa.table('user_fts', sa.column('rowid', sa.Integer),
+                    sa.column('username', sa.Text),
+                    sa.column('about_me', sa.Text))
+
+
+def install(metadata):
+    """
+    Create the search indexes along with the tables, on SQLite only.
+    """
+    for statement in SCHEMA:
+        sa.event.listen(metadata, 'after_create',
+                        sa.DDL(statement).execute_if(dialect='sqlite'))
+    for table in FTS_TABLES:
+        sa.event.listen(metadata, 'before_drop', sa.DDL(
+            f'DROP TABLE IF EXISTS {table}').execute_if(dialect='sqlite'))
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """
+    Keep the FTS5 tables and their shadow tables out of autogenerate.
+    """
+    return not (type_ == 'table' and reflected and name.startswith(FTS_TABLES))
+
+
+def drop_triggers(session, tables):
+    """
+    Stop indexing writes to the given content tables, e.g. for a bulk load.
+
+    The indexes are stale until restore_triggers() and rebuild() are run.
+    """
+    for table in tables:
+        for trigger in TRIGGERS[table]:
+            session.execute(sa.text(f'DROP TRIGGER IF EXISTS {trigger}'))
+
+
+def restore_triggers(session):
+    """
+    Recreate whatever part of the search schema is missing.
+    """
+    for statement in SCHEMA:
+        session.execute(sa.text(statement))
+
+
+def match_expression(terms):
+    """
+    Turn what a user typed into an FTS5 query matching all of its words.
+
+    Every word is quoted, so FTS5 operators and punctuation in the input
+    are searched for literally instead of raising a syntax error.
+
+    Returns:
+        str: The MATCH expression, or None if there is nothing to search.
+    """
+    words = terms.split()
+    if not words:
+        return None
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in words)
+
+
+def rebuild(session, chunk_size=1000, progress=None):
+    """
+    Rebuild both search indexes from their content tables in id ranges.
+
+    Each chunk is committed on its own, so writers are never blocked for
+    long; posts and users written meanwhile are indexed by the triggers.
+
+    Args:
+        session (Session): The session to run the statements in.
+        chunk_size (int): Number of ids indexed per transaction.
+        progress (callable, optional): Called with (index, last id done).
+    """
+    for table, (source, columns) in _SOURCES.items():
+        session.execute(sa.text(
+            f"INSERT INTO {table} ({table}) VALUES ('delete-all')"))
+        session.commit()
+        last_id = session.scalar(sa.text(f'SELECT MAX(id) FROM {source}')) or 0
+        fill = sa.text(
+            f"INSERT INTO {table} (rowid, {', '.join(columns)}) "
+            f"SELECT id, {', '.join(columns)} FROM {source} "
+            f"WHERE id BETWEEN :first AND :last")
+        for first_id in range(1, last_id + 1, chunk_size):
+            session.execute(fill, {'first': first_id,
+                                   'last': first_id + chunk_size - 1})
+            session.commit()
+            if progress is not None:
+                progress(table, min(first_id + chunk_size - 1, last_id))
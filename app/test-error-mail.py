@@ -1,14 +1,32 @@
-import smtplib
-from email.message import EmailMessage
+import logging
+from logging.handlers import QueueListener
 
-msg = EmailMessage()
-msg.set_content("This is a test email.")
-msg['Subject'] = 'Test'
-msg['From'] = 'test@localhost'
-msg['To'] = 'admin@example.com'
+from log_handlers import BoundedQueueHandler, DigestMailHandler
 
-with smtplib.SMTP('localhost', 8025) as server:
-    server.send_message(msg)
+# Sends a burst of identical errors through the queued digest mailer used in
+# production. The local SMTP server on port 8025 should receive one digest
+# email reporting 50 occurrences, not 50 separate emails.
+mail_handler = DigestMailHandler(
+    mailhost=('localhost', 8025), fromaddr='test@localhost',
+    toaddrs=['admin@example.com'], subject='Test', window=2)
+mail_queue = BoundedQueueHandler(1000)
+mail_queue.setLevel(logging.ERROR)
+mail_handler.queue_handler = mail_queue
+listener = QueueListener(mail_queue.queue, mail_handler)
+listener.start()
+
+logger = logging.getLogger('test-error-mail')
+logger.addHandler(mail_queue)
+for i in range(50):
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        logger.exception('Test error %d', i)
+
+listener.stop()
+mail_handler.close()
+print(f'Digests sent: {mail_handler.sent}, failed: {mail_handler.failed}, '
+      f'dropped records: {mail_queue.dropped}')
 
 # Have to open port 8025 or allow python to access through the firewall 
-# ERROR: ConnectionRefusedError: [WinError 10061] No connection could be made because the target machine actively refused it
\ No newline at end of file
+# ERROR: ConnectionRefusedError: [WinError 10061] No connection could be made because the target machine actively refused it
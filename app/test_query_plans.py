@@ -0,0 +1,145 @@
+import os
+# Only effective when run as a script; under pytest, conftest.py pins it
+os.environ['DATABASE_URL'] = 'sqlite://'
+
+import re
+import unittest
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+from app import app, db
+from app.models import User, Post, Timeline, Suggestion
+
+# Full table or full index scans; SCAN CONSTANT ROW is a literal SELECT
+FULL_SCAN = re.compile(r'^SCAN (?!CONSTANT ROW)')
+
+
+class QueryPlanCase(unittest.TestCase):
+    """
+    Query plan regression tests for the hot read paths.
+
+    Every statement issued by the methods below is run through SQLite's
+    EXPLAIN QUERY PLAN, and the test fails if any step falls back to a full
+    scan of a table or index. Losing an index, or rewriting a query so that
+    SQLite can no longer use one, then shows up here before it shows up in
+    production latency.
+
+    Methods:
+        setUp(): Creates an in-memory database with a few users and posts.
+        tearDown(): Drops the database.
+        assertIndexed(call): Asserts that no statement issued by call scans.
+        test_following_posts(): Checks the join-based home feed.
+        test_timeline_posts(): Checks the timeline-based home feed.
+        test_is_following(): Checks the follow membership and state lookups.
+        test_follow_listings(): Checks the follower and following listings.
+        test_counters(): Checks the counter drift and celebrity queries.
+        test_profile_posts(): Checks the profile post listing.
+        test_suggestions(): Checks the precomputed who to follow list.
+    """
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        # create_all() and drop_all() must never touch a real database
+        self.assertIn(db.engine.url.database, (None, '', ':memory:'),
+                      f'tests must run in memory, not on {db.engine.url}')
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.u1, self.u2])
+        db.session.add_all([Post(body='one', author=self.u1),
+                            Post(body='two', author=self.u1),
+                            Post(body='three', author=self.u2)])
+        db.session.commit()
+        self.u1.follow(self.u2)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    @contextmanager
+    def captured(self):
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, many):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+
+        sa.event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            yield statements
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', capture)
+
+    def plan(self, statement, parameters):
+        with db.engine.connect() as connection:
+            rows = connection.exec_driver_sql(
+                'EXPLAIN QUERY PLAN ' + statement, parameters)
+            return [row[3] for row in rows]
+
+    def assertIndexed(self, call):
+        db.session.expire_all()
+        with self.captured() as statements:
+            call()
+        self.assertTrue(statements, 'no SELECT statements were issued')
+        for statement, parameters in statements:
+            plan = self.plan(statement, parameters)
+            scans = [step for step in plan if FULL_SCAN.match(step)]
+            self.assertEqual(scans, [], '\n'.join([statement] + plan))
+
+    def test_following_posts(self):
+        self.assertIndexed(
+            lambda: db.session.scalars(self.u1.following_posts()).all())
+        self.assertIndexed(lambda: self.u1.feed_head())
+        page = self.u1.following_posts_page(per_page=1)
+        self.assertIndexed(
+            lambda: self.u1.following_posts_page(page.next_cursor, 1))
+
+    def test_timeline_posts(self):
+        app.config['TIMELINE_ENABLED'] = True
+        self.addCleanup(app.config.__setitem__, 'TIMELINE_ENABLED', False)
+        Timeline.rebuild()
+        db.session.commit()
+        page = self.u1.following_posts_page(per_page=1)
+        self.assertIndexed(
+            lambda: self.u1.following_posts_page(page.next_cursor, 1))
+
+        # With a followed celebrity the feed mixes pushed and pulled posts
+        app.config['TIMELINE_FANOUT_LIMIT'] = 0
+        self.addCleanup(app.config.__setitem__, 'TIMELINE_FANOUT_LIMIT', 10000)
+        self.assertIndexed(
+            lambda: db.session.scalars(self.u1.following_posts()).all())
+
+    def test_is_following(self):
+        self.assertIndexed(lambda: self.u1.is_following(self.u2))
+        self.assertIndexed(
+            lambda: self.u2.follow_states([self.u1.id, self.u2.id, 99]))
+
+    def test_follow_listings(self):
+        self.assertIndexed(lambda: self.u2.followers_page())
+        self.assertIndexed(lambda: self.u1.following_page())
+
+    def test_counters(self):
+        self.assertIndexed(
+            lambda: db.session.execute(User.counter_drift(1, 1000)).all())
+        self.assertIndexed(lambda: Timeline.is_celebrity(self.u2.id))
+        self.assertIndexed(lambda: db.session.scalars(
+            Timeline.celebrities(follower_id=self.u1.id)).all())
+
+    def test_profile_posts(self):
+        page = self.u1.posts_page(per_page=1)
+        self.assertTrue(page.has_next)
+        self.assertIndexed(lambda: self.u1.posts_page(page.next_cursor, 1))
+
+    def test_suggestions(self):
+        Suggestion.rebuild()
+        db.session.add(Suggestion(user_id=self.u2.id, rank=0,
+                                  suggested_id=self.u1.id, score=1))
+        db.session.commit()
+        self.assertIndexed(lambda: self.u2.suggestions())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
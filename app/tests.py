@@ -1,10 +1,76 @@
 import os
+# Only effective when run as a script; under pytest, conftest.py pins it
 os.environ['DATABASE_URL'] = 'sqlite://'
 
+import base64
+import glob
+import io
+import json
+import logging
+import multiprocessing
+import socketserver
+import sqlite3
+import tempfile
+import threading
+from logging.handlers import QueueListener
+
 from datetime import datetime, timezone, timedelta
 import unittest
-from app import app, db
-from app.models import User, Post
+from hashlib import md5
+from contextlib import contextmanager
+import sqlalchemy as sa
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from config import Config
+from app import app, db, last_seen_tracker, instrumentation, identity_cache
+from app import password_hasher, username_availability, replica_router
+from app import fragment_cache, conditional_get, social_graph
+from unittest import mock
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from app import models
+from app import pagination
+from app.models import User, Post, Timeline, Suggestion
+from app import bulk
+from app.database import DatabaseProfile
+from app.hashing import HashingBusy
+from app.fragments import LRUBackend, SQLiteBackend
+from app.lru import LRUCache
+from app.graph import SocialGraph
+from app.metrics import MetricsStore
+from app.log_handlers import BoundedQueueHandler, DigestMailHandler
+from app.log_handlers import BatchingFileHandler, JsonFormatter
+
+def setUpModule():
+    # The test cases create and drop all tables; never do that to a real
+    # database, e.g. when the app was imported before DATABASE_URL was set
+    with app.app_context():
+        url = db.engine.url
+    if url.database not in (None, '', ':memory:'):
+        raise RuntimeError(f'tests must run in memory, not on {url}')
+
+
+@contextmanager
+def count_queries():
+    """
+    Count the SQL statements emitted inside the with block.
+
+    Yields:
+        list: The statements, filled in as they are executed.
+    """
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, many):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    sa.event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        yield statements
+    finally:
+        sa.event.remove(engine, 'before_cursor_execute', capture)
+
 
 class UserModelCase(unittest.TestCase):
     """
@@ -24,9 +90,24 @@ class UserModelCase(unittest.TestCase):
         setUp(): Sets up the test environment before each test method.
         tearDown(): Cleans up the test environment after each test method.
         test_password_hashing(): Tests the password hashing and verification methods.
+        test_password_rehash(): Tests that a login upgrades an outdated hash.
+        test_password_hashing_busy(): Tests the 503 when all hashing slots are taken.
+        test_password_hashing_pool_failure(): Tests timeouts and a broken hashing pool.
         test_avatar(): Tests the avatar URL generation method.
+        test_email_digest(): Tests that the stored digest follows email changes.
         test_follow(): Tests the follow and unfollow methods, as well as follower/following counts.
         test_follow_posts(): Tests the retrieval of posts from followed users.
+        test_timeline_posts(): Tests the fan-out-on-write timeline feed.
+        test_timeline_celebrity_pull(): Tests the pull fallback for large authors.
+        test_timeline_backfill_limit(): Tests that a follow copies only the newest posts.
+        test_keyset_pagination(): Tests cursor paging through posts and followers.
+        test_last_seen_tracker(): Tests buffering and batched writes of last_seen.
+        test_counters(): Tests the denormalized counters and the drift repair.
+        test_identifiers_taken(): Tests the combined username and email lookup.
+        test_search(): Tests the full-text indexes, ranking and paging.
+        test_bulk_import(): Tests the batched loaders and deferred indexes.
+        test_bulk_export(): Tests the streamed export, redaction and --since.
+        test_suggestions(): Tests the friends-of-friends batch and its reads.
     """
     
     def setUp(self):
@@ -45,11 +126,91 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_rehash(self):
+        method = password_hasher.method
+        self.addCleanup(setattr, password_hasher, 'method', method)
+        password_hasher.method = 'pbkdf2:sha256:1000'
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        old_hash = u.password_hash
+        self.assertTrue(old_hash.startswith('pbkdf2:sha256:1000$'))
+
+        password_hasher.method = 'pbkdf2:sha256:2000'
+        self.assertFalse(u.check_password('dog'))
+        self.assertEqual(u.password_hash, old_hash)
+        self.assertTrue(u.check_password('cat'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(u.check_password('cat'))
+
+    def test_password_hashing_busy(self):
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        slots = password_hasher.concurrency
+        for _ in range(slots):
+            password_hasher._slots.acquire()
+        try:
+            app.config['WTF_CSRF_ENABLED'] = False
+            self.addCleanup(app.config.__setitem__, 'WTF_CSRF_ENABLED', True)
+            response = app.test_client().post('/login', data={
+                'username': 'susan', 'password': 'cat'})
+        finally:
+            for _ in range(slots):
+                password_hasher._slots.release()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+    def test_password_hashing_pool_failure(self):
+        self.addCleanup(setattr, password_hasher, 'workers',
+                        password_hasher.workers)
+        self.addCleanup(setattr, password_hasher, 'timeout',
+                        password_hasher.timeout)
+        password_hasher.workers = 1
+        password_hasher.timeout = 0.01
+        pool = mock.Mock()
+        self.addCleanup(setattr, password_hasher, '_executor', None)
+        password_hasher._executor = pool
+        password_hasher._executor_pid = os.getpid()
+
+        # A hash that outlives the timeout is shed like a busy worker
+        pool.submit.return_value = Future()
+        with self.assertRaises(HashingBusy):
+            password_hasher.hash('cat')
+        self.assertIs(password_hasher._executor, pool)
+
+        # A pool that lost a process is dropped and recreated on next use
+        broken = Future()
+        broken.set_exception(BrokenProcessPool())
+        pool.submit.return_value = broken
+        with self.assertRaises(HashingBusy):
+            password_hasher.hash('cat')
+        pool.shutdown.assert_called_once()
+        self.assertIsNone(password_hasher._executor)
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
+
+    def test_email_digest(self):
+        u = User(username='john', email='John@Example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.assertEqual(u.email_digest, 'd4c74594d841139328695756648b6bd6')
+        u.email = 'susan@example.com'
+        db.session.commit()
+        db.session.expire_all()
+        self.assertEqual(u.email_digest, md5(b'susan@example.com').hexdigest())
+
+        # Feeds load only the columns the post template renders
+        db.session.add(Post(body='hello', author=u))
+        db.session.commit()
+        query = str(u.following_posts())
+        self.assertIn('user_1.email_digest', query)
+        self.assertNotIn('user_1.email,', query)
+        self.assertNotIn('user_1.password_hash', query)
         
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
@@ -65,8 +226,8 @@ class UserModelCase(unittest.TestCase):
         u1.follow(u2)
         db.session.commit()
         self.assertTrue(u1.is_following(u2))
-        self.assertEqual(u1.following_count(), 1)
-        self.assertEqual(u2.followers_count(), 1)
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u2.followers_count, 1)
         u1_following = db.session.execute(u1.following.select()).scalars().all()
         u2_followers = db.session.execute(u2.followers.select()).scalars().all()
         self.assertEqual(u1_following[0].username, 'susan')
@@ -75,8 +236,8 @@ class UserModelCase(unittest.TestCase):
         u1.unfollow(u2)
         db.session.commit()
         self.assertFalse(u1.is_following(u2))
-        self.assertEqual(u1.following_count(), 0)
-        self.assertEqual(u2.followers_count(), 0)
+        self.assertEqual(u1.following_count, 0)
+        self.assertEqual(u2.followers_count, 0)
 
     def test_follow_posts(self):
         # Create four users
@@ -116,6 +277,1288 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline_posts(self):
+        app.config['TIMELINE_ENABLED'] = True
+        self.addCleanup(app.config.__setitem__, 'TIMELINE_ENABLED', False)
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        # Posts written before the follow are backfilled
+        now = datetime.now(timezone.utc)
+        p1 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=1))
+        db.session.add(p1)
+        db.session.commit()
+        u1.follow(u2)
+        u1.follow(u3)
+        db.session.commit()
+
+        # Posts written after the follow are fanned out
+        p2 = Post(body="post from mary", author=u3,
+                  timestamp=now + timedelta(seconds=2))
+        p3 = Post(body="post from john", author=u1,
+                  timestamp=now + timedelta(seconds=3))
+        db.session.add_all([p2, p3])
+        db.session.commit()
+
+        f1 = db.session.execute(u1.following_posts()).scalars().all()
+        self.assertEqual(f1, [p3, p2, p1])
+        f2 = db.session.execute(u2.following_posts()).scalars().all()
+        self.assertEqual(f2, [p1])
+
+        u1.unfollow(u2)
+        db.session.commit()
+        f1 = db.session.execute(u1.following_posts()).scalars().all()
+        self.assertEqual(f1, [p3, p2])
+
+        Timeline.rebuild()
+        db.session.commit()
+        f1 = db.session.execute(u1.following_posts()).scalars().all()
+        self.assertEqual(f1, [p3, p2])
+
+    def test_timeline_celebrity_pull(self):
+        app.config['TIMELINE_ENABLED'] = True
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        self.addCleanup(app.config.__setitem__, 'TIMELINE_ENABLED', False)
+        self.addCleanup(app.config.__setitem__, 'TIMELINE_FANOUT_LIMIT', 10000)
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        star = User(username='star', email='star@example.com')
+        db.session.add_all([u1, u2, star])
+        db.session.commit()
+        u1.follow(star)
+        u2.follow(star)
+        db.session.commit()
+
+        p1 = Post(body="post from star", author=star)
+        db.session.add(p1)
+        db.session.commit()
+
+        # Only the author's own timeline entry is written
+        entries = db.session.scalars(sa.select(Timeline.user_id)).all()
+        self.assertEqual(entries, [star.id])
+        f1 = db.session.execute(u1.following_posts()).scalars().all()
+        f2 = db.session.execute(u2.following_posts()).scalars().all()
+        self.assertEqual(f1, [p1])
+        self.assertEqual(f2, [p1])
+
+        # Dropping back to the limit pushes the posts to the followers left
+        u2.unfollow(star)
+        db.session.commit()
+        f1 = db.session.execute(u1.following_posts()).scalars().all()
+        self.assertEqual(f1, [p1])
+
+    def test_timeline_backfill_limit(self):
+        app.config['TIMELINE_ENABLED'] = True
+        app.config['TIMELINE_BACKFILL'] = 2
+        self.addCleanup(app.config.__setitem__, 'TIMELINE_ENABLED', False)
+        self.addCleanup(app.config.__setitem__, 'TIMELINE_BACKFILL', 100)
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'post {i}', author=u2,
+                      timestamp=now + timedelta(seconds=i))
+                 for i in range(4)]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        # Only the newest posts are copied into the feed
+        u1.follow(u2)
+        db.session.commit()
+        f1 = db.session.execute(u1.following_posts()).scalars().all()
+        self.assertEqual(f1, [posts[3], posts[2]])
+
+    def test_keyset_pagination(self):
+        u1 = User(username='john', email='john@example.com')
+        db.session.add(u1)
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'post {i}', author=u1,
+                      timestamp=now + timedelta(seconds=i // 2))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        fans = [User(username=f'fan{i}', email=f'fan{i}@example.com')
+                for i in range(3)]
+        db.session.add_all(fans)
+        db.session.commit()
+        for fan in fans:
+            fan.follow(u1)
+        db.session.commit()
+        newest_first = sorted(posts, key=lambda p: (p.timestamp, p.id),
+                              reverse=True)
+
+        # Walk forwards through the feed and the profile listing
+        for fetch in (u1.following_posts_page, u1.posts_page):
+            page1 = fetch(per_page=2)
+            self.assertEqual(page1.items, newest_first[:2])
+            self.assertFalse(page1.has_prev)
+            page2 = fetch(page1.next_cursor, per_page=2)
+            self.assertEqual(page2.items, newest_first[2:4])
+            page3 = fetch(page2.next_cursor, per_page=2)
+            self.assertEqual(page3.items, newest_first[4:])
+            self.assertFalse(page3.has_next)
+
+            # ... and backwards again
+            back = fetch(page3.prev_cursor, per_page=2)
+            self.assertEqual(back.items, newest_first[2:4])
+            back = fetch(back.prev_cursor, per_page=2)
+            self.assertEqual(back.items, newest_first[:2])
+            self.assertFalse(back.has_prev)
+
+        page = u1.followers_page(per_page=2)
+        self.assertEqual(page.items, [fans[2], fans[1]])
+        page = u1.followers_page(page.next_cursor, per_page=2)
+        self.assertEqual(page.items, [fans[0]])
+        self.assertEqual(fans[0].following_page().items, [u1])
+
+        # A malformed cursor falls back to the first page
+        self.assertEqual(u1.posts_page('garbage', per_page=2).items,
+                         newest_first[:2])
+        keys = (Post.timestamp, Post.id)
+        for payload in ({'n': 1}, ['n', [1], {}], ['n', '2020-01-01', '1'],
+                        ['n', 1, 2], ['n', '2020-01-01'], 'n', None,
+                        ['n', '2020-01-01', True]):
+            cursor = base64.urlsafe_b64encode(
+                json.dumps(payload).encode()).decode()
+            self.assertEqual(pagination.decode_cursor(cursor, keys),
+                             (None, None), payload)
+            self.assertEqual(u1.posts_page(cursor, per_page=2).items,
+                             newest_first[:2])
+        self.assertEqual(u1.followers_page(
+            base64.urlsafe_b64encode(b'["n",{"a":1}]').decode()).items,
+            [fans[2], fans[1], fans[0]])
+
+    def test_last_seen_tracker(self):
+        tracker = last_seen_tracker
+        tracker.flush()
+        before = tracker.stats()
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        now = datetime(2025, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+        # The first touch is queued, touches within the granularity absorbed
+        self.assertTrue(tracker.touch(u1.id, None, now))
+        self.assertFalse(tracker.touch(u1.id, None, now + timedelta(seconds=30)))
+        self.assertTrue(tracker.touch(u2.id, now - timedelta(hours=1), now))
+        self.assertFalse(tracker.touch(u2.id, now, now + timedelta(seconds=1)))
+        self.assertEqual(tracker.stats()['pending'], 2)
+
+        self.assertEqual(tracker.flush(), 2)
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, now.replace(tzinfo=None))
+        self.assertEqual(u2.last_seen, now.replace(tzinfo=None))
+
+        # Written values keep absorbing until the granularity has passed
+        self.assertFalse(tracker.touch(u1.id, None, now + timedelta(seconds=59)))
+        self.assertTrue(tracker.touch(u1.id, None, now + timedelta(seconds=61)))
+        stats = tracker.stats()
+        self.assertEqual(stats['touches'] - before['touches'], 6)
+        self.assertEqual(stats['absorbed'] - before['absorbed'], 3)
+        self.assertEqual(stats['rows_written'] - before['rows_written'], 2)
+        tracker.flush()
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.add_all([Post(body='one', author=u1),
+                            Post(body='two', author=u1)])
+        db.session.commit()
+        self.assertEqual(u1.post_count, 2)
+        db.session.add(Post(body='three', user_id=u1.id))
+        db.session.add(Post(body='four', author=u2))
+        db.session.commit()
+        self.assertEqual(u1.post_count, 3)
+        self.assertEqual(u2.post_count, 1)
+
+        u1.follow(u2)
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual((u1.followers_count, u1.following_count), (1, 1))
+        self.assertEqual(db.session.scalar(User.counter_drift(1, 2)), None)
+
+        # Corrupt a counter and let the CLI repair it
+        db.session.execute(sa.update(User).where(User.id == u2.id)
+                           .values(followers_count=7, post_count=0))
+        db.session.commit()
+        drift = db.session.execute(User.counter_drift(1, 2)).all()
+        self.assertEqual(drift, [(u2.id, 1, 1, 1)])
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['counters', 'verify', '--repair'])
+        self.assertIn('Repaired 1 users.', result.output)
+        db.session.expire_all()
+        self.assertEqual((u2.followers_count, u2.post_count), (1, 1))
+
+    def test_identifiers_taken(self):
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        self.assertEqual(User.identifiers_taken('john', 'john@example.com'),
+                         (True, True))
+        self.assertEqual(User.identifiers_taken('susan', 'john@example.com'),
+                         (False, True))
+        self.assertEqual(User.identifiers_taken('john'), (True, False))
+        self.assertEqual(User.identifiers_taken(email='susan@example.com'),
+                         (False, False))
+
+    def test_search(self):
+        u1 = User(username='john', email='john@example.com',
+                  about_me='I write about gardening')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.add_all([
+            Post(body='Tomatoes in the garden', author=u1),
+            Post(body='Gardening gardening gardening', author=u2),
+            Post(body='Nothing to see here', author=u2),
+        ])
+        db.session.commit()
+        results = Post.search_page('garden').items
+        # Stemmed, and the post that is all about it ranks first
+        self.assertEqual([p.body for p in results],
+                         ['Gardening gardening gardening',
+                          'Tomatoes in the garden'])
+        self.assertEqual(Post.search_page('"garden OR (').items, [])
+        self.assertEqual(Post.search_page('  ').items, [])
+
+        # Users are indexed by username and about me, and kept up to date
+        self.assertEqual(User.search_page('gardening').items, [u1])
+        self.assertEqual(User.search_page('susan').items, [u2])
+        u1.about_me = 'I write about cooking'
+        u2.username = 'gardener'
+        db.session.commit()
+        self.assertEqual(User.search_page('cooking').items, [u1])
+        self.assertEqual(User.search_page('susan').items, [])
+        db.session.delete(results[1])
+        db.session.commit()
+        self.assertEqual(len(Post.search_page('garden').items), 1)
+
+        # Keyset pagination over the ranked results
+        db.session.add_all([Post(body=f'garden {i}', author=u2)
+                            for i in range(5)])
+        db.session.commit()
+        first = Post.search_page('garden', per_page=4)
+        second = Post.search_page('garden', first.next_cursor, per_page=4)
+        self.assertEqual(len(first.items) + len(second.items), 6)
+        self.assertFalse(second.has_next)
+        self.assertFalse(set(first.items) & set(second.items))
+        back = Post.search_page('garden', second.prev_cursor, per_page=4)
+        self.assertEqual(back.items, first.items)
+
+        # The CLI rebuilds the indexes from scratch
+        db.session.execute(sa.text(
+            "INSERT INTO post_fts (post_fts) VALUES ('delete-all')"))
+        db.session.commit()
+        self.assertEqual(Post.search_page('garden').items, [])
+        result = app.test_cli_runner().invoke(
+            args=['search', 'rebuild', '--chunk-size', '2'])
+        self.assertIn('Search indexes rebuilt.', result.output)
+        self.assertEqual(len(Post.search_page('garden').items), 6)
+
+    def test_bulk_import(self):
+        users = io.StringIO(
+            '{"username": "john", "email": "john@example.com", '
+            '"password": "cat"}\n\n'
+            '{"username": "susan", "email": "Susan@example.com", '
+            '"about_me": "gardener"}\n')
+        posts = io.StringIO('author,body,timestamp\n'
+                            'john,Tomatoes in the garden,2024-01-01T10:00:00\n'
+                            'susan,Potatoes,2024-01-02T10:00:00\n'
+                            'susan,Onions,\n')
+        follows = io.StringIO('{"follower": "john", "followed": "susan"}\n')
+        with bulk.deferred_indexes(db.session, ['users', 'posts', 'follows']):
+            self.assertEqual(bulk.load_users(
+                db.session, bulk.read_records(users), batch_size=1), 2)
+            self.assertEqual(bulk.load_posts(
+                db.session, bulk.read_records(posts, 'csv'), batch_size=2), 3)
+            self.assertEqual(bulk.load_follows(
+                db.session, bulk.read_records(follows)), 1)
+        john = db.session.scalar(sa.select(User).filter_by(username='john'))
+        susan = db.session.scalar(sa.select(User).filter_by(username='susan'))
+        self.assertTrue(john.check_password('cat'))
+        self.assertIsNone(susan.password_hash)
+        self.assertEqual(susan.email_digest,
+                         md5(b'susan@example.com').hexdigest())
+        self.assertEqual((john.following_count, susan.followers_count,
+                          susan.post_count), (1, 1, 2))
+        self.assertEqual(susan.profile_version, 1)
+        self.assertEqual(db.session.scalar(User.counter_drift(1, 2)), None)
+        self.assertEqual(len(john.following_posts_page().items), 3)
+        # The indexes and search triggers are back, and the search rebuilt
+        self.assertEqual(User.search_page('gardener').items, [susan])
+        self.assertEqual(Post.search_page('garden').items[0].author, john)
+        db.session.add(Post(body='Leeks', author=john))
+        db.session.commit()
+        self.assertEqual(len(Post.search_page('leeks').items), 1)
+
+        with self.assertRaisesRegex(bulk.ImportFailed,
+                                    'posts record 1: unknown user "mary"'):
+            bulk.load_posts(db.session, [{'author': 'mary', 'body': 'hi'}])
+        with self.assertRaisesRegex(bulk.ImportFailed,
+                                    'follows records 1-1: UNIQUE'):
+            bulk.load_follows(db.session, [{'follower': 'john',
+                                            'followed': 'susan'}])
+        self.assertEqual(db.session.scalar(
+            sa.select(User.following_count).filter_by(username='john')), 1)
+
+    def test_bulk_export(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u1.set_password('cat')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        now = datetime.now(timezone.utc)
+        db.session.add_all([
+            Post(body='first', author=u1, timestamp=now - timedelta(days=1)),
+            Post(body='second', author=u2, timestamp=now),
+        ])
+        db.session.commit()
+
+        def export(kind, format='ndjson', **kwargs):
+            query = bulk.export_query(kind, **kwargs)
+            stream = io.StringIO()
+            bulk.write_records(
+                stream, bulk.stream_records(db.session, query, batch_size=1),
+                [column.key for column in query.selected_columns], format)
+            stream.seek(0)
+            return list(bulk.read_records(stream, format))
+
+        # Password hashes only when asked for, other columns on request
+        users = export('users')
+        self.assertEqual([u['username'] for u in users], ['john', 'susan'])
+        self.assertNotIn('password_hash', users[0])
+        self.assertEqual(export('users', password_hashes=True)[0]
+                         ['password_hash'], u1.password_hash)
+        self.assertEqual(set(export('users', redact=['email'])[0]),
+                         {'id', 'username', 'about_me', 'last_seen'})
+        with self.assertRaises(ValueError):
+            bulk.export_query('users', redact=['nope'])
+
+        # Incremental exports by id or by timestamp
+        posts = export('posts', 'csv')
+        self.assertEqual([(p['author'], p['body']) for p in posts],
+                         [('john', 'first'), ('susan', 'second')])
+        self.assertEqual(export('posts', since=int(posts[0]['id'])),
+                         export('posts', since=now - timedelta(hours=1)))
+        self.assertEqual(len(export('posts', since=now - timedelta(hours=1))),
+                         1)
+        self.assertEqual(export('follows'),
+                         [{'follower': 'john', 'followed': 'susan'}])
+        with self.assertRaises(ValueError):
+            bulk.export_query('follows', since=1)
+
+        # What is exported loads back
+        db.session.execute(sa.delete(Post))
+        db.session.commit()
+        self.assertEqual(bulk.load_posts(db.session, posts), 2)
+        self.assertEqual(export('posts', 'csv')[1]['body'], 'second')
+
+    def test_suggestions(self):
+        a, b, c, d, e, f = users = [
+            User(username=name, email=f'{name}@example.com')
+            for name in ('ann', 'bob', 'cat', 'dan', 'eve', 'fay')]
+        db.session.add_all(users)
+        db.session.commit()
+        for follower, followed in [(a, b), (a, c), (b, d), (b, e), (c, d),
+                                   (c, a), (c, b), (d, a), (f, a)]:
+            follower.follow(followed)
+        db.session.commit()
+        self.assertEqual(Suggestion.rebuild(size=2, chunk_size=4), 8)
+        # dan is followed by both of ann's followees; bob is left out, as
+        # ann follows him already, and so is ann herself
+        self.assertEqual([(user.username, mutual, follows_you) for
+                          user, mutual, follows_you in a.suggestions()],
+                         [('dan', 2, True), ('eve', 1, False)])
+        self.assertEqual(a.suggestions(limit=1)[0][0], d)
+        self.assertEqual([row[0] for row in f.suggestions()], [b, c])
+        self.assertEqual(e.suggestions(), [])
+
+        # Following a suggestion hides it until the next rebuild
+        a.follow(d)
+        db.session.commit()
+        self.assertEqual([row[0] for row in a.suggestions()], [e])
+        a.unfollow(b)
+        db.session.commit()
+        Suggestion.rebuild(size=2)
+        self.assertEqual([(row[0], row[1]) for row in a.suggestions()],
+                         [(b, 1)])
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).where(
+            Suggestion.user_id == a.id)), 1)
+
+
+class PageQueryCase(unittest.TestCase):
+    """
+    Test case for the number of queries issued while rendering pages.
+
+    Requests run outside the test's own app context, so that nothing loaded
+    while seeding the database is cached in the session or in flask.g.
+
+    Methods:
+        setUp(): Creates the database, a reader and a client logged in as them.
+        tearDown(): Cleans up the test environment after each test method.
+        seed(authors, posts, own_posts): Adds followed authors and posts.
+        render(url): Returns the statements issued while rendering url.
+        test_feed_query_count(): Tests that the feed costs a constant number of queries.
+        test_profile_query_count(): Tests the same for the profile page.
+        test_server_timing(): Tests the instrumentation header and slow query log.
+        test_metrics_endpoint(): Tests the Prometheus histograms.
+        test_identity_cache(): Tests that a cached identity costs no query.
+        test_registration_uniqueness(): Tests the one-query check and the race.
+        test_username_available(): Tests the cached live availability check.
+        test_search_page(): Tests the search page.
+        test_fragment_cache(): Tests caching and retiring rendered fragments.
+        test_conditional_get(): Tests 304 answers and their validators.
+        test_follow_states(): Tests the batched and remembered follow lookups.
+        test_suggestions_page(): Tests who to follow on the home and profile pages.
+    """
+
+    def setUp(self):
+        self.authors = 0
+        identity_cache.clear()
+        username_availability.clear()
+        fragment_cache.clear()
+        with app.app_context():
+            db.create_all()
+            reader = User(username='reader', email='reader@example.com')
+            db.session.add(reader)
+            db.session.commit()
+            self.reader_id = reader.id
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(self.reader_id)
+
+    def tearDown(self):
+        with app.app_context():
+            db.drop_all()
+
+    def seed(self, authors=0, posts=0, own_posts=0):
+        with app.app_context():
+            reader = db.session.get(User, self.reader_id)
+            db.session.add_all([Post(body=f'mine {i}', author=reader)
+                                for i in range(own_posts)])
+            for i in range(authors):
+                self.authors += 1
+                author = User(username=f'author{self.authors}',
+                              email=f'author{self.authors}@example.com')
+                db.session.add(author)
+                db.session.add_all([Post(body=f'post {j}', author=author)
+                                    for j in range(posts)])
+                reader.follow(author)
+            db.session.commit()
+
+    def render(self, url):
+        with count_queries() as statements:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return statements
+
+    def test_feed_query_count(self):
+        self.render('/index')  # warm the identity cache
+        self.seed(authors=1, posts=1)
+        small = self.render('/index')
+        self.seed(authors=10, posts=2)
+        large = self.render('/index')
+        self.assertEqual(len(small), len(large))
+
+    def test_profile_query_count(self):
+        self.render('/user/reader')  # warm the identity cache
+        self.seed(own_posts=1)
+        small = self.render('/user/reader')
+        self.seed(own_posts=15)
+        large = self.render('/user/reader')
+        self.assertEqual(len(small), len(large))
+        # The post cells load only the author columns they render
+        self.assertFalse(any('user_1.password_hash' in statement
+                             for statement in large))
+
+    def test_server_timing(self):
+        self.seed(authors=2, posts=2)
+        instrumentation.enabled = True
+        self.addCleanup(setattr, instrumentation, 'enabled', False)
+        with count_queries() as statements:
+            response = self.client.get('/index')
+        header = response.headers['Server-Timing']
+        self.assertIn(f'desc="{len(statements)} queries"', header)
+        self.assertIn('render;dur=', header)
+        self.assertIn('total;dur=', header)
+
+        instrumentation.slow_query_threshold = 0
+        self.addCleanup(setattr, instrumentation, 'slow_query_threshold', 0.1)
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            self.client.get('/index')
+        self.assertIn('in route index: SELECT', logs.output[0])
+
+        # A failing statement leaves nothing behind on the pooled connection
+        with app.app_context():
+            connection = db.session.connection()
+            with self.assertRaises(sa.exc.OperationalError):
+                connection.execute(sa.text('SELECT * FROM missing'))
+            self.assertNotIn('query_start', connection.info)
+            with self.assertLogs(app.logger, 'WARNING') as logs:
+                connection.execute(sa.text('SELECT 1'))
+            self.assertIn('SELECT 1', logs.output[0])
+            db.session.rollback()
+
+    def test_metrics_endpoint(self):
+        self.client.get('/index')
+        self.client.get('/user/reader')
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('# TYPE microblog_request_duration_seconds histogram', text)
+        for endpoint in ('index', 'user'):
+            line = ('microblog_request_duration_seconds_count'
+                    f'{{endpoint="{endpoint}"}} ')
+            count = next(l for l in text.splitlines() if l.startswith(line))
+            self.assertGreaterEqual(float(count.split()[-1]), 1)
+        self.assertIn('le="+Inf"', text)
+
+    def test_identity_cache(self):
+        miss = self.render('/user/reader/followers')
+        hit = self.render('/user/reader/followers')
+        self.assertEqual(len(hit), len(miss) - 1)
+
+        # The home feed runs on the cached identity, without the User row
+        self.seed(authors=1, posts=2)
+        statements = self.render('/index')
+        self.assertEqual([s for s in statements if 'user.password_hash' in s],
+                         [])
+
+        # Editing the profile goes through to the row and refreshes the cache
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.addCleanup(app.config.__setitem__, 'WTF_CSRF_ENABLED', True)
+        response = self.client.post('/edit_profile', data={
+            'username': 'renamed', 'about_me': 'Hello'})
+        self.assertEqual(response.status_code, 302)
+        page = self.client.get('/user/renamed').get_data(as_text=True)
+        self.assertIn('href="/user/renamed">Profile</a>', page)
+        self.assertIn('Hello', page)
+
+    def test_registration_uniqueness(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.addCleanup(app.config.__setitem__, 'WTF_CSRF_ENABLED', True)
+        client = app.test_client()
+        form = {'username': 'reader', 'email': 'reader@example.com',
+                'password': 'cat', 'password2': 'cat'}
+        with count_queries() as statements:
+            page = client.post('/register', data=form).get_data(as_text=True)
+        self.assertEqual(len(statements), 1)
+        self.assertIn('Please use a different username.', page)
+        self.assertIn('Please use a different email address.', page)
+
+        # A concurrent registration wins between the check and the commit
+        form['email'] = 'other@example.com'
+        with mock.patch.object(User, 'identifiers_taken',
+                               return_value=(False, False)):
+            response = client.post('/register', data=form)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Please use a different username.',
+                      response.get_data(as_text=True))
+
+        form['username'] = 'newcomer'
+        response = client.post('/register', data=form)
+        self.assertEqual(response.status_code, 302)
+
+    def test_username_available(self):
+        client = app.test_client()
+        with count_queries() as statements:
+            data = client.get('/username_available?username=susan').get_json()
+        self.assertTrue(data['available'])
+        self.assertEqual(len(statements), 1)
+        with count_queries() as statements:
+            data = client.get('/username_available?username=susan').get_json()
+        self.assertTrue(data['available'])
+        self.assertEqual(statements, [])
+        self.assertFalse(client.get(
+            '/username_available?username=reader').get_json()['available'])
+
+        # Registering claims the name in this worker at once
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.addCleanup(app.config.__setitem__, 'WTF_CSRF_ENABLED', True)
+        client.post('/register', data={
+            'username': 'susan', 'email': 'susan@example.com',
+            'password': 'cat', 'password2': 'cat'})
+        self.assertFalse(client.get(
+            '/username_available?username=susan').get_json()['available'])
+
+    def test_search_page(self):
+        self.seed(authors=1, posts=2)
+        page = self.client.get('/search?q=post').get_data(as_text=True)
+        self.assertIn('author1 says:<br>post 1', page)
+        page = self.client.get('/search?q=author1&kind=users').get_data(
+            as_text=True)
+        self.assertIn('href="/user/author1">author1</a>', page)
+        page = self.client.get('/search?q=nothing').get_data(as_text=True)
+        self.assertIn('No results.', page)
+
+    def test_fragment_cache(self):
+        self.seed(authors=1, posts=3)
+        stats = fragment_cache.stats
+        misses = lambda: stats.store.collect()[stats._slot('misses')]
+        self.client.get('/user/author1')
+        before = misses()
+        page = self.client.get('/user/author1').get_data(as_text=True)
+        self.assertEqual(misses(), before)
+        self.assertIn('author1 says:<br>post 2', page)
+        self.assertIn('Followers: 1 |', page)
+        self.assertIn('csrf_token', page)
+
+        # Following retires the cached header of both users, but not the
+        # post cells
+        with app.app_context():
+            fan = User(username='fan', email='fan@example.com')
+            db.session.add(fan)
+            fan.follow(db.session.scalar(
+                sa.select(User).where(User.username == 'author1')))
+            db.session.commit()
+        before = misses()
+        page = self.client.get('/user/author1').get_data(as_text=True)
+        self.assertIn('Followers: 2 |', page)
+        self.assertEqual(misses(), before + 1)
+
+        # So does editing a profile, for the header and the post cells
+        self.seed(own_posts=1)
+        self.client.get('/user/reader')
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.addCleanup(app.config.__setitem__, 'WTF_CSRF_ENABLED', True)
+        self.client.post('/edit_profile', data={
+            'username': 'renamed', 'about_me': 'Hello'})
+        page = self.client.get('/user/renamed').get_data(as_text=True)
+        self.assertIn('<h1>User: renamed</h1>', page)
+        self.assertIn('<p>Hello</p>', page)
+        self.assertIn('renamed says:<br>mine 0', page)
+
+    def test_conditional_get(self):
+        self.seed(authors=1, posts=2, own_posts=1)
+        for url in ('/index', '/user/reader'):
+            first = self.client.get(url)
+            etag = first.headers['ETag']
+            self.assertTrue(etag.startswith('W/"'))
+            # Only the ETag follows every input of the page
+            self.assertNotIn('Last-Modified', first.headers)
+            response = self.client.get(url, headers={
+                'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+            self.assertEqual(response.status_code, 200)
+            with count_queries() as statements:
+                again = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(again.get_data(), b'')
+            with count_queries() as full:
+                self.client.get(url)
+            self.assertLess(len(statements), len(full))
+
+        # A new post in the feed changes both validators
+        etag = self.client.get('/index').headers['ETag']
+        self.seed(authors=1, posts=1)
+        response = self.client.get('/index', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        # Following someone changes the profile, for the new follower too
+        etag = self.client.get('/user/author1').headers['ETag']
+        with app.app_context():
+            fan = User(username='fan', email='fan@example.com')
+            db.session.add(fan)
+            fan.follow(db.session.scalar(
+                sa.select(User).where(User.username == 'author1')))
+            db.session.commit()
+        response = self.client.get('/user/author1',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        # So does the viewer renaming themselves, as the navigation shows it
+        etag = response.headers['ETag']
+        with app.app_context():
+            reader = db.session.get(User, self.reader_id)
+            reader.username = 'renamed'
+            reader.bump_profile_version()
+            db.session.commit()
+        identity_cache.clear()
+        response = self.client.get('/user/author1',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('renamed', response.get_data(as_text=True))
+
+        conditional_get.log_interval = 0
+        self.addCleanup(setattr, conditional_get, 'log_interval', 300.0)
+        with self.assertLogs(app.logger, 'INFO') as logs:
+            self.client.get('/user/author1', headers={
+                'If-None-Match': response.headers['ETag']})
+        self.assertTrue(any('Conditional GET user:' in line and
+                            'requests not modified' in line
+                            for line in logs.output))
+
+        # A followed author renaming changes the feed the post cells show
+        etag = self.client.get('/index').headers['ETag']
+        with app.app_context():
+            author = db.session.scalar(
+                sa.select(User).where(User.username == 'author1'))
+            author.username = 'robert'
+            author.bump_author_version()
+            author.bump_profile_version()
+            db.session.commit()
+        response = self.client.get('/index', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('robert says', response.get_data(as_text=True))
+
+    def test_follow_states(self):
+        self.seed(authors=2)
+        with app.app_context():
+            author1 = db.session.scalar(
+                sa.select(User).filter_by(username='author1'))
+            author1.follow(db.session.get(User, self.reader_id))
+            db.session.commit()
+        self.render('/user/reader/following')  # warm the identity cache
+
+        # One query for the follow states of the whole listing
+        small = self.render('/user/reader/following')
+        self.seed(authors=5)
+        large = self.render('/user/reader/following')
+        self.assertEqual(len(small), len(large))
+        items = self.client.get('/user/reader/following').get_json()['items']
+        self.assertEqual(len(items), 7)
+        self.assertTrue(all(item['following'] for item in items))
+        self.assertEqual([item['username'] for item in items
+                          if item['follows_you']], ['author1'])
+
+        response = self.client.get('/user/author1')
+        self.assertIn(b'Follows you', response.data)
+        self.assertIn(b'value="Unfollow"', response.data)
+        response = self.client.get('/user/author2')
+        self.assertNotIn(b'Follows you', response.data)
+
+        # Remembered for the rest of the request, until a follow changes it
+        with app.test_request_context():
+            reader = db.session.get(User, self.reader_id)
+            author1, author2 = db.session.get(User, 2), db.session.get(User, 3)
+            ids = list(range(1, 9))
+            with count_queries() as statements:
+                states = reader.follow_states(ids)
+                reader.follow_states(ids[:3])
+                self.assertTrue(reader.is_following(author1))
+            self.assertEqual(len(statements), 1)
+            self.assertEqual(states[2], models.FollowState(True, True))
+            self.assertEqual(states[self.reader_id],
+                             models.FollowState(False, False))
+            reader.unfollow(author2)
+            db.session.commit()
+            self.assertFalse(reader.is_following(author2))
+            self.assertFalse(author2.follow_states([reader])[self.reader_id]
+                             .followed_by)
+
+    def test_suggestions_page(self):
+        self.seed(authors=2)
+        with app.app_context():
+            star = User(username='star', email='star@example.com')
+            db.session.add(star)
+            for author in db.session.scalars(
+                    sa.select(User).where(User.username.like('author%'))):
+                author.follow(star)
+            db.session.commit()
+        etag = self.client.get('/index').headers['ETag']
+        with app.app_context():
+            Suggestion.rebuild()
+        response = self.client.get('/index', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        page = response.get_data(as_text=True)
+        self.assertIn('Who to follow', page)
+        self.assertIn('>star</a>', page)
+        self.assertIn('Followed by 2 people you follow', page)
+        self.assertIn('>star</a>', self.client.get('/user/reader')
+                      .get_data(as_text=True))
+        self.assertNotIn('Who to follow', self.client.get('/user/author1')
+                         .get_data(as_text=True))
+
+
+class FragmentCacheCase(unittest.TestCase):
+    """
+    Test case for the fragment stores and the in-process LRU cache.
+    """
+
+    def test_shared_backend(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'fragments.db')
+        backend = SQLiteBackend(path, maxsize=5)
+        backend.PRUNE_EVERY = 10
+        backend.set('post:1:0', '<p>one</p>')
+        # Another worker sees what this one rendered
+        self.assertEqual(SQLiteBackend(path).get('post:1:0'), '<p>one</p>')
+        self.assertIsNone(backend.get('post:2:0'))
+        for i in range(9):
+            backend.set(f'post:{i + 2}:0', 'x')
+        self.assertIsNone(backend.get('post:1:0'))
+        self.assertEqual(backend.get('post:10:0'), 'x')
+
+    def test_lru_backend(self):
+        backend = LRUBackend(maxsize=2)
+        backend.set('a', '1')
+        backend.set('b', '2')
+        backend.get('a')
+        backend.set('c', '3')
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('a'), '1')
+
+    def test_lru_cache_expiry(self):
+        cache = LRUCache(maxsize=2, ttl=10)
+        with mock.patch('app.lru.time.monotonic', return_value=100.0):
+            cache.set('a', 1)
+        with mock.patch('app.lru.time.monotonic', return_value=109.0):
+            self.assertEqual(cache.get('a'), 1)
+        # Reading an entry does not extend its life
+        with mock.patch('app.lru.time.monotonic', return_value=110.0):
+            self.assertIsNone(cache.get('a'))
+
+
+class SocialGraphCase(unittest.TestCase):
+    """
+    Test case for the in-memory social graph.
+
+    Methods:
+        test_lookups(): Tests membership, degrees and slices against SQL.
+        test_changes(): Tests that committed follows reach the graph.
+        test_snapshot(): Tests the mapped snapshot and the shared delta log.
+    """
+
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        saved = (social_graph.enabled, social_graph.path)
+        self.addCleanup(self._restore, saved)
+        social_graph.path = None
+        self.users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                      for i in range(5)]
+        db.session.add_all(self.users)
+        db.session.commit()
+        edges = [(0, 1), (0, 2), (0, 3), (1, 0), (2, 0), (3, 4)]
+        for a, b in edges:
+            self.users[a].follow(self.users[b])
+        db.session.commit()
+        social_graph.enabled = True
+        social_graph.reset()
+
+    def _restore(self, saved):
+        social_graph.enabled, social_graph.path = saved
+        social_graph.reset()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_lookups(self):
+        u0 = self.users[0]
+        # Loaded before counting, as the commit expired them
+        db.session.refresh(u0)
+        u1, u2, u3, u4 = (user.id for user in self.users[1:])
+        with count_queries() as statements:
+            social_graph.is_following(u0.id, u1)
+        self.assertTrue(statements)  # the graph is read on first use
+        with count_queries() as statements:
+            self.assertTrue(social_graph.is_following(u0.id, u1))
+            self.assertFalse(social_graph.is_following(u1, u2))
+            self.assertFalse(social_graph.is_following(u0.id, 999))
+            self.assertEqual(social_graph.following_count(u0.id), 3)
+            self.assertEqual(social_graph.followers_count(u0.id), 2)
+            self.assertEqual(social_graph.followers_count(999), 0)
+            self.assertEqual(social_graph.following(u0.id), [u1, u2, u3])
+            self.assertEqual(social_graph.following(u0.id, 1, 2), [u2])
+            self.assertEqual(social_graph.followers(u4), [u3])
+            states = u0.follow_states([u1, u2, u4])
+        self.assertEqual(statements, [])
+        self.assertEqual(states[u1], (True, True))
+        self.assertEqual(states[u4], (False, False))
+
+    def test_changes(self):
+        u0, u1, u2, u3, u4 = self.users
+        self.assertFalse(social_graph.is_following(u4.id, u0.id))
+        u4.follow(u0)
+        u0.unfollow(u1)
+        # Not visible before the commit, and SQL answers meanwhile
+        self.assertFalse(social_graph.is_following(u4.id, u0.id))
+        self.assertTrue(u4.is_following(u0))
+        db.session.commit()
+        self.assertTrue(social_graph.is_following(u4.id, u0.id))
+        self.assertFalse(social_graph.is_following(u0.id, u1.id))
+        self.assertEqual(social_graph.followers(u0.id), [u1.id, u2.id, u4.id])
+        self.assertEqual(social_graph.following(u0.id), [u2.id, u3.id])
+        self.assertEqual(social_graph.following_count(u0.id), 2)
+        u1.follow(u3)
+        db.session.rollback()
+        self.assertFalse(social_graph.is_following(u1.id, u3.id))
+        # Following again undoes the change instead of stacking a new one
+        u0.follow(u1)
+        db.session.commit()
+        self.assertEqual(social_graph.stats()['changes'], 1)
+
+    def test_snapshot(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'graph.bin')
+        social_graph.path = path
+        social_graph.reset()
+        u0, u1, u2, u3, u4 = self.users
+        self.assertTrue(social_graph.is_following(u3.id, u4.id))
+        self.assertTrue(os.path.exists(path))
+        self.assertIsInstance(social_graph.following(u3.id), list)
+
+        # Another worker maps the same file
+        worker = SocialGraph()
+        worker.db, worker.enabled, worker.path = db, True, path
+        self.assertEqual(worker.followers(u0.id), [u1.id, u2.id])
+        u4.follow(u0)
+        db.session.commit()
+        self.assertEqual(worker.followers(u0.id), [u1.id, u2.id, u4.id])
+
+        # A new snapshot folds the log in, and workers switch to it
+        self.assertEqual(social_graph.snapshot(), (6, 7))
+        with count_queries() as statements:
+            self.assertEqual(worker.stats()['changes'], 0)
+        self.assertEqual(statements, [])
+        self.assertTrue(worker.is_following(u4.id, u0.id))
+        with self.assertRaises(ValueError):
+            with open(path, 'r+b') as f:
+                f.write(b'garbage!')
+            worker.reset()
+            worker.is_following(u4.id, u0.id)
+
+
+class DatabaseProfileCase(unittest.TestCase):
+    """
+    Test case for the engine options and SQLite pragmas.
+
+    Uses its own Flask app and SQLAlchemy instance on a temporary file, as
+    the pragmas only apply to connections opened after attach().
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.app = Flask(__name__)
+        self.app.config.from_object(Config)
+        self.app.config.update(
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(
+                directory.name, 'test.db'),
+            SQLITE_PROFILE='tuned', SQLITE_READ_ONLY_ENGINE=True,
+            DATABASE_POOL_SIZE=3, SQLALCHEMY_ENGINE_OPTIONS={},
+            SQLALCHEMY_BINDS={})
+        profile = DatabaseProfile(self.app)
+        self.db = SQLAlchemy(self.app)
+        profile.attach(self.db)
+        self.addCleanup(self._dispose)
+
+    def _dispose(self):
+        with self.app.app_context():
+            for engine in self.db.engines.values():
+                engine.dispose()
+
+    def test_tuned_profile(self):
+        with self.app.app_context():
+            with self.db.engine.connect() as conn:
+                pragma = lambda name: conn.exec_driver_sql(
+                    f'PRAGMA {name}').scalar()
+                self.assertEqual(pragma('journal_mode'), 'wal')
+                self.assertEqual(pragma('busy_timeout'), 5000)
+                self.assertEqual(pragma('synchronous'), 1)  # NORMAL
+                conn.exec_driver_sql('CREATE TABLE t (x INTEGER)')
+                conn.commit()
+            self.assertEqual(self.db.engine.pool.size(), 3)
+
+    def test_read_only_engine(self):
+        with self.app.app_context():
+            with self.db.engine.connect() as conn:
+                conn.exec_driver_sql('CREATE TABLE t (x INTEGER)')
+                conn.exec_driver_sql('INSERT INTO t VALUES (1)')
+                conn.commit()
+            with self.db.engines['readonly'].connect() as conn:
+                self.assertEqual(
+                    conn.exec_driver_sql('SELECT x FROM t').scalar(), 1)
+                with self.assertRaises(sa.exc.OperationalError):
+                    conn.exec_driver_sql('INSERT INTO t VALUES (2)')
+
+
+class ReplicaCase(unittest.TestCase):
+    """
+    Test case for routing reads to a replica.
+
+    The application's engines are swapped for two SQLite files, a primary
+    and a replica that is only brought up to date by sync(), so replication
+    lag can be simulated by writing to the primary alone.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.primary = os.path.join(directory.name, 'primary.db')
+        self.replica = os.path.join(directory.name, 'replica.db')
+        identity_cache.clear()
+        fragment_cache.clear()
+        with app.app_context():
+            engines = db.engines
+            saved = dict(engines)
+            engines[None] = sa.create_engine('sqlite:///' + self.primary)
+            engines['replica'] = sa.create_engine('sqlite:///' + self.replica)
+            self.addCleanup(self._restore, saved)
+            db.create_all()
+            reader = User(username='reader', email='reader@example.com')
+            author = User(username='author', email='author@example.com')
+            db.session.add_all([reader, author, Post(body='old post',
+                                                     author=author)])
+            db.session.commit()
+            self.reader_id = reader.id
+        self.sync()
+        replica_router.replicas = ['replica']
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(self.reader_id)
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.addCleanup(app.config.__setitem__, 'WTF_CSRF_ENABLED', True)
+
+    def _restore(self, saved):
+        replica_router.replicas = []
+        with app.app_context():
+            for engine in (db.engines[None], db.engines['replica']):
+                engine.dispose()
+            db.engines.clear()
+            db.engines.update(saved)
+
+    def sync(self):
+        """
+        Copy the primary over the replica, as replication would.
+        """
+        source = sqlite3.connect(self.primary)
+        target = sqlite3.connect(self.replica)
+        source.backup(target)
+        source.close()
+        target.close()
+
+    def test_session_routing(self):
+        with app.app_context():
+            primary, replica = db.engines[None], db.engines['replica']
+            with app.test_request_context():
+                session = db.session()
+                self.assertIs(session.get_bind(clause=sa.select(User)), replica)
+                self.assertIs(session.get_bind(
+                    clause=sa.select(User).with_for_update()), primary)
+                self.assertIs(session.get_bind(clause=sa.update(User)), primary)
+                # Once written, the request reads its own writes
+                self.assertIs(session.get_bind(clause=sa.select(User)), primary)
+                db.session.remove()
+            # Outside of requests everything goes to the primary
+            self.assertIs(db.session.get_bind(clause=sa.select(User)), primary)
+
+    def test_read_your_writes(self):
+        with app.app_context():
+            author = db.session.scalar(
+                sa.select(User).where(User.username == 'author'))
+            db.session.add(Post(body='lagging post', author=author))
+            db.session.commit()
+        page = self.client.get('/user/author').get_data(as_text=True)
+        self.assertIn('old post', page)
+        self.assertNotIn('lagging post', page)
+
+        response = self.client.post('/follow/author')
+        self.assertEqual(response.status_code, 302)
+        page = self.client.get('/user/author').get_data(as_text=True)
+        self.assertIn('lagging post', page)
+        self.assertIn('Followers: 1', page)
+
+        # Once the sticky window is over, reads go back to the replica
+        with self.client.session_transaction() as session:
+            session['_primary_until'] = 0
+        page = self.client.get('/user/author').get_data(as_text=True)
+        self.assertNotIn('lagging post', page)
+        self.sync()
+        page = self.client.get('/user/author').get_data(as_text=True)
+        self.assertIn('lagging post', page)
+
+
+def _write_metrics(store):
+    store.add('requests', 2)
+
+
+class MetricsStoreCase(unittest.TestCase):
+    """
+    Test case for the multiprocess metrics store.
+
+    Methods:
+        test_multiprocess(): Tests that slots written by several processes are summed.
+    """
+
+    def test_multiprocess(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = MetricsStore(directory)
+            store.register(['requests'])
+            store.add('requests')
+            child = multiprocessing.get_context('fork').Process(
+                target=_write_metrics, args=(store,))
+            child.start()
+            child.join()
+            self.assertEqual(len(os.listdir(directory)), 2)
+            store.register(['late'])
+            store.add('late', 0.5)
+            self.assertEqual(store.collect(), {'requests': 3.0, 'late': 0.5})
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough of the SMTP protocol to accept messages from smtplib.
+    """
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost stub')
+        while True:
+            line = self.rfile.readline().decode('utf-8').strip()
+            command = line.split(' ', 1)[0].upper()
+            if command == 'DATA':
+                self.reply('354 go ahead')
+                lines = []
+                while True:
+                    data = self.rfile.readline().decode('utf-8')
+                    if data.rstrip('\r\n') == '.':
+                        break
+                    lines.append(data)
+                self.server.messages.append(''.join(lines))
+                self.reply('250 queued')
+            elif command == 'QUIT' or not line:
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+    def reply(self, text):
+        self.wfile.write(text.encode('utf-8') + b'\r\n')
+
+
+class ErrorMailCase(unittest.TestCase):
+    """
+    Test case for the queued digest error mailer, against a stub SMTP server.
+
+    Methods:
+        setUp(): Starts the stub SMTP server on a free local port.
+        tearDown(): Stops the server.
+        test_digest(): Tests that a burst of identical errors becomes one email.
+        test_queue_bound(): Tests that a full queue drops and counts records.
+    """
+
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('localhost', 0),
+                                                      StubSMTPHandler)
+        self.server.messages = []
+        self.server.connections = 0
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.handler = DigestMailHandler(
+            mailhost=self.server.server_address, fromaddr='no-reply@localhost',
+            toaddrs=['admin@example.com'], subject='Microblog Failure',
+            window=3600)
+
+    def tearDown(self):
+        self.handler.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_digest(self):
+        queue_handler = BoundedQueueHandler(100)
+        self.handler.queue_handler = queue_handler
+        listener = QueueListener(queue_handler.queue, self.handler)
+        logger = logging.getLogger('microblog.test.digest')
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+        listener.start()
+        for i in range(20):
+            try:
+                raise ValueError(f'bad value {i}')
+            except ValueError:
+                logger.exception('Request %d failed', i)
+        logger.error('Something else')
+        listener.stop()
+        self.handler.flush()
+
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.messages), 1)
+        message = self.server.messages[0]
+        self.assertIn('21 errors, 2 distinct', message)
+        self.assertIn('=== 20x', message)
+        self.assertIn('ValueError: bad value 0', message)
+
+    def test_queue_bound(self):
+        queue_handler = BoundedQueueHandler(2)
+        self.handler.queue_handler = queue_handler
+        logger = logging.getLogger('microblog.test.bound')
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+        for i in range(5):
+            logger.error('Error %d', i)
+        self.assertEqual(queue_handler.dropped, 3)
+
+        while not queue_handler.queue.empty():
+            self.handler.handle(queue_handler.queue.get_nowait())
+        self.handler.flush()
+        self.assertIn('3 error records were dropped', self.server.messages[0])
+
+
+def _write_log_lines(filename, worker):
+    handler = BatchingFileHandler(filename, max_bytes=4096, backup_count=100,
+                                  flush_bytes=512)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    for i in range(200):
+        handler.handle(logging.makeLogRecord(
+            {'msg': f'worker {worker} line {i:04d} ' + 'x' * 40}))
+    handler.close()
+
+
+class FileLoggingCase(unittest.TestCase):
+    """
+    Test case for the batched, rotating file log writer.
+
+    Methods:
+        test_json_lines(): Tests the JSON formatter and its extra fields.
+        test_multiprocess_rotation(): Tests that concurrent writers rotate
+            without losing or interleaving lines.
+    """
+
+    def test_json_lines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'test.log')
+            handler = BatchingFileHandler(filename, flush_interval=3600)
+            handler.setFormatter(JsonFormatter())
+            logger = logging.getLogger('microblog.test.json')
+            logger.addHandler(handler)
+            logger.propagate = False
+            logger.warning('slow %s', 'index', extra={'total_ms': 12.5})
+            self.assertEqual(os.path.getsize(filename), 0)
+            handler.close()
+            with open(filename) as f:
+                entry = json.loads(f.readline())
+            self.assertEqual(entry['message'], 'slow index')
+            self.assertEqual(entry['level'], 'WARNING')
+            self.assertEqual(entry['total_ms'], 12.5)
+
+    def test_multiprocess_rotation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'test.log')
+            context = multiprocessing.get_context('fork')
+            workers = [context.Process(target=_write_log_lines,
+                                       args=(filename, worker))
+                       for worker in range(4)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            lines = []
+            for path in glob.glob(filename + '*'):
+                if not path.endswith('.lock'):
+                    with open(path) as f:
+                        lines.extend(f.read().splitlines())
+            self.assertGreater(len(glob.glob(filename + '.*')), 2)
+            self.assertEqual(len(lines), 800)
+            self.assertEqual(len(set(lines)), 800)
+            for line in lines:
+                self.assertRegex(line, r'^worker \d line \d{4} x{40}$')
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file
@@ -15,6 +15,42 @@ class Config:
                                     Loaded from 'DATABASE_URL' environment variable,
                                     or defaults to SQLite database in app.db file.
         
+        SQLITE_PROFILE (str): Pragma set applied to every new SQLite
+                            connection: 'default' leaves SQLite's defaults,
+                            'tuned' enables WAL, busy_timeout, synchronous=NORMAL,
+                            a larger cache and mmap. Loaded from 'SQLITE_PROFILE',
+                            or defaults to 'default'.
+
+        SQLITE_PRAGMAS (dict): Pragmas overriding or extending the profile.
+
+        SQLITE_READ_ONLY_ENGINE (bool): Also open the database file through a
+                            read-only 'readonly' bind. Set to True if
+                            'SQLITE_READ_ONLY_ENGINE' environment variable exists.
+
+        DATABASE_POOL_SIZE (int): Connections kept open per worker; 0 keeps
+                            SQLAlchemy's default. Loaded from 'DATABASE_POOL_SIZE'.
+
+        DATABASE_MAX_OVERFLOW (int): Connections opened beyond the pool size
+                            under load. Loaded from 'DATABASE_MAX_OVERFLOW', or
+                            defaults to 10.
+
+        DATABASE_POOL_PRE_PING (bool): Test connections when they are checked
+                            out of the pool. Set to True if
+                            'DATABASE_POOL_PRE_PING' environment variable exists.
+
+        SQLALCHEMY_BINDS (dict): Additional databases. Each URL in the
+                            space separated 'DATABASE_REPLICA_URLS' environment
+                            variable becomes a bind named replica1, replica2, ...
+
+        DATABASE_REPLICAS (list): Bind keys that requests read from. Loaded
+                            from the comma separated 'DATABASE_REPLICAS', or
+                            defaults to all replica binds. May include
+                            'readonly' when SQLITE_READ_ONLY_ENGINE is set.
+
+        REPLICA_STICKY_SECONDS (float): How long a user who wrote something
+                            keeps reading from the primary. Loaded from
+                            'REPLICA_STICKY_SECONDS', or defaults to 5.
+
         MAIL_SERVER (str): SMTP server hostname for sending emails.
                         Loaded from 'MAIL_SERVER' environment variable.
         
@@ -35,11 +71,178 @@ class Config:
         ADMINS (list): List of administrator email addresses for error notifications.
                     Contains email addresses that will receive error reports
                     in production environment.
+
+        LAST_SEEN_GRANULARITY (int): Seconds within which repeated activity
+                            does not update a user's last_seen. Loaded from
+                            'LAST_SEEN_GRANULARITY', or defaults to 60.
+
+        LAST_SEEN_FLUSH_INTERVAL (float): Minimum seconds between two batched
+                            last_seen writes. Loaded from
+                            'LAST_SEEN_FLUSH_INTERVAL', or defaults to 5.
+
+        LAST_SEEN_FLUSH_THREAD (bool): Flush last_seen from a background thread
+                            instead of at request teardown. Set to True if
+                            'LAST_SEEN_FLUSH_THREAD' environment variable exists.
+
+        INSTRUMENTATION_ENABLED (bool): Record SQL count, db, render and total
+                            time per request, returned in a Server-Timing
+                            header and logged. Set to True if
+                            'INSTRUMENTATION_ENABLED' environment variable exists.
+
+        SLOW_QUERY_THRESHOLD (float): Statements slower than this many
+                            milliseconds are logged with their parameters and
+                            route. Loaded from 'SLOW_QUERY_THRESHOLD', or
+                            defaults to 100.
+
+        METRICS_DIR (str): Directory holding one mmap'd metrics file per worker
+                            process, so /metrics covers all gunicorn workers.
+                            Loaded from 'METRICS_DIR'; if unset, only the
+                            serving process is reported.
+
+        METRICS_ENDPOINTS (list): Endpoints that get their own latency
+                            histogram; all others are reported as 'other'.
+
+        IDENTITY_CACHE_SIZE (int): Maximum number of logged in users whose
+                            identity is cached per worker.
+
+        IDENTITY_CACHE_TTL (float): Seconds a cached identity is trusted before
+                            it is reloaded. Loaded from 'IDENTITY_CACHE_TTL',
+                            or defaults to 60.
+
+        USERNAME_CACHE_SIZE (int): Maximum number of free usernames remembered
+                            per worker for the availability check.
+
+        USERNAME_CACHE_TTL (float): Seconds a username is trusted to still be
+                            free. Loaded from 'USERNAME_CACHE_TTL', or defaults
+                            to 30.
+
+        FRAGMENT_CACHE_SIZE (int): Rendered post cells and profile headers
+                            kept per worker; 0 disables the fragment cache.
+
+        FRAGMENT_CACHE_PATH (str): SQLite file shared by all workers as a
+                            second level fragment cache. Loaded from
+                            'FRAGMENT_CACHE_PATH'; if unset, each worker only
+                            has its own.
+
+        FRAGMENT_CACHE_SHARED_SIZE (int): Approximate number of fragments kept
+                            in the shared file.
+
+        SOCIAL_GRAPH_ENABLED (bool): Whether follow lookups are answered from
+                            an in-memory copy of the followers table instead
+                            of SQL. Set to True if 'SOCIAL_GRAPH_ENABLED'
+                            environment variable exists.
+
+        SOCIAL_GRAPH_PATH (str): Snapshot file of the graph, memory-mapped by
+                            all workers, with a delta log next to it. Loaded
+                            from 'SOCIAL_GRAPH_PATH'; if unset, each worker
+                            reads the table itself, which is only correct
+                            with a single worker.
+
+        SOCIAL_GRAPH_POLL_INTERVAL (float): Seconds between two checks for
+                            changes logged by other workers. Loaded from
+                            'SOCIAL_GRAPH_POLL_INTERVAL', or defaults to 0,
+                            checking before every lookup.
+
+        SUGGESTIONS_SIZE (int): Number of users to follow computed and stored
+                            per user by flask suggestions rebuild.
+
+        SUGGESTIONS_SHOWN (int): Number of users to follow shown on the home
+                            page and on the reader's own profile.
+
+        CONDITIONAL_GET_LOG_INTERVAL (float): Seconds between two log lines
+                            reporting how many page requests were answered
+                            with 304 Not Modified. Loaded from
+                            'CONDITIONAL_GET_LOG_INTERVAL', or defaults to 300.
+
+        POSTS_PER_PAGE (int): Number of posts shown per page of a feed or
+                            profile.
+
+        USERS_PER_PAGE (int): Number of users returned per page of a follower
+                            or following listing.
+
+        MAIL_QUEUE_SIZE (int): Maximum number of error records waiting to be
+                            mailed; further records are dropped and counted.
+                            Loaded from 'MAIL_QUEUE_SIZE', or defaults to 1000.
+
+        MAIL_DIGEST_WINDOW (float): Seconds over which errors are collected
+                            into one digest email. Loaded from
+                            'MAIL_DIGEST_WINDOW', or defaults to 60.
+
+        LOG_FILE (str): Path of the application log file. Loaded from
+                            'LOG_FILE', or defaults to logs/microblog.log.
+
+        LOG_MAX_BYTES (int): Size at which the log file is rotated. Loaded from
+                            'LOG_MAX_BYTES', or defaults to 10 MB.
+
+        LOG_BACKUP_COUNT (int): Number of rotated log files kept.
+
+        LOG_JSON (bool): Write the log as JSON lines instead of plain text.
+                            Set to True if 'LOG_JSON' environment variable exists.
+
+        LOG_QUEUE_SIZE (int): Maximum number of log records waiting to be
+                            written; further records are dropped and counted.
+
+        LOG_FLUSH_BYTES (int): Buffered log size that triggers a write.
+
+        LOG_FLUSH_INTERVAL (float): Maximum seconds a log line stays buffered.
+
+        PASSWORD_HASH_METHOD (str): werkzeug hash method and cost for new
+                            password hashes, e.g. 'scrypt:32768:8:1' or
+                            'pbkdf2:sha256:600000'. Stored hashes made with
+                            another method or cost are upgraded at login.
+                            Loaded from 'PASSWORD_HASH_METHOD', or defaults
+                            to 'scrypt'.
+
+        PASSWORD_HASH_WORKERS (int): Size of the process pool that hashes and
+                            verifies passwords; 0 hashes on the request thread.
+                            Loaded from 'PASSWORD_HASH_WORKERS', or defaults
+                            to 2.
+
+        PASSWORD_HASH_CONCURRENCY (int): Maximum hash operations in flight per
+                            worker; further logins get a 503 at once. Loaded
+                            from 'PASSWORD_HASH_CONCURRENCY', or defaults to 4.
+
+        PASSWORD_HASH_TIMEOUT (float): Seconds a login waits for the pool before
+                            it gets a 503. Loaded from 'PASSWORD_HASH_TIMEOUT',
+                            or defaults to 10.
+
+        TIMELINE_ENABLED (bool): Whether home feeds are served from the
+                            precomputed timeline table (fan-out on write).
+                            Set to True if 'TIMELINE_ENABLED' environment
+                            variable exists, False otherwise.
+
+        TIMELINE_FANOUT_LIMIT (int): Authors with more followers than this are
+                            not fanned out; their posts are pulled into feeds
+                            at read time instead. Loaded from
+                            'TIMELINE_FANOUT_LIMIT', or defaults to 10000.
+
+        TIMELINE_BACKFILL (int): Newest posts of an author copied into a feed
+                            when it starts following them, or into their
+                            followers' feeds when they drop back to
+                            TIMELINE_FANOUT_LIMIT. Loaded from
+                            'TIMELINE_BACKFILL', or defaults to 100.
     """
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'isa-secret-key'
 
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
+
+    # Connection pool and SQLite pragmas
+    SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE') or 'default'
+    SQLITE_PRAGMAS = {}
+    SQLITE_READ_ONLY_ENGINE = os.environ.get('SQLITE_READ_ONLY_ENGINE') is not None
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 0)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW') or 10)
+    DATABASE_POOL_PRE_PING = os.environ.get('DATABASE_POOL_PRE_PING') is not None
+
+    # Read replicas
+    SQLALCHEMY_BINDS = {
+        f'replica{i}': url for i, url in enumerate(
+            (os.environ.get('DATABASE_REPLICA_URLS') or '').split(), 1)}
+    DATABASE_REPLICAS = [key for key in (
+        os.environ.get('DATABASE_REPLICAS') or ','.join(SQLALCHEMY_BINDS)
+    ).split(',') if key]
+    REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS') or 5)
     
     # Handle emailing errors in production application
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
@@ -47,4 +250,73 @@ class Config:
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
-    ADMINS = ['admin@example.com']
\ No newline at end of file
+    ADMINS = ['admin@example.com']
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 1000)
+    MAIL_DIGEST_WINDOW = float(os.environ.get('MAIL_DIGEST_WINDOW') or 60)
+
+    # Buffered last_seen tracking
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = float(
+        os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 5)
+    LAST_SEEN_FLUSH_THREAD = os.environ.get('LAST_SEEN_FLUSH_THREAD') is not None
+
+    # Request instrumentation
+    INSTRUMENTATION_ENABLED = os.environ.get('INSTRUMENTATION_ENABLED') is not None
+    SLOW_QUERY_THRESHOLD = float(os.environ.get('SLOW_QUERY_THRESHOLD') or 100)
+
+    # Prometheus metrics
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_ENDPOINTS = ['index', 'login', 'user', 'follow', 'unfollow',
+                         'edit_profile', 'register']
+
+    # Logged in user identity cache
+    IDENTITY_CACHE_SIZE = 10000
+    IDENTITY_CACHE_TTL = float(os.environ.get('IDENTITY_CACHE_TTL') or 60)
+
+    # Live username availability check
+    USERNAME_CACHE_SIZE = 10000
+    USERNAME_CACHE_TTL = float(os.environ.get('USERNAME_CACHE_TTL') or 30)
+
+    # Rendered fragment cache
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 10000)
+    FRAGMENT_CACHE_PATH = os.environ.get('FRAGMENT_CACHE_PATH')
+    FRAGMENT_CACHE_SHARED_SIZE = 100000
+
+    # In-memory social graph
+    SOCIAL_GRAPH_ENABLED = os.environ.get('SOCIAL_GRAPH_ENABLED') is not None
+    SOCIAL_GRAPH_PATH = os.environ.get('SOCIAL_GRAPH_PATH')
+    SOCIAL_GRAPH_POLL_INTERVAL = float(
+        os.environ.get('SOCIAL_GRAPH_POLL_INTERVAL') or 0)
+
+    # "Who to follow" suggestions
+    SUGGESTIONS_SIZE = 10
+    SUGGESTIONS_SHOWN = 5
+
+    # Conditional GET hit rate reporting
+    CONDITIONAL_GET_LOG_INTERVAL = float(
+        os.environ.get('CONDITIONAL_GET_LOG_INTERVAL') or 300)
+
+    # Pagination
+    POSTS_PER_PAGE = 20
+    USERS_PER_PAGE = 50
+
+    # Queued, batched file logging
+    LOG_FILE = os.environ.get('LOG_FILE') or 'logs/microblog.log'
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 10 * 1024 * 1024)
+    LOG_BACKUP_COUNT = 10
+    LOG_JSON = os.environ.get('LOG_JSON') is not None
+    LOG_QUEUE_SIZE = 10000
+    LOG_FLUSH_BYTES = 64 * 1024
+    LOG_FLUSH_INTERVAL = 1.0
+
+    # Offloaded password hashing
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt'
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_CONCURRENCY = int(
+        os.environ.get('PASSWORD_HASH_CONCURRENCY') or 4)
+    PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT') or 10)
+
+    # Fan-out-on-write home timelines
+    TIMELINE_ENABLED = os.environ.get('TIMELINE_ENABLED') is not None
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT') or 10000)
+    TIMELINE_BACKFILL = int(os.environ.get('TIMELINE_BACKFILL') or 100)
@@ -0,0 +1,10 @@
+"""
+Test bootstrap, loaded by pytest before any test module.
+
+The app package reads DATABASE_URL once, when it is first imported, and
+pytest imports it before a test module could set the variable. Pinning it
+here runs every test against an in-memory database, never app.db.
+"""
+import os
+
+os.environ['DATABASE_URL'] = 'sqlite://'
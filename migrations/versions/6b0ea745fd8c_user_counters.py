@@ -0,0 +1,48 @@
+"""user counters
+
+Revision ID: 6b0ea745fd8c
+Revises: 9421d4ca7450
+Create Date: 2026-10-18 18:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6b0ea745fd8c'
+down_revision = '9421d4ca7450'
+branch_labels = None
+depends_on = None
+
+# Number of user ids backfilled per UPDATE
+CHUNK_SIZE = 1000
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('followers_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('following_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('post_count', sa.Integer(), server_default='0', nullable=False))
+
+    # Backfill the counters in id ranges to keep each transaction short
+    connection = op.get_bind()
+    last_id = connection.scalar(sa.text('SELECT MAX(id) FROM user')) or 0
+    backfill = sa.text(
+        'UPDATE user SET '
+        'followers_count = (SELECT COUNT(*) FROM followers '
+        'WHERE followers.followed_id = user.id), '
+        'following_count = (SELECT COUNT(*) FROM followers '
+        'WHERE followers.follower_id = user.id), '
+        'post_count = (SELECT COUNT(*) FROM post WHERE post.user_id = user.id) '
+        'WHERE id BETWEEN :first AND :last')
+    for first_id in range(1, last_id + 1, CHUNK_SIZE):
+        connection.execute(backfill, {'first': first_id,
+                                      'last': first_id + CHUNK_SIZE - 1})
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('post_count')
+        batch_op.drop_column('following_count')
+        batch_op.drop_column('followers_count')
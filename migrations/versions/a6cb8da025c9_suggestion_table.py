@@ -0,0 +1,32 @@
+"""suggestion table
+
+Revision ID: a6cb8da025c9
+Revises: f79906c76f3b
+Create Date: 2026-10-19 00:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6cb8da025c9'
+down_revision = 'f79906c76f3b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('suggestion',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('rank', sa.Integer(), nullable=False),
+    sa.Column('suggested_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['suggested_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'rank')
+    )
+
+
+def downgrade():
+    op.drop_table('suggestion')
@@ -0,0 +1,26 @@
+"""user author version
+
+Revision ID: b3e5f0c2d8a1
+Revises: a6cb8da025c9
+Create Date: 2026-10-19 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e5f0c2d8a1'
+down_revision = 'a6cb8da025c9'
+branch_labels = None
+depends_on = None
+
+
+# Not batch mode: on SQLite that copies the user table, and the copy would
+# lose the search index triggers
+def upgrade():
+    op.add_column('user', sa.Column('author_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('user', 'author_version')
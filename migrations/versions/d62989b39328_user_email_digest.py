@@ -0,0 +1,49 @@
+"""user email digest
+
+Revision ID: d62989b39328
+Revises: 090d9de956e8
+Create Date: 2026-10-18 21:10:00.000000
+
+"""
+from hashlib import md5
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd62989b39328'
+down_revision = '090d9de956e8'
+branch_labels = None
+depends_on = None
+
+# Number of users backfilled per batch
+CHUNK_SIZE = 1000
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('email_digest', sa.String(length=32), nullable=True))
+
+    # The digest is computed in Python, so backfill in id ranges to keep
+    # both memory and each transaction small
+    connection = op.get_bind()
+    last_id = connection.scalar(sa.text('SELECT MAX(id) FROM user')) or 0
+    select = sa.text('SELECT id, email FROM user WHERE id BETWEEN :first AND :last')
+    update = sa.text('UPDATE user SET email_digest = :digest WHERE id = :id')
+    for first_id in range(1, last_id + 1, CHUNK_SIZE):
+        rows = connection.execute(select, {'first': first_id,
+                                           'last': first_id + CHUNK_SIZE - 1})
+        digests = [{'id': row.id,
+                    'digest': md5(row.email.lower().encode('utf-8')).hexdigest()}
+                   for row in rows]
+        if digests:
+            connection.execute(update, digests)
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.alter_column('email_digest', existing_type=sa.String(length=32), nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('email_digest')
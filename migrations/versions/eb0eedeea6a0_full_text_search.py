@@ -0,0 +1,74 @@
+"""full text search
+
+Revision ID: eb0eedeea6a0
+Revises: d62989b39328
+Create Date: 2026-10-18 22:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'eb0eedeea6a0'
+down_revision = 'd62989b39328'
+branch_labels = None
+depends_on = None
+
+# Number of ids indexed per statement
+CHUNK_SIZE = 1000
+
+
+def upgrade():
+    # FTS5 is SQLite only
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("CREATE VIRTUAL TABLE post_fts USING fts5("
+               "body, content='post', content_rowid='id', "
+               "tokenize='porter unicode61')")
+    op.execute("CREATE VIRTUAL TABLE user_fts USING fts5("
+               "username, about_me, content='user', content_rowid='id', "
+               "tokenize='porter unicode61')")
+    op.execute("CREATE TRIGGER post_fts_insert AFTER INSERT ON post BEGIN "
+               "INSERT INTO post_fts (rowid, body) VALUES (new.id, new.body); END")
+    op.execute("CREATE TRIGGER post_fts_delete AFTER DELETE ON post BEGIN "
+               "INSERT INTO post_fts (post_fts, rowid, body) "
+               "VALUES ('delete', old.id, old.body); END")
+    op.execute("CREATE TRIGGER post_fts_update AFTER UPDATE OF body ON post BEGIN "
+               "INSERT INTO post_fts (post_fts, rowid, body) "
+               "VALUES ('delete', old.id, old.body); "
+               "INSERT INTO post_fts (rowid, body) VALUES (new.id, new.body); END")
+    op.execute('CREATE TRIGGER user_fts_insert AFTER INSERT ON "user" BEGIN '
+               "INSERT INTO user_fts (rowid, username, about_me) "
+               "VALUES (new.id, new.username, new.about_me); END")
+    op.execute('CREATE TRIGGER user_fts_delete AFTER DELETE ON "user" BEGIN '
+               "INSERT INTO user_fts (user_fts, rowid, username, about_me) "
+               "VALUES ('delete', old.id, old.username, old.about_me); END")
+    op.execute("CREATE TRIGGER user_fts_update "
+               'AFTER UPDATE OF username, about_me ON "user" BEGIN '
+               "INSERT INTO user_fts (user_fts, rowid, username, about_me) "
+               "VALUES ('delete', old.id, old.username, old.about_me); "
+               "INSERT INTO user_fts (rowid, username, about_me) "
+               "VALUES (new.id, new.username, new.about_me); END")
+
+    # Index the existing rows in id ranges
+    connection = op.get_bind()
+    for table, source, columns in (('post_fts', 'post', 'body'),
+                                   ('user_fts', '"user"', 'username, about_me')):
+        last_id = connection.scalar(sa.text(f'SELECT MAX(id) FROM {source}')) or 0
+        fill = sa.text(f'INSERT INTO {table} (rowid, {columns}) '
+                       f'SELECT id, {columns} FROM {source} '
+                       'WHERE id BETWEEN :first AND :last')
+        for first_id in range(1, last_id + 1, CHUNK_SIZE):
+            connection.execute(fill, {'first': first_id,
+                                      'last': first_id + CHUNK_SIZE - 1})
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for trigger in ('post_fts_insert', 'post_fts_delete', 'post_fts_update',
+                    'user_fts_insert', 'user_fts_delete', 'user_fts_update'):
+        op.execute(f'DROP TRIGGER {trigger}')
+    op.execute('DROP TABLE user_fts')
+    op.execute('DROP TABLE post_fts')
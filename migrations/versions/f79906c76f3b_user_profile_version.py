@@ -0,0 +1,26 @@
+"""user profile version
+
+Revision ID: f79906c76f3b
+Revises: eb0eedeea6a0
+Create Date: 2026-10-18 23:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f79906c76f3b'
+down_revision = 'eb0eedeea6a0'
+branch_labels = None
+depends_on = None
+
+
+# Not batch mode: on SQLite that copies the user table, and the copy would
+# lose the search index triggers
+def upgrade():
+    op.add_column('user', sa.Column('profile_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('user', 'profile_version')
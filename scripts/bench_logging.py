@@ -0,0 +1,56 @@
+"""
+Micro-benchmark of the per-request cost of application logging.
+
+Compares the old synchronous RotatingFileHandler (10 KB files) with the
+queued BatchingFileHandler, timing only the logger call made on the request
+thread. Run from the repository root: python scripts/bench_logging.py
+"""
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from logging.handlers import QueueListener, RotatingFileHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+from log_handlers import BoundedQueueHandler, BatchingFileHandler  # noqa: E402
+
+RECORDS = 20000
+FORMAT = '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+
+
+def run(name, handler, cleanup=lambda: None):
+    logger = logging.getLogger(f'bench.{name}')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    timings = []
+    for i in range(RECORDS):
+        start = time.perf_counter()
+        logger.info('method=GET path=/index endpoint=index status=200 '
+                    'queries=3 db_ms=1.2 render_ms=2.5 total_ms=%d', i)
+        timings.append(time.perf_counter() - start)
+    cleanup()
+    timings.sort()
+    print(f'{name:<28} mean {statistics.mean(timings) * 1e6:7.1f} us   '
+          f'p99 {timings[int(len(timings) * 0.99)] * 1e6:7.1f} us')
+
+
+with tempfile.TemporaryDirectory() as directory:
+    before = RotatingFileHandler(os.path.join(directory, 'before.log'),
+                                 maxBytes=10240, backupCount=10)
+    before.setFormatter(logging.Formatter(FORMAT))
+    run('RotatingFileHandler 10 KB', before, before.close)
+
+    writer = BatchingFileHandler(os.path.join(directory, 'after.log'))
+    writer.setFormatter(logging.Formatter(FORMAT))
+    queue_handler = BoundedQueueHandler(RECORDS)
+    listener = QueueListener(queue_handler.queue, writer)
+    listener.start()
+
+    def stop():
+        listener.stop()
+        writer.close()
+
+    run('Queue + BatchingFileHandler', queue_handler, stop)
@@ -0,0 +1,122 @@
+"""
+Benchmark of concurrent SQLite reads and writes under each pragma profile.
+
+Reader threads run the profile page lookup while writer threads update
+last_seen one row per transaction, as before_request used to. Each profile
+of app/database.py is run against a fresh copy of the same database file,
+with a read-only engine for the readers when asked to.
+Run from the repository root: python scripts/bench_sqlite.py [--read-only]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+
+import sqlalchemy as sa
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+from database import PROFILES, DatabaseProfile  # noqa: E402
+
+USERS = 10000
+DURATION = 5.0
+
+
+def make_engine(path, pragmas, read_only=False):
+    if read_only:
+        url = f'sqlite:///file:{path}?mode=ro&uri=true'
+    else:
+        url = f'sqlite:///{path}'
+    engine = sa.create_engine(url, pool_size=16, max_overflow=0)
+    # The same hook the application installs with DatabaseProfile.attach()
+    profile = DatabaseProfile()
+    profile.pragmas = pragmas
+    sa.event.listen(engine, 'connect', partial(profile._configure, read_only))
+    return engine
+
+
+def seed(path):
+    engine = sa.create_engine(f'sqlite:///{path}')
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            'CREATE TABLE user (id INTEGER PRIMARY KEY, username TEXT UNIQUE, '
+            'about_me TEXT, last_seen REAL)')
+        conn.exec_driver_sql(
+            'INSERT INTO user (username, about_me, last_seen) VALUES (?, ?, ?)',
+            [(f'user{i}', 'x' * 100, 0.0) for i in range(USERS)])
+    engine.dispose()
+
+
+def run(name, pragmas, readers, writers, read_only):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        seed(path)
+        write_engine = make_engine(path, pragmas)
+        # Touch the file once so WAL mode is set before the readers connect
+        with write_engine.connect() as conn:
+            conn.exec_driver_sql('SELECT 1')
+        read_engine = make_engine(path, pragmas, read_only) \
+            if read_only else write_engine
+        counts = {'reads': 0, 'writes': 0, 'errors': 0}
+        lock = threading.Lock()
+        stop = time.perf_counter() + DURATION
+
+        def count(kind):
+            with lock:
+                counts[kind] += 1
+
+        def reader(seed):
+            i = seed
+            with read_engine.connect() as conn:
+                while time.perf_counter() < stop:
+                    i = (i * 7919 + 1) % USERS
+                    try:
+                        conn.exec_driver_sql(
+                            'SELECT id, username, about_me, last_seen FROM user '
+                            'WHERE username = ?', (f'user{i}',)).all()
+                        conn.rollback()
+                        count('reads')
+                    except sa.exc.OperationalError:
+                        conn.rollback()
+                        count('errors')
+
+        def writer(seed):
+            i = seed
+            with write_engine.connect() as conn:
+                while time.perf_counter() < stop:
+                    i = (i * 104729 + 1) % USERS
+                    try:
+                        conn.exec_driver_sql(
+                            'UPDATE user SET last_seen = ? WHERE id = ?',
+                            (time.time(), i + 1))
+                        conn.commit()
+                        count('writes')
+                    except sa.exc.OperationalError:
+                        conn.rollback()
+                        count('errors')
+
+        threads = [threading.Thread(target=reader, args=(n,))
+                   for n in range(readers)]
+        threads += [threading.Thread(target=writer, args=(n,))
+                    for n in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        write_engine.dispose()
+        read_engine.dispose()
+    print(f'{name:<10} reads/s {counts["reads"] / DURATION:9.0f}   '
+          f'writes/s {counts["writes"] / DURATION:7.0f}   '
+          f'errors {counts["errors"]}')
+
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+parser.add_argument('--readers', type=int, default=8)
+parser.add_argument('--writers', type=int, default=2)
+parser.add_argument('--read-only', action='store_true',
+                    help='serve the readers from a read-only engine')
+args = parser.parse_args()
+for profile, pragmas in PROFILES.items():
+    run(profile, pragmas, args.readers, args.writers, args.read_only)
@@ -0,0 +1,19 @@
+"""
+Load generator and benchmark suite for the microblog.
+
+Builds a synthetic social graph with power-law follower counts in a
+scratch SQLite database, drives the application through the Flask test
+client with a mix of feed, profile, follow and login traffic, and reports
+throughput, latency percentiles and SQL query counts per endpoint as JSON.
+A report can be compared with a stored baseline to catch regressions.
+The suggestions command times the "who to follow" batch job instead.
+
+Run from the repository root:
+
+    python -m scripts.benchmark run --output report.json
+    python -m scripts.benchmark compare scripts/benchmark/baseline.json report.json
+    python -m scripts.benchmark generate --database big.db --users 100000 \\
+        --follows 100
+    python -m scripts.benchmark suggestions --database big.db --users 100000 \\
+        --follows 100
+"""
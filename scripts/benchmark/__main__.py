@@ -0,0 +1,231 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+
+from . import __doc__ as description
+from .report import compare
+
+# Application settings that change the numbers, recorded in every report
+SETTINGS = ('SQLITE_PROFILE', 'TIMELINE_ENABLED', 'FRAGMENT_CACHE_SIZE',
+            'PASSWORD_HASH_METHOD', 'PASSWORD_HASH_WORKERS')
+
+
+def use_database(path):
+    """
+    Point the application at path; must run before the app is imported.
+    """
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(path)}'
+    os.environ['INSTRUMENTATION_ENABLED'] = '1'
+    os.environ.setdefault('LOG_FILE', os.devnull)
+
+
+def make_graph(args):
+    from .graph import Graph
+    return Graph(args.users, args.follows, args.posts, args.alpha, args.seed)
+
+
+def generate(args, scratch):
+    if os.path.exists(args.database):
+        sys.exit(f'{args.database} already exists')
+    use_database(args.database)
+    make_graph(args).load(args.batch_size, log=_log)
+
+
+def prepare(args, scratch):
+    """
+    Load the graph into the database unless given one, and count its rows.
+    """
+    database = args.database or os.path.join(scratch, 'benchmark.db')
+    exists = os.path.exists(database)
+    use_database(database)
+    import sqlalchemy as sa
+    from app import app, db
+    from app.models import User, Post, followers
+
+    graph = make_graph(args)
+    if not exists:
+        graph.load(args.batch_size, log=_log)
+    with app.app_context():
+        # Counted, as a reused database may have been generated differently
+        loaded = {
+            'users': db.session.scalar(sa.select(sa.func.count(User.id))),
+            'follows': db.session.scalar(
+                sa.select(sa.func.count()).select_from(followers)),
+            'posts': db.session.scalar(sa.select(sa.func.count(Post.id))),
+        }
+    if loaded['users'] != args.users:
+        sys.exit(f'{database} holds {loaded["users"]} users, not {args.users}')
+    return graph, loaded
+
+
+def run(args, scratch):
+    graph, loaded = prepare(args, scratch)
+    from app import app, last_seen_tracker
+    from .report import summarize
+    from .traffic import Driver
+
+    driver = Driver(graph, sessions=args.sessions, seed=args.seed)
+    driver.run(args.warmup)
+    start = time.perf_counter()
+    samples = driver.run(args.requests)
+    seconds = time.perf_counter() - start
+    # Write the buffered last_seen updates while the database still exists
+    last_seen_tracker.stop()
+    report = {
+        'config': {key: getattr(args, key) for key in (
+            'users', 'follows', 'posts', 'alpha', 'seed', 'requests',
+            'warmup', 'sessions')},
+        'loaded': loaded,
+        'settings': {key: app.config[key] for key in SETTINGS},
+        'environment': _environment(),
+        'results': summarize(samples, seconds),
+    }
+    _write_report(report, args.output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        return _report_problems(compare(baseline, report, args.tolerance))
+    return 0
+
+
+def suggestions(args, scratch):
+    graph, loaded = prepare(args, scratch)
+    import sqlalchemy as sa
+    from app import app, db
+    from app.models import Suggestion
+
+    with app.app_context():
+        start = time.perf_counter()
+        written = Suggestion.rebuild(
+            args.size, args.chunk_size,
+            progress=lambda last_id, rows: _log(
+                f'Suggestions computed up to user {last_id}'))
+        seconds = time.perf_counter() - start
+        served = db.session.scalar(
+            sa.select(sa.func.count(sa.distinct(Suggestion.user_id))))
+    report = {
+        'config': {key: getattr(args, key) for key in (
+            'users', 'follows', 'posts', 'alpha', 'seed', 'size',
+            'chunk_size')},
+        'loaded': loaded,
+        'environment': _environment(),
+        'results': {
+            'seconds': round(seconds, 2),
+            'users_per_second': round(loaded['users'] / seconds, 1)
+            if seconds else 0.0,
+            'suggestions': written,
+            'users_with_suggestions': served,
+        },
+    }
+    _write_report(report, args.output)
+    return 0
+
+
+def compare_reports(args, scratch):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.report) as f:
+        report = json.load(f)
+    return _report_problems(compare(baseline, report, args.tolerance))
+
+
+def _environment():
+    return {
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def _write_report(report, output):
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+def _report_problems(problems):
+    for problem in problems:
+        _log(f'REGRESSION {problem}')
+    if not problems:
+        _log('No regressions against the baseline.')
+    return 1 if problems else 0
+
+
+def _log(message):
+    print(message, file=sys.stderr)
+
+
+def _graph_arguments(parser):
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--follows', type=float, default=20,
+                        help='mean number of users each user follows')
+    parser.add_argument('--posts', type=float, default=10,
+                        help='mean number of posts per user')
+    parser.add_argument('--alpha', type=float, default=1.0,
+                        help='exponent of the popularity power law')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='rows inserted per transaction while loading')
+
+
+parser = argparse.ArgumentParser(
+    prog='python -m scripts.benchmark', description=description,
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+commands = parser.add_subparsers(required=True)
+
+command = commands.add_parser('generate', help='only build a database')
+command.add_argument('--database', required=True)
+_graph_arguments(command)
+command.set_defaults(handler=generate)
+
+command = commands.add_parser('run', help='build a database unless given '
+                                          'one, and benchmark it')
+command.add_argument('--database',
+                     help='database to use, generated first if missing; '
+                          'a scratch database by default')
+_graph_arguments(command)
+command.add_argument('--requests', type=int, default=2000)
+command.add_argument('--warmup', type=int, default=200)
+command.add_argument('--sessions', type=int, default=20,
+                     help='number of concurrently logged in users')
+command.add_argument('--output', help='report file; stdout by default')
+command.add_argument('--baseline', help='report to compare the run with')
+command.add_argument('--tolerance', type=float, default=0.25,
+                     help='allowed latency and throughput drift')
+command.set_defaults(handler=run)
+
+command = commands.add_parser('suggestions', help='build a database unless '
+                                                  'given one, and time the '
+                                                  'who to follow batch job')
+command.add_argument('--database',
+                     help='database to use, generated first if missing; '
+                          'a scratch database by default')
+_graph_arguments(command)
+command.add_argument('--size', type=int, default=10,
+                     help='suggestions kept per user')
+command.add_argument('--chunk-size', type=int, default=1000,
+                     help='users whose lists are replaced per transaction')
+command.add_argument('--output', help='report file; stdout by default')
+command.set_defaults(handler=suggestions)
+
+command = commands.add_parser('compare', help='compare a report with a '
+                                              'baseline')
+command.add_argument('baseline')
+command.add_argument('report')
+command.add_argument('--tolerance', type=float, default=0.25,
+                     help='allowed latency and throughput drift')
+command.set_defaults(handler=compare_reports)
+
+args = parser.parse_args()
+with tempfile.TemporaryDirectory() as scratch:
+    status = args.handler(args, scratch)
+sys.exit(status or 0)
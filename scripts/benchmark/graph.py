@@ -0,0 +1,116 @@
+"""
+Synthetic social graphs with power-law follower and post counts.
+"""
+import itertools
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from app import app, db, password_hasher
+from app import bulk
+from app.models import Timeline
+
+PASSWORD = 'password'
+WORDS = ('garden', 'coffee', 'python', 'flask', 'music', 'travel', 'cat',
+         'dog', 'rain', 'sun', 'book', 'film', 'code', 'bike', 'tea', 'city')
+
+
+def username(i):
+    return f'user{i}'
+
+
+class Graph:
+    """
+    A reproducible random social graph.
+
+    Users are ranked by popularity, user0 being the most popular. Every
+    user follows a Pareto-distributed number of others, picked with a
+    probability proportional to 1 / (rank + 1) ** alpha, so a few users
+    have most of the followers, as on real networks. Post counts are
+    Pareto-distributed as well.
+
+    Attributes:
+        users (int): Number of users.
+        follows (float): Mean number of users each user follows.
+        posts (float): Mean number of posts per user.
+        alpha (float): Exponent of the popularity distribution.
+        seed (int): Seed of the random generator.
+    """
+
+    def __init__(self, users, follows=20, posts=10, alpha=1.0, seed=0):
+        self.users = users
+        self.follows = follows
+        self.posts = posts
+        self.alpha = alpha
+        self.seed = seed
+        weights = [1 / (rank + 1) ** alpha for rank in range(users)]
+        self.cum_weights = list(itertools.accumulate(weights))
+
+    def pick(self, rng, k=1):
+        """
+        Return k user numbers drawn by popularity, with repetitions.
+        """
+        return rng.choices(range(self.users), cum_weights=self.cum_weights,
+                           k=k)
+
+    def user_records(self):
+        # Hashing every password would dominate the load; all users share one
+        password_hash = password_hasher.hash(PASSWORD)
+        for i in range(self.users):
+            yield {'username': username(i), 'email': f'{username(i)}@example.com',
+                   'password_hash': password_hash}
+
+    def follow_records(self):
+        rng = random.Random(self.seed)
+        for i in range(self.users):
+            wanted = min(_pareto(rng, self.follows), self.users - 1)
+            chosen = set()
+            # Popular users are drawn again and again; give up after a while
+            for _ in range(4):
+                chosen.update(self.pick(rng, wanted - len(chosen)))
+                chosen.discard(i)
+                if len(chosen) >= wanted:
+                    break
+            for j in sorted(chosen):
+                yield {'follower': username(i), 'followed': username(j)}
+
+    def post_records(self, days=30):
+        rng = random.Random(self.seed + 1)
+        now = datetime.now(timezone.utc)
+        for i in range(self.users):
+            for _ in range(_pareto(rng, self.posts)):
+                body = ' '.join(rng.choices(WORDS, k=rng.randint(3, 12)))
+                timestamp = now - timedelta(seconds=rng.uniform(0, days * 86400))
+                yield {'author': username(i), 'body': body,
+                       'timestamp': timestamp}
+
+    def load(self, batch_size=5000, log=print):
+        """
+        Create the tables and load the graph into the application database.
+
+        Returns:
+            dict: Number of users, follows and posts loaded.
+        """
+        counts = {}
+        with app.app_context():
+            db.create_all()
+            loads = [
+                ('users', bulk.load_users, self.user_records()),
+                ('follows', bulk.load_follows, self.follow_records()),
+                ('posts', bulk.load_posts, self.post_records()),
+            ]
+            with bulk.deferred_indexes(db.session, [kind for kind, *_ in loads]):
+                for kind, load, records in loads:
+                    start = time.perf_counter()
+                    counts[kind] = load(db.session, records, batch_size)
+                    log(f'Loaded {counts[kind]} {kind} in '
+                        f'{time.perf_counter() - start:.1f}s')
+            if app.config['TIMELINE_ENABLED']:
+                Timeline.rebuild()
+                db.session.commit()
+        return counts
+
+
+def _pareto(rng, mean, shape=2.0):
+    # A Pareto variate of this shape has mean shape / (shape - 1)
+    return int(mean * rng.paretovariate(shape) * (shape - 1) / shape)
@@ -0,0 +1,101 @@
+"""
+Benchmark reports: summaries of the samples, and baseline comparisons.
+"""
+import statistics
+
+
+def percentile(values, fraction):
+    """
+    Return the nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, round(fraction * len(values)) - 1))
+    return values[index]
+
+
+def summarize(samples, seconds):
+    """
+    Summarize the samples of a run per kind of request.
+
+    Args:
+        samples (list): The Samples of the run.
+        seconds (float): Wall time of the whole run.
+
+    Returns:
+        dict: Totals, and per kind the throughput, latency percentiles in
+              milliseconds, SQL query counts and status counts.
+    """
+    endpoints = {}
+    for kind in sorted({sample.kind for sample in samples}):
+        mine = [sample for sample in samples if sample.kind == kind]
+        latencies = sorted(sample.seconds * 1000 for sample in mine)
+        queries = [sample.queries for sample in mine]
+        busy = sum(latencies) / 1000
+        endpoints[kind] = {
+            'requests': len(mine),
+            'throughput': round(len(mine) / busy, 1) if busy else 0.0,
+            'latency_ms': {
+                'mean': round(statistics.fmean(latencies), 2),
+                'p50': round(percentile(latencies, 0.5), 2),
+                'p90': round(percentile(latencies, 0.9), 2),
+                'p99': round(percentile(latencies, 0.99), 2),
+                'max': round(latencies[-1], 2),
+            },
+            'queries': {
+                'mean': round(statistics.fmean(queries), 2),
+                'max': max(queries),
+            },
+            'not_modified': sum(sample.status == 304 for sample in mine),
+            'errors': sum(sample.status >= 400 for sample in mine),
+        }
+    return {
+        'requests': len(samples),
+        'seconds': round(seconds, 2),
+        'throughput': round(len(samples) / seconds, 1) if seconds else 0.0,
+        'endpoints': endpoints,
+    }
+
+
+def compare(baseline, current, tolerance=0.25, query_tolerance=0.05):
+    """
+    List how a report regressed from a baseline report.
+
+    The median and p90 latencies and the throughput may drift by
+    tolerance, as they depend on the machine; p99 is too noisy at these
+    sample sizes to be compared. Query counts are deterministic for a given
+    seed and may only drift by query_tolerance. Errors may not increase.
+
+    Returns:
+        list: One message per regression; empty if there are none.
+    """
+    problems = []
+    if baseline.get('config') != current.get('config'):
+        problems.append('the runs used different configurations: '
+                        f'{baseline.get("config")} != {current.get("config")}')
+    if current['results']['throughput'] < \
+            baseline['results']['throughput'] * (1 - tolerance):
+        problems.append(
+            f'throughput fell from {baseline["results"]["throughput"]} to '
+            f'{current["results"]["throughput"]} requests/s')
+    old_endpoints = baseline['results']['endpoints']
+    new_endpoints = current['results']['endpoints']
+    for kind, old in old_endpoints.items():
+        new = new_endpoints.get(kind)
+        if new is None:
+            problems.append(f'{kind}: missing from the report')
+            continue
+        for key in ('p50', 'p90'):
+            if new['latency_ms'][key] > old['latency_ms'][key] * (1 + tolerance):
+                problems.append(
+                    f'{kind}: {key} latency rose from {old["latency_ms"][key]} '
+                    f'to {new["latency_ms"][key]} ms')
+        if new['queries']['mean'] > \
+                old['queries']['mean'] * (1 + query_tolerance):
+            problems.append(
+                f'{kind}: mean queries rose from {old["queries"]["mean"]} '
+                f'to {new["queries"]["mean"]}')
+        if new['errors'] > old['errors']:
+            problems.append(f'{kind}: errors rose from {old["errors"]} to '
+                            f'{new["errors"]}')
+    return problems
@@ -0,0 +1,128 @@
+"""
+Drives the application through the Flask test client with a traffic mix.
+"""
+import logging
+import random
+import re
+import time
+
+from app import app, instrumentation
+
+from .graph import PASSWORD, username
+
+# Share of each kind of request in the default mix
+MIX = {'feed': 0.55, 'profile': 0.3, 'follow': 0.06, 'unfollow': 0.06,
+       'login': 0.03}
+
+_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+class Sample:
+    """
+    The measurements of one request.
+
+    Attributes:
+        kind (str): The kind of request, a key of the mix.
+        seconds (float): Wall time of the request.
+        queries (int): SQL statements run, from the Server-Timing header.
+        status (int): HTTP status code.
+    """
+    __slots__ = ('kind', 'seconds', 'queries', 'status')
+
+    def __init__(self, kind, seconds, queries, status):
+        self.kind = kind
+        self.seconds = seconds
+        self.queries = queries
+        self.status = status
+
+
+class Driver:
+    """
+    Plays the traffic of a pool of logged in users against the application.
+
+    Each session is a test client logged in as a user drawn by popularity,
+    since active users tend to be the popular ones. Profile views and
+    follows target users drawn the same way. Like a browser, every session
+    keeps the ETags it was sent and revalidates with them.
+
+    Attributes:
+        graph (Graph): The graph loaded in the database.
+        mix (dict): Share of each kind of request.
+        sessions (int): Number of concurrent logged in users.
+    """
+
+    def __init__(self, graph, mix=None, sessions=20, seed=0):
+        self.graph = graph
+        self.mix = mix or MIX
+        self.sessions = sessions
+        self.rng = random.Random(seed)
+        self._clients = []
+        app.config['WTF_CSRF_ENABLED'] = False
+        # Every request reports its query count in a Server-Timing header,
+        # but only slow queries are logged
+        instrumentation.enabled = True
+        app.logger.setLevel(logging.WARNING)
+
+    def run(self, requests):
+        """
+        Send requests requests drawn from the mix.
+
+        Returns:
+            list: A Sample per request, including the logins they needed.
+        """
+        samples = []
+        kinds = self.rng.choices(list(self.mix), list(self.mix.values()),
+                                 k=requests)
+        for kind in kinds:
+            if kind == 'login' or len(self._clients) < self.sessions:
+                samples.append(self._login())
+            else:
+                samples.append(getattr(self, '_' + kind)())
+        return samples
+
+    def _login(self):
+        client = app.test_client()
+        sample = self._request(client, 'login', 'post', '/login', data={
+            'username': username(self.graph.pick(self.rng)[0]),
+            'password': PASSWORD})
+        client.etags = {}
+        if len(self._clients) < self.sessions:
+            self._clients.append(client)
+        else:
+            self._clients[self.rng.randrange(self.sessions)] = client
+        return sample
+
+    def _feed(self):
+        return self._request(self._client(), 'feed', 'get', '/index')
+
+    def _profile(self):
+        target = username(self.graph.pick(self.rng)[0])
+        return self._request(self._client(), 'profile', 'get',
+                             f'/user/{target}')
+
+    def _follow(self):
+        target = username(self.graph.pick(self.rng)[0])
+        return self._request(self._client(), 'follow', 'post',
+                             f'/follow/{target}')
+
+    def _unfollow(self):
+        target = username(self.graph.pick(self.rng)[0])
+        return self._request(self._client(), 'unfollow', 'post',
+                             f'/unfollow/{target}')
+
+    def _client(self):
+        return self.rng.choice(self._clients)
+
+    def _request(self, client, kind, method, path, **kwargs):
+        etags = getattr(client, 'etags', {})
+        headers = {}
+        if method == 'get' and path in etags:
+            headers['If-None-Match'] = etags[path]
+        start = time.perf_counter()
+        response = getattr(client, method)(path, headers=headers, **kwargs)
+        seconds = time.perf_counter() - start
+        if response.headers.get('ETag'):
+            etags[path] = response.headers['ETag']
+        match = _QUERIES.search(response.headers.get('Server-Timing', ''))
+        return Sample(kind, seconds, int(match.group(1)) if match else 0,
+                      response.status_code)
@@ -1,7 +0,0 @@
-from app import app, db
-from app.models import User
-
-with app.app_context():
-    users = User.query.all()
-    for user in users:
-        print(f"ID: {user.id}, Username: {user.username}, Email: {user.email}, Password: {user.password_hash}")
\ No newline at end of file